@@ -3,15 +3,34 @@ This can also contain game logic. For more complex games it would be wise to
 move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
+import collections
 from datetime import datetime
 import endpoints
-from protorpc import remote, messages, message_types
-from google.appengine.api import oauth
+from protorpc import remote, messages
+from google.appengine.api import datastore_errors, oauth
 from google.appengine.ext import ndb
 
-from models import User, Game, PlayerMoves, UserScores
+import bot
+import counters
+import engine
+import events
+import leaderboard
+import matchmaking
+import movelog
+import profiling
+import ratelimit
+import stats
+import tournament
+from engine import MOVES
+from models import User, Game, GameSummary, UserScores, pack_history
 from models import StringMessage, StringMessages
-from utils import get_by_urlsafe
+from models import GameEventForm, GameEventForms
+from models import GameForm, HistoryForm, UserRankForm, UserRankForms
+from models import MoveForms, MoveResultForm, MoveResultForms
+from models import StatsForm
+from models import Tournament, TournamentForm
+from utils import get_by_urlsafe, get_by_urlsafe_async, get_cursor, get_key
+from utils import coalesce, get_users, get_users_async, invalidate
 
 USER_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1))
@@ -28,12 +47,505 @@ PLAY_GAME_REQUEST = endpoints.ResourceContainer(
     player_name=messages.StringField(2),
     move=messages.StringField(3))
 
+REPLAY_GAME_REQUEST = endpoints.ResourceContainer(
+    game_key=messages.StringField(1),
+    round=messages.IntegerField(2))
+
+WAIT_GAME_EVENTS_REQUEST = endpoints.ResourceContainer(
+    game_key=messages.StringField(1),
+    since=messages.IntegerField(2, default=0))
+
 GET_USER_GAME_REQUEST = endpoints.ResourceContainer(
-    player_name=messages.StringField(1))
+    player_name=messages.StringField(1),
+    page_size=messages.IntegerField(2, default=20),
+    cursor=messages.StringField(3))
+
+MAX_PAGE_SIZE = 100  # Maximum page_size of get_user_games/get_high_scores
+
+GET_RANKINGS_REQUEST = endpoints.ResourceContainer(
+    limit=messages.IntegerField(1, default=100),
+    cursor=messages.StringField(2))
+
+MAX_RANKINGS = 500  # Maximum limit of get_user_rankings
+
+MAX_BATCH_MOVES = 100  # Maximum number of moves sent to play_moves
+
+CREATE_TOURNAMENT_REQUEST = endpoints.ResourceContainer(
+    name=messages.StringField(1, required=True),
+    player_names=messages.StringField(2, repeated=True),
+    pairing=messages.StringField(3, default=tournament.ROUND_ROBIN),
+    rounds=messages.IntegerField(4))
+
+GET_TOURNAMENT_REQUEST = endpoints.ResourceContainer(
+    tournament_key=messages.StringField(1))
+
+MAX_TOURNAMENT_PLAYERS = 10000
+MAX_USERS_PER_GET = 1000
+
+
+def _apply_move(game, player_name, move):
+    """Apply a single player's move to an active Game in memory.
+    Args:
+        game: The Game
+        player_name: Name of the player making the move
+        move: rock, paper or scissors
+    Returns:
+        The game result message.
+    Raises:
+        endpoints.ConflictException: If the move is not allowed."""
+    if not game.is_active:
+        raise endpoints.ConflictException('Game has already finished')
+
+    if game.player_1_name == player_name:
+        player, opponent_name = 0, game.player_2_name
+    elif game.player_2_name == player_name:
+        player, opponent_name = 1, game.player_1_name
+    else:
+        raise endpoints.ConflictException(
+            '{} is not a player of this game!'.format(player_name))
+
+    # Save single player's move. Players can choose
+    # rock, paper or scissors from the cards remaining.
+    state = game.to_state()
+    try:
+        engine.apply_move(state, player, move)
+    except engine.UnknownCard:
+        raise endpoints.ConflictException(
+            '{} chose a card we don\'t know about. You have to '
+            'choose rock, paper or scissors. Try to choose a '
+            'card again.'.format(player_name))
+    except engine.NoCardLeft:
+        raise endpoints.ConflictException(
+            '{}\'s {} card does not remain. '
+            'Choose another type of card.'.format(player_name, move))
+    except engine.AlreadyMoved as e:
+        raise endpoints.ConflictException(
+            '{} already used a {} card. '
+            'Please wait to {}\'s move.'.format(
+                player_name, e.move, opponent_name))
+    # Only an accepted move clears the result of the previous one
+    game.round_result = None
+
+    # Evaluate result of the round once both players have played
+    played = list(state.moves)
+    game_winner = engine.resolve_round(state)
+    game.apply_state(state)
+    if game_winner is not None:
+        if game_winner == engine.PLAYER_1_WINS:
+            game.round_result = ('Round result: Winner:{}, Loser:{}.'.
+                                 format(game.player_1_name,
+                                        game.player_2_name))
+        elif game_winner == engine.PLAYER_2_WINS:
+            game.round_result = ('Round result: Winner:{}, Loser:{}.'.
+                                 format(game.player_2_name,
+                                        game.player_1_name))
+        else:
+            game.round_result = 'Round result: Draw.'
+
+        # record player's move history to the Game itself
+        game.record_round(MOVES[played[0]], MOVES[played[1]])
+
+    if not engine.is_finished(state):
+        return 'Game still in progress.'
+    game.is_active = False
+    if game.player_1_round_score > game.player_2_round_score:
+        return ('Game finished. Game result Winner:{}, Loser:{}.'.
+                format(game.player_1_name, game.player_2_name))
+    elif game.player_1_round_score < game.player_2_round_score:
+        return ('Game finished. Game result Winner:{}, Loser:{}.'.
+                format(game.player_2_name, game.player_1_name))
+    return 'Game finished. Game result is Draw.'
+
+
+def _bot_move(game):
+    """Choose the bot's card of the round in a single player game, unless
+    it has already played. The bot does not see a card its opponent has
+    just played.
+    Returns:
+        The move, or None if the bot had already played."""
+    player = 0 if game.player_1_name == bot.BOT_NAME else 1
+    state = game.to_state()
+    if state.moves[player] is not None:
+        return None
+    return bot.choose_move(state, player)
+
+
+def _move_events(game, player_name, game_result):
+    """Return the (kind, message) events of a move just applied to game"""
+    published = [(events.MOVED, '{} played a card.'.format(player_name))]
+    if game.round_result is not None:
+        published.append((events.ROUND, game.round_result))
+    if not game.is_active:
+        published.append((events.FINISHED, game_result))
+    return published
+
+
+@ndb.transactional_tasklet(xg=True)
+def _commit_moves_async(game_key, moves):
+    """Apply moves to a Game in order and write every changed entity in one
+    batch. Runs in a cross-group transaction so that two players moving at
+    the same time cannot overwrite each other. A move that is not allowed
+    is reported and skipped; the others are still applied.
+    Args:
+        game_key: The ndb.Key of the Game
+        moves: A list of (player_name, move) pairs
+    Returns:
+        A tuple of the updated Game, a list with the game result message or
+        the ConflictException of each move, the names of the players whose
+        results changed and the list of (seq, events) to publish."""
+    game = yield game_key.get_async()
+    was_active = game.is_active
+    results = []
+    published = []
+    logged = []
+    with profiling.phase('play_game.resolve_round'):
+        for player_name, move in moves:
+            try:
+                game_result = _apply_move(game, player_name, move)
+            except endpoints.ConflictException as e:
+                results.append(e)
+                continue
+            results.append(game_result)
+            logged.extend(movelog.record(game, player_name, move))
+            published.append((events.game_seq(game),
+                              _move_events(game, player_name, game_result)))
+            if bot.BOT_NAME in game.players and game.is_active:
+                bot_move = _bot_move(game)
+                if bot_move:
+                    results[-1] = _apply_move(game, bot.BOT_NAME, bot_move)
+                    logged.extend(movelog.record(game, bot.BOT_NAME,
+                                                 bot_move))
+                    published.append((events.game_seq(game),
+                                      _move_events(game, bot.BOT_NAME,
+                                                   results[-1])))
+    if not published:
+        raise ndb.Return(game, results, [], [])
+
+    entities = [game] + logged
+    finished = []
+    # Update Game and the players' results if game has finished
+    if was_active and not game.is_active:
+        with profiling.phase('play_game.finish_game'):
+            # record user score to UserScores()
+            entities.append(UserScores(parent=game.key,
+                                       player=game.player_1_name,
+                                       score=game.player_1_round_score))
+            entities.append(UserScores(parent=game.key,
+                                       player=game.player_2_name,
+                                       score=game.player_2_round_score))
+
+            finished = [game.player_1_name, game.player_2_name]
+            shards = yield [counters.increment_async(name, result)
+                            for name, result in zip(finished,
+                                                    counters.outcome(game))]
+            entities.extend(shards)
+            entities.append((yield stats.add_game_async(game)))
+
+    with profiling.phase('play_game.persist_move'):
+        yield ndb.put_multi_async(entities)
+    raise ndb.Return(game, results, finished, published)
+
+
+def _publish_moves(game, finished, published):
+    """Apply committed moves to the leaderboard and publish their events"""
+    invalidate(game.key)
+    if finished:
+        leaderboard.update(counters.get_users_async(finished).get_result())
+        if game.tournament:
+            # Not transactional: concurrent transactions of play_moves on
+            # this thread would not know which one the task belongs to
+            tournament.enqueue_advance(game.tournament)
+    for seq, move_events in published:
+        events.publish(game.key, seq, move_events)
+
+
+def _new_game(player_1_name, player_2_name):
+    """Check both players and create a Game between them"""
+    # Check player_name
+    if player_1_name == player_2_name:
+        raise endpoints.ConflictException(
+            'Cannot create a game between a player and themselves!')
+    player_names = [player_1_name, player_2_name]
+    if bot.BOT_NAME in player_names:
+        _bot_user()
+    for player_name, user in zip(player_names, get_users(player_names)):
+        if not user:
+            raise endpoints.ConflictException(
+                'No user named {} exists!'.format(player_name))
 
-ROCK = 'rock'
-PAPER = 'paper'
-SCISSORS = 'scissors'
+    game = Game.new_game(player_1_name, player_2_name)
+    game.put()
+    return game
+
+
+@ndb.transactional
+def _insert_user(user):
+    """Put a new User unless one with its name exists, so that two
+    concurrent creates of a name cannot overwrite each other.
+    Returns:
+        False if the name is taken"""
+    if user.key.get():
+        return False
+    user.put()
+    return True
+
+
+def _bot_user():
+    """Return the User of the bot, creating it for its first game. It has
+    no email, so nobody can play for it and it gets no reminders."""
+    return User.get_or_insert(bot.BOT_NAME, name=bot.BOT_NAME, email='',
+                              winning_rate=0, win=0, lose=0, draw=0)
+
+
+def _find_game(urlsafe):
+    """Return the Game of a urlsafe key, raising if there is none. An
+    archived game is rebuilt from its GameSummary."""
+    return _find_game_async(urlsafe).get_result()
+
+
+@ndb.tasklet
+def _find_game_async(urlsafe):
+    game = yield _get_game_async(urlsafe)
+
+    # check game key
+    if not game:
+        raise endpoints.ConflictException('Cannot find game with key {}'.
+                                          format(urlsafe))
+    raise ndb.Return(game)
+
+
+@ndb.tasklet
+def _get_game_async(urlsafe):
+    game = yield get_by_urlsafe_async(urlsafe, Game)
+    if not game:
+        game = yield _archived_game_async(urlsafe)
+    raise ndb.Return(game)
+
+
+def _watch_game(service, urlsafe):
+    """Return the Game of a urlsafe key for get_game and get_game_history,
+    which spectators of a popular game call over and over. Callers are rate
+    limited per user and per game, and the reads of a game running at the
+    same time on this instance share one fetch, so the Game returned must
+    not be modified."""
+    if not ratelimit.allow('user', _caller(service)) or \
+            not ratelimit.allow('game', urlsafe):
+        raise endpoints.ForbiddenException(
+            'Too many requests, please slow down')
+    game = coalesce(get_key(urlsafe, Game),
+                    lambda: _get_game_async(urlsafe).get_result())
+
+    # check game key
+    if not game:
+        raise endpoints.ConflictException('Cannot find game with key {}'.
+                                          format(urlsafe))
+    return game
+
+
+def _caller(service):
+    """Return the email of the oauth user, or else the address of the
+    client, that rate limits apply to"""
+    scope = 'https://www.googleapis.com/auth/userinfo.email'
+    try:
+        return oauth.get_current_user(scope).email()
+    except oauth.Error:
+        request_state = getattr(service, 'request_state', None)
+        return request_state.remote_address if request_state else ''
+
+
+def _archived_game(urlsafe):
+    """Return the read-only Game rebuilt from the GameSummary of an
+    archived game, or None if the game was not archived"""
+    return _archived_game_async(urlsafe).get_result()
+
+
+@ndb.tasklet
+def _archived_game_async(urlsafe):
+    summary = yield GameSummary.key_for(get_key(urlsafe, Game)).get_async()
+    raise ndb.Return(summary.to_game() if summary else None)
+
+
+def _find_user(name, refresh=False):
+    """Return the User of a player name, raising if there is none. With
+    refresh its results include the counter shards not rolled up yet."""
+    return _find_user_async(name, refresh).get_result()
+
+
+@ndb.tasklet
+def _find_user_async(name, refresh=False):
+    if refresh:
+        users = yield counters.get_users_async([name])
+    else:
+        users = yield get_users_async([name])
+    if not users[0]:
+        raise endpoints.ConflictException(
+            'No user named {} exists!'.format(name))
+    raise ndb.Return(users[0])
+
+
+def _queue_user(name):
+    """Return the User of a player name with refreshed results, checking
+    that the oauth user may play for them"""
+    scope = 'https://www.googleapis.com/auth/userinfo.email'
+    oauth_user = oauth.get_current_user(scope)
+    user = _find_user(name, refresh=True)
+    if not user.email == oauth_user.email():
+        raise endpoints.ConflictException(
+            'You are not authorized to play for {}!'.format(name))
+    return user
+
+
+def _play_move(urlsafe, player_name, move):
+    """Check that the oauth user may play for the player and commit the
+    move, then publish its results.
+    Returns:
+        A tuple of the updated Game and the game result message."""
+    return _play_move_async(urlsafe, player_name, move).get_result()
+
+
+@ndb.tasklet
+def _play_move_async(urlsafe, player_name, move):
+    scope = 'https://www.googleapis.com/auth/userinfo.email'
+    oauth_user = oauth.get_current_user(scope)
+
+    # Verify inputs and game state, getting the Game and User in parallel
+    with profiling.phase('play_game.validate'):
+        game, users = yield (_find_game_async(urlsafe),
+                             get_users_async([player_name]))
+        if not game.is_active:
+            raise endpoints.ConflictException('Game has already finished')
+        player = users[0]
+        if not player:
+            raise endpoints.ConflictException(
+                'No user named {} exists!'.format(player_name))
+        if not player.email == oauth_user.email():
+            raise endpoints.ConflictException(
+                'You are not authorized to play for {}!'.format(player_name))
+
+    game, results, finished, published = yield _commit_moves_async(
+        game.key, [(player_name, move)])
+    if isinstance(results[0], endpoints.ConflictException):
+        raise results[0]
+    with profiling.phase('play_game.publish'):
+        _publish_moves(game, finished, published)
+    raise ndb.Return(game, results[0])
+
+
+def _play_moves(moves):
+    """Check and commit a batch of moves with a single oauth check and batch
+    gets of the Games and Users. The moves of each Game are committed
+    together in one transaction, and the transactions run concurrently.
+    Returns:
+        A list with a MoveResultForm for each move."""
+    if len(moves) > MAX_BATCH_MOVES:
+        raise endpoints.BadRequestException(
+            'At most {} moves can be played at once'.format(MAX_BATCH_MOVES))
+    scope = 'https://www.googleapis.com/auth/userinfo.email'
+    email = oauth.get_current_user(scope).email()
+
+    errors = [None] * len(moves)
+    keys = [None] * len(moves)
+    for i, item in enumerate(moves):
+        try:
+            keys[i] = get_key(item.game_key, Game)
+        except (endpoints.BadRequestException, ValueError) as e:
+            errors[i] = str(e)
+
+    game_keys = list(set(key for key in keys if key))
+    game_futures = ndb.get_multi_async(game_keys)
+    names = list(set(item.player_name for item in moves))
+    users = dict(zip(names, get_users(names)))
+    games = dict((key, future.get_result())
+                 for key, future in zip(game_keys, game_futures))
+    missing = [key for key in game_keys if not games[key]]
+    summaries = ndb.get_multi([GameSummary.key_for(key) for key in missing])
+    archived = set(key for key, summary in zip(missing, summaries)
+                   if summary)
+
+    # Verify inputs and game state, then group the moves by Game
+    groups = collections.OrderedDict()
+    for i, item in enumerate(moves):
+        if errors[i]:
+            continue
+        game = games[keys[i]]
+        user = users[item.player_name]
+        if keys[i] in archived:
+            errors[i] = 'Game has already finished'
+        elif not game:
+            errors[i] = 'Cannot find game with key {}'.format(item.game_key)
+        elif not game.is_active:
+            errors[i] = 'Game has already finished'
+        elif not user:
+            errors[i] = 'No user named {} exists!'.format(item.player_name)
+        elif not user.email == email:
+            errors[i] = 'You are not authorized to play for {}!'.format(
+                item.player_name)
+        else:
+            groups.setdefault(keys[i], []).append(i)
+
+    results = [MoveResultForm(game_key=item.game_key,
+                              player_name=item.player_name,
+                              ok=False, message=error)
+               for item, error in zip(moves, errors)]
+    futures = [(indexes, _commit_moves_async(
+        key, [(moves[i].player_name, moves[i].move) for i in indexes]))
+        for key, indexes in groups.items()]
+    for indexes, future in futures:
+        try:
+            game, game_results, finished, published = future.get_result()
+        except datastore_errors.TransactionFailedError:
+            for i in indexes:
+                results[i].message = ('Too many concurrent moves in this '
+                                      'game. Try again.')
+            continue
+        _publish_moves(game, finished, published)
+        for i, game_result in zip(indexes, game_results):
+            if isinstance(game_result, endpoints.ConflictException):
+                results[i].message = str(game_result)
+            else:
+                results[i].ok = True
+                results[i].message = game_result
+    return results
+
+
+def _new_tournament(name, player_names, pairing, rounds):
+    """Check the registered players and create a Tournament"""
+    if pairing not in (tournament.ROUND_ROBIN, tournament.SWISS):
+        raise endpoints.BadRequestException(
+            'pairing must be {} or {}'.format(tournament.ROUND_ROBIN,
+                                              tournament.SWISS))
+    if not 2 <= len(player_names) <= MAX_TOURNAMENT_PLAYERS:
+        raise endpoints.BadRequestException(
+            'A tournament needs between 2 and {} players'.format(
+                MAX_TOURNAMENT_PLAYERS))
+    if len(set(player_names)) != len(player_names):
+        raise endpoints.ConflictException(
+            'A player cannot be registered twice!')
+    for i in range(0, len(player_names), MAX_USERS_PER_GET):
+        names = player_names[i:i + MAX_USERS_PER_GET]
+        for player_name, user in zip(names, get_users(names)):
+            if not user:
+                raise endpoints.ConflictException(
+                    'No user named {} exists!'.format(player_name))
+
+    return tournament.new_tournament(name, player_names, pairing, rounds)
+
+
+def _rankings_page(limit, cursor):
+    """Return a page of leaderboard entries and the next cursor"""
+    if not 0 < limit <= MAX_RANKINGS:
+        raise endpoints.BadRequestException(
+            'limit must be between 1 and {}'.format(MAX_RANKINGS))
+    try:
+        return leaderboard.page(limit, cursor)
+    except ValueError:
+        raise endpoints.BadRequestException('Invalid cursor')
+
+
+def _check_page_size(page_size):
+    if not 0 < page_size <= MAX_PAGE_SIZE:
+        raise endpoints.BadRequestException(
+            'page_size must be between 1 and {}'.format(MAX_PAGE_SIZE))
 
 
 @endpoints.api(name='limitedRockPaperScissors', version='v1')
@@ -44,21 +556,22 @@ class LimitedRPSApi(remote.Service):
                       path='create_user',
                       name='create_user',
                       http_method='POST')
+    @profiling.instrument
     def create_user(self, request):
         """Create a User. Requires a unique username.
         Gets email from oauth account"""
         scope = 'https://www.googleapis.com/auth/userinfo.email'
         oauth_user = oauth.get_current_user(scope)
 
+        user = User(id=request.user_name,
+                    name=request.user_name,
+                    email=oauth_user.email(),
+                    winning_rate=0, win=0, lose=0, draw=0)
         # Check user name
-        if User.query(User.name == request.user_name).get():
+        if request.user_name == bot.BOT_NAME or not _insert_user(user):
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-
-        user = User(name=request.user_name,
-                    email=oauth_user.email(),
-                    winning_rate=0, win=0, lose=0, draw=0)
-        user.put()
+        leaderboard.update([user])
         return StringMessage(message='User {} created!'.format(
             request.user_name))
 
@@ -67,33 +580,10 @@ class LimitedRPSApi(remote.Service):
                       path='create_game',
                       name='create_game',
                       http_method='POST')
+    @profiling.instrument
     def create_game(self, request):
         """Create a Game between two Users"""
-
-        # Check player_name
-        if request.player_1_name == request.player_2_name:
-            raise endpoints.ConflictException(
-                'Cannot create a game between a player and themselves!')
-        for player_name in [request.player_1_name, request.player_2_name]:
-            if not User.query(User.name == player_name).get():
-                raise endpoints.ConflictException(
-                    'No user named {} exists!'.format(player_name))
-
-        game = Game(player_1_name=request.player_1_name,
-                    player_2_name=request.player_2_name,
-                    player_1_rock=3,
-                    player_1_paper=3,
-                    player_1_scissors=3,
-                    player_2_rock=3,
-                    player_2_paper=3,
-                    player_2_scissors=3,
-                    player_1_round_score=0,
-                    player_2_round_score=0,
-                    round=0,
-                    is_active=True,
-                    round_result='Not all players have played yet.')
-
-        game_key = game.put()
+        game = _new_game(request.player_1_name, request.player_2_name)
 
         return StringMessage(message='Game created! '
                                      '{}\'s cards remain '
@@ -110,22 +600,17 @@ class LimitedRPSApi(remote.Service):
                                                        game.player_2_paper,
                                                        game.player_2_scissors,
                                                        game.round,
-                                                       game_key.urlsafe()))
+                                                       game.key.urlsafe()))
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='get_game',
                       name='get_game',
                       http_method='GET')
+    @profiling.instrument
     def get_game(self, request):
         """Get a Game from its websafe key"""
-
-        game = get_by_urlsafe(request.game_key, Game)
-
-        # check game key
-        if not game:
-            raise endpoints.ConflictException('Cannot find game with key {}'.
-                                              format(request.game_key))
+        game = _watch_game(self, request.game_key)
 
         return StringMessage(message='Found game between {} and {}. '
                                      '(key={}) '
@@ -152,213 +637,11 @@ class LimitedRPSApi(remote.Service):
                       path='play_game',
                       name='play_game',
                       http_method='POST')
+    @profiling.instrument
     def play_game(self, request):
         """Play move in a Game."""
-        scope = 'https://www.googleapis.com/auth/userinfo.email'
-        oauth_user = oauth.get_current_user(scope)
-
-        # Verify inputs and game state
-        game = get_by_urlsafe(request.game_key, Game)
-        game.round_result = None
-        if not game:
-            raise endpoints.ConflictException('Cannot find game with key {}'.
-                                              format(request.game_key))
-        if not game.is_active:
-            raise endpoints.ConflictException('Game has already finished')
-
-        player = User.query(User.name == request.player_name).get()
-        if not player:
-            raise endpoints.ConflictException(
-                'No user named {} exists!'.format(request.player_name))
-
-        if not player.email == oauth_user.email():
-            raise endpoints.ConflictException(
-                'You are not authorized to play for {}!'.format(
-                    request.player_name))
-
-        # Save single player's move. Players can choose
-        # rock, paper or scissors from the cards remaining.
-        if game.player_1_name == request.player_name:
-            if game.player_1_move is None:
-                if request.move == ROCK:
-                    if game.player_1_rock < 1:
-                        raise endpoints.ConflictException(
-                            '{}\'s rock card does not remain. '
-                            'Choose another type of card.'.format(
-                                request.player_name))
-                    else:
-                        game.player_1_move = request.move
-                        game.player_1_rock -= 1
-                elif request.move == PAPER:
-                    if game.player_1_paper < 1:
-                        raise endpoints.ConflictException(
-                            '{}\'s paper card does not remain. '
-                            'Choose another type of card.'.format(
-                                request.player_name))
-                    else:
-                        game.player_1_move = request.move
-                        game.player_1_paper -= 1
-                elif request.move == SCISSORS:
-                    if game.player_1_scissors < 1:
-                        raise endpoints.ConflictException(
-                            '{}\'s scissors card does not remain. '
-                            'Choose another type of card.'.format(
-                                request.player_name))
-                    else:
-                        game.player_1_move = request.move
-                        game.player_1_scissors -= 1
-                else:
-                    raise endpoints.ConflictException(
-                        '{} chose a card we don\'t know about. You have to '
-                        'choose rock, paper or scissors. Try to choose a '
-                        'card again.'.format(request.player_name))
-            else:
-                raise endpoints.ConflictException(
-                    '{} already used a {} card. '
-                    'Please wait to {}\'s move.'.format(
-                        request.player_name,
-                        game.player_1_move,
-                        game.player_2_name))
-        elif game.player_2_name == request.player_name:
-            if game.player_2_move is None:
-                if request.move == ROCK:
-                    if game.player_2_rock < 1:
-                        raise endpoints.ConflictException(
-                            '{}\'s rock card does not remain. '
-                            'Choose another type of card.'.format(
-                                request.player_name))
-                    else:
-                        game.player_2_move = request.move
-                        game.player_2_rock -= 1
-                elif request.move == PAPER:
-                    if game.player_2_paper < 1:
-                        raise endpoints.ConflictException(
-                            '{}\'s paper card does not remain. '
-                            'Choose another type of card.'.format(
-                                request.player_name))
-                    else:
-                        game.player_2_move = request.move
-                        game.player_2_paper -= 1
-                elif request.move == SCISSORS:
-                    if game.player_2_scissors < 1:
-                        raise endpoints.ConflictException(
-                            '{}\'s scissors card does not remain. '
-                            'Choose another type of card.'.format(
-                                request.player_name))
-                    else:
-                        game.player_2_move = request.move
-                        game.player_2_scissors -= 1
-                else:
-                    raise endpoints.ConflictException(
-                        '{} chose a card we don\'t know about. You have to '
-                        'choose rock, paper or scissors. Try to choose a '
-                        'card again.'.format(request.player_name))
-            else:
-                raise endpoints.ConflictException(
-                    '{} already used a {} card. '
-                    'Please wait to {}\'s move.'.format(
-                        request.player_name,
-                        game.player_2_move,
-                        game.player_1_name))
-        game.put()
-
-        # Evaluate result and update Game if game has finished
-        if game.player_1_move is not None \
-                and game.player_2_move is not None:
-            if game.player_1_move == ROCK:
-                if game.player_2_move == ROCK:
-                    game_winner = 0                 # draw
-                elif game.player_2_move == PAPER:
-                    game_winner = 2                 # winner is player_2
-                else:
-                    game_winner = 1                 # winner is player_1
-            elif game.player_1_move == PAPER:
-                if game.player_2_move == ROCK:
-                    game_winner = 1
-                elif game.player_2_move == PAPER:
-                    game_winner = 0
-                else:
-                    game_winner = 2
-            else:
-                if game.player_2_move == ROCK:
-                    game_winner = 2
-                elif game.player_2_move == PAPER:
-                    game_winner = 1
-                else:
-                    game_winner = 0
-            if game_winner == 1:
-                game.round_result = ('Round result: Winner:{}, Loser:{}.'.
-                                     format(game.player_1_name,
-                                            game.player_2_name))
-                game.player_1_round_score += 1
-            elif game_winner == 2:
-                game.round_result = ('Round result: Winner:{}, Loser:{}.'.
-                                     format(game.player_2_name,
-                                            game.player_1_name))
-                game.player_2_round_score += 1
-            else:
-                game.round_result = 'Round result: Draw.'
-
-            game.round += 1
-
-            # record player's move history to PlayerMoves()
-            move = PlayerMoves(parent=game.key,
-                               player_1_move=game.player_1_move,
-                               player_2_move=game.player_2_move,
-                               round=game.round)
-            move.put()
-
-            game.player_1_move = None
-            game.player_2_move = None
-            game.put()
-
-        # Update Game and Users if game has finished
-        if (game.round > 8) or (game.player_1_round_score > 4) \
-                or (game.player_2_round_score > 4):
-            game.is_active = False
-            game.put()
-
-            # record user score to UserScores()
-            player_1_score = UserScores(parent=game.key,
-                                        player=game.player_1_name,
-                                        score=game.player_1_round_score)
-            player_2_score = UserScores(parent=game.key,
-                                        player=game.player_2_name,
-                                        score=game.player_2_round_score)
-            player_1_score.put()
-            player_2_score.put()
-
-            if game.player_1_round_score != game.player_2_round_score:
-                # if not draw
-                if game.player_1_round_score > game.player_2_round_score:
-                    winner_name = game.player_1_name
-                    loser_name = game.player_2_name
-                else:
-                    winner_name = game.player_2_name
-                    loser_name = game.player_1_name
-                winner = User.query(User.name == winner_name).get()
-                loser = User.query(User.name == loser_name).get()
-                winner.win += 1
-                winner.winning_rate = winner.win/(winner.win+winner.lose+winner.draw)
-                loser.lose += 1
-                loser.winning_rate = loser.win/(loser.win+loser.lose+loser.draw)
-                winner.put()
-                loser.put()
-                game_result = ('Game finished. Game result '
-                               'Winner:{}, Loser:{}.'.format(
-                                winner_name, loser_name))
-            else: # if draw
-                draw1 = User.query(User.name == game.player_1_name).get()
-                draw2 = User.query(User.name == game.player_2_name).get()
-                draw1.draw += 1
-                draw1.winning_rate = draw1.win/(draw1.win+draw1.lose+draw1.draw)
-                draw2.draw += 1
-                draw2.winning_rate = draw2.win/(draw2.win+draw2.lose+draw2.draw)
-                draw1.put()
-                draw2.put()
-                game_result = 'Game finished. Game result is Draw.'
-        else:
-            game_result = 'Game still in progress.'
+        game, game_result = _play_move(request.game_key, request.player_name,
+                                       request.move)
 
         return StringMessage(message='{} played {}\'s card in this round. '
                                      '(key={}) '
@@ -388,104 +671,340 @@ class LimitedRPSApi(remote.Service):
                       path='get_user_games',
                       name='get_user_games',
                       http_method='GET')
+    @profiling.instrument
     def get_user_games(self, request):
-        """Get all active Games for a User"""
+        """Get a page of active Games for a User"""
+        _check_page_size(request.page_size)
+        cursor = get_cursor(request.cursor)
+
+        # Fetch the page while the user name is checked
+        users = get_users_async([request.player_name])
+        page = Game.query(
+            Game.players == request.player_name,
+            Game.is_active == True).order(Game.key).fetch_page_async(
+                request.page_size, start_cursor=cursor, keys_only=True)
 
         # check user name
-        if not User.query(User.name == request.player_name).get():
+        if not users.get_result()[0]:
             raise endpoints.ConflictException(
                 'No user named {} exists!'.format(request.player_name))
         else:
-            games = Game.query(ndb.AND(Game.is_active == True,
-                                       ndb.OR(Game.player_1_name ==
-                                              request.player_name,
-                                              Game.player_2_name ==
-                                              request.player_name))).fetch()
-            return StringMessages(message=[game.key.urlsafe()
-                                           for game in games])
+            keys, next_cursor, more = page.get_result()
+            return StringMessages(message=[key.urlsafe() for key in keys],
+                                  cursor=next_cursor.urlsafe()
+                                  if more and next_cursor else None)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='cancel_game',
                       name='cancel_game',
                       http_method='POST')
+    @profiling.instrument
     def cancel_game(self, request):
         """Cancel an active game"""
 
-        game = get_by_urlsafe(request.game_key, Game)
+        game, cancelled = movelog.cancel(get_key(request.game_key, Game))
+        if not game:
+            game = _archived_game(request.game_key)
 
         # check game key
         if not game:
             raise endpoints.ConflictException('Cannot find game (key={})'.
                                               format(request.game_key))
-        if not game.is_active:
+        if not cancelled:
             raise endpoints.ConflictException('This game is already finished')
 
-        game.round = 9
-        game.is_active = False
-        game.put()
+        invalidate(game.key)
+        if game.tournament:
+            tournament.enqueue_advance(game.tournament)
+        events.publish(game.key, events.game_seq(game),
+                       [(events.CANCELLED, 'Game cancelled.')])
 
         return StringMessage(message='Game {} cancelled'.
                              format(request.game_key))
 
-    @endpoints.method(request_message=message_types.VoidMessage,
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=StringMessage,
+                      path='join_queue',
+                      name='join_queue',
+                      http_method='POST')
+    @profiling.instrument
+    def join_queue(self, request):
+        """Wait for an opponent with a similar winning rate. The Game is
+        created automatically and listed by get_user_games."""
+        user = _queue_user(request.user_name)
+        if not matchmaking.join(user):
+            raise endpoints.ConflictException(
+                '{} is already waiting for an opponent'.format(user.name))
+        return StringMessage(message='{} is waiting for an opponent'.
+                             format(user.name))
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=StringMessage,
+                      path='leave_queue',
+                      name='leave_queue',
+                      http_method='POST')
+    @profiling.instrument
+    def leave_queue(self, request):
+        """Stop waiting for an opponent"""
+        user = _queue_user(request.user_name)
+        if not matchmaking.leave(user.name):
+            raise endpoints.ConflictException(
+                '{} is not waiting for an opponent'.format(user.name))
+        return StringMessage(message='{} stopped waiting for an opponent'.
+                             format(user.name))
+
+    @endpoints.method(request_message=WAIT_GAME_EVENTS_REQUEST,
+                      response_message=GameEventForms,
+                      path='wait_game_events',
+                      name='wait_game_events',
+                      http_method='GET')
+    @profiling.instrument
+    def wait_game_events(self, request):
+        """Wait for changes to a Game newer than seq since"""
+        game_key = get_key(request.game_key, Game)
+        found = events.wait(game_key, request.since)
+
+        return GameEventForms(
+            events=[GameEventForm(seq=seq, kind=kind, message=message)
+                    for seq, kind, message in found],
+            seq=found[-1][0] if found else request.since)
+
+    @endpoints.method(request_message=GET_RANKINGS_REQUEST,
                       response_message=StringMessages,
                       path='get_user_rankings',
                       name='get_user_rankings',
                       http_method='POST')
+    @profiling.instrument
     def get_user_rankings(self, request):
-        """Return list of Users in descending order of winning rate"""
-        users = User.query().order(-User.winning_rate).fetch()
+        """Return a page of Users in descending order of winning rate"""
+        entries, cursor = _rankings_page(request.limit, request.cursor)
 
         return StringMessages(message=['{} (Winning rate:{}, '
                                        'win:{}, lose:{}, draw:{})'.
-                              format(user.name, user.winning_rate, user.win,
-                                     user.lose, user.draw) for user in users])
+                              format(name, winning_rate, win, lose, draw)
+                              for winning_rate, name, win, lose, draw
+                              in entries],
+                              cursor=cursor)
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=StringMessage,
+                      path='get_user_rank',
+                      name='get_user_rank',
+                      http_method='GET')
+    @profiling.instrument
+    def get_user_rank(self, request):
+        """Return the rank of a single User by winning rate"""
+        user = _find_user(request.user_name, refresh=True)
+
+        return StringMessage(message='{} is ranked {} (Winning rate:{}, '
+                                     'win:{}, lose:{}, draw:{})'.
+                             format(user.name, leaderboard.rank(user),
+                                    user.winning_rate, user.win, user.lose,
+                                    user.draw))
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessages,
                       path='get_game_history',
                       name='get_game_history',
                       http_method='GET')
+    @profiling.instrument
     def get_game_history(self, request):
         """Return list of moves play in Game"""
 
-        game = get_by_urlsafe(request.game_key, Game)
-        # check game key
-        if not game:
-            raise endpoints.ConflictException('Cannot find game (key={})'.
-                                              format(request.game_key))
-
-        moves = PlayerMoves.query(ancestor=game.key).order(PlayerMoves.round)
+        game = _watch_game(self, request.game_key)
 
         return StringMessages(message=[
-            'Round {}, {}:{}, {}:{}.'.format(move.round,
+            'Round {}, {}:{}, {}:{}.'.format(i + 1,
                                              game.player_1_name,
-                                             move.player_1_move,
+                                             player_1_move,
                                              game.player_2_name,
-                                             move.player_2_move
-                                             ) for move in moves])
+                                             player_2_move)
+            for i, (player_1_move, player_2_move)
+            in enumerate(game.get_history())])
 
     @endpoints.method(request_message=GET_USER_GAME_REQUEST,
                       response_message=StringMessages,
                       path='get_high_scores',
                       name='get_high_scores',
                       http_method='GET')
+    @profiling.instrument
     def get_high_scores(self, request):
-        """Return list of high scores of the player """
+        """Return a page of high scores of the player """
+        _check_page_size(request.page_size)
+        cursor = get_cursor(request.cursor)
 
-        scores = UserScores.query(UserScores.player ==
-                                  request.player_name).\
-            order(UserScores.score).fetch()
+        scores, next_cursor, more = UserScores.query(
+            UserScores.player == request.player_name).\
+            order(UserScores.score).fetch_page(
+                request.page_size, start_cursor=cursor,
+                projection=[UserScores.score])
 
         # check user played games
-        if not scores:
+        if not scores and not cursor:
             raise endpoints.ConflictException(
                 '{} have not finished game yet.'.format(request.player_name))
         else:
             return StringMessages(message=['Win {} rounds in game (key={})'.
                                   format(score.score,
                                          score.key.parent().urlsafe())
-                                           for score in scores])
+                                           for score in scores],
+                                  cursor=next_cursor.urlsafe()
+                                  if more and next_cursor else None)
+
+
+
+@endpoints.api(name='limitedRockPaperScissors', version='v2')
+class LimitedRPSApiV2(remote.Service):
+    """Game API returning structured messages instead of text. Endpoints
+    that only confirm an action or list keys are served by v1."""
+    @endpoints.method(request_message=CREATE_GAME_REQUEST,
+                      response_message=GameForm,
+                      path='create_game',
+                      name='create_game',
+                      http_method='POST')
+    @profiling.instrument
+    def create_game(self, request):
+        """Create a Game between two Users"""
+        return _new_game(request.player_1_name,
+                         request.player_2_name).to_form()
+
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=GameForm,
+                      path='get_game',
+                      name='get_game',
+                      http_method='GET')
+    @profiling.instrument
+    def get_game(self, request):
+        """Get a Game from its websafe key"""
+        return _watch_game(self, request.game_key).to_form()
+
+    @endpoints.method(request_message=PLAY_GAME_REQUEST,
+                      response_message=GameForm,
+                      path='play_game',
+                      name='play_game',
+                      http_method='POST')
+    @profiling.instrument
+    def play_game(self, request):
+        """Play move in a Game."""
+        game, game_result = _play_move(request.game_key, request.player_name,
+                                       request.move)
+        return game.to_form(game_result)
+
+    @endpoints.method(request_message=REPLAY_GAME_REQUEST,
+                      response_message=GameForm,
+                      path='replay_game',
+                      name='replay_game',
+                      http_method='GET')
+    @profiling.instrument
+    def replay_game(self, request):
+        """Rebuild a Game as it was after a round from its move log"""
+        game = _find_game(request.game_key)
+        if request.round is not None and \
+                not 0 <= request.round <= engine.ROUNDS:
+            raise endpoints.BadRequestException(
+                'round must be between 0 and {}'.format(engine.ROUNDS))
+        try:
+            if not movelog.is_logged(game):
+                raise movelog.IncompleteLog(game.key)
+            state, moves, cancelled = movelog.replay(game.key, request.round)
+        except movelog.IncompleteLog:
+            raise endpoints.ConflictException(
+                'The moves of this game were not logged')
+
+        replayed = Game.new_game(game.player_1_name, game.player_2_name,
+                                 id=game.key.id())
+        replayed.apply_state(state)
+        replayed.history = pack_history(moves)
+        replayed.is_active = not (cancelled or engine.is_finished(state))
+        replayed.round_result = None
+        return replayed.to_form()
+
+    @endpoints.method(request_message=MoveForms,
+                      response_message=MoveResultForms,
+                      path='play_moves',
+                      name='play_moves',
+                      http_method='POST')
+    @profiling.instrument
+    def play_moves(self, request):
+        """Play a batch of moves, in one or many Games, for players of the
+        current user. Meant for bots and tournament runners."""
+        return MoveResultForms(results=_play_moves(request.moves))
+
+    @endpoints.method(request_message=CREATE_TOURNAMENT_REQUEST,
+                      response_message=TournamentForm,
+                      path='create_tournament',
+                      name='create_tournament',
+                      http_method='POST')
+    @profiling.instrument
+    def create_tournament(self, request):
+        """Create a round robin or swiss Tournament between Users and the
+        Games of its first round"""
+        return _new_tournament(request.name, list(request.player_names),
+                               request.pairing, request.rounds).to_form()
+
+    @endpoints.method(request_message=GET_TOURNAMENT_REQUEST,
+                      response_message=TournamentForm,
+                      path='get_tournament',
+                      name='get_tournament',
+                      http_method='GET')
+    @profiling.instrument
+    def get_tournament(self, request):
+        """Get a Tournament and its standings from its websafe key"""
+        found = get_by_urlsafe(request.tournament_key, Tournament)
+        if not found:
+            raise endpoints.ConflictException(
+                'Cannot find tournament with key {}'.format(
+                    request.tournament_key))
+        return found.to_form(tournament.results(found)[0])
 
-api = endpoints.api_server([LimitedRPSApi])
+    @endpoints.method(request_message=GET_RANKINGS_REQUEST,
+                      response_message=UserRankForms,
+                      path='get_user_rankings',
+                      name='get_user_rankings',
+                      http_method='POST')
+    @profiling.instrument
+    def get_user_rankings(self, request):
+        """Return a page of Users in descending order of winning rate"""
+        entries, cursor = _rankings_page(request.limit, request.cursor)
+        return UserRankForms(
+            users=[UserRankForm(name=name, winning_rate=winning_rate,
+                                win=win, lose=lose, draw=draw)
+                   for winning_rate, name, win, lose, draw in entries],
+            cursor=cursor)
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=UserRankForm,
+                      path='get_user_rank',
+                      name='get_user_rank',
+                      http_method='GET')
+    @profiling.instrument
+    def get_user_rank(self, request):
+        """Return the rank of a single User by winning rate"""
+        user = _find_user(request.user_name, refresh=True)
+        return user.to_form(leaderboard.rank(user))
+
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=HistoryForm,
+                      path='get_game_history',
+                      name='get_game_history',
+                      http_method='GET')
+    @profiling.instrument
+    def get_game_history(self, request):
+        """Return list of moves play in Game"""
+        return _watch_game(self, request.game_key).to_history_form()
+
+    @endpoints.method(response_message=StatsForm,
+                      path='get_stats',
+                      name='get_stats',
+                      http_method='GET')
+    @profiling.instrument
+    def get_stats(self, request):
+        """Return global game statistics, updated as games finish"""
+        snapshot = stats.get()
+        if not snapshot:
+            raise endpoints.NotFoundException(
+                'Statistics have not been computed yet')
+        return snapshot.to_form()
+
+api = endpoints.api_server([LimitedRPSApi, LimitedRPSApiV2])
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""bench_engine.py - Micro-benchmark of the game rules in engine.py, without
+App Engine. Times a move and a round played through apply_move and
+resolve_round, and whole games simulated with play_decks when numpy is
+installed.
+
+Usage:
+    python bench_engine.py [--games 100000] [--repeat 5]"""
+
+import argparse
+import timeit
+
+import engine
+
+SETUP = 'import engine'
+ROUND = '''
+state = engine.GameState()
+engine.apply_move(state, 0, 'rock')
+engine.apply_move(state, 1, 'paper')
+engine.resolve_round(state)
+engine.is_finished(state)
+'''
+
+
+def best(statement, setup, number, repeat):
+    """Return the best time of one run of statement in seconds"""
+    return min(timeit.repeat(statement, setup, number=number,
+                             repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', type=int, default=100000,
+                        help='Games simulated per play_decks call')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    seconds = best(ROUND, SETUP, 100000, args.repeat)
+    print('round (2 moves, resolve, check): {:.2f} us'.format(seconds * 1e6))
+    if engine.numpy is None:
+        print('play_decks: skipped, numpy is not installed')
+        return
+    decks = ('decks_1 = engine.random_decks({0}); '
+             'decks_2 = engine.random_decks({0})'.format(args.games))
+    seconds = best('engine.play_decks(decks_1, decks_2)',
+                   SETUP + '; ' + decks, 1, args.repeat)
+    print('play_decks: {:.0f} games/s ({:.2f} us per game)'.format(
+        args.games / seconds, seconds / args.games * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""bot.py - The built-in opponent of single player games.
+The bot plays a minimax (Nash equilibrium) mixed strategy of the zero-sum
+game in which a win is worth 1, a draw 0 and a loss -1. The strategy of
+every state is precomputed offline by solve_bot.py into bot_table.bin and
+loaded once per instance, so choosing a move is a table lookup. Like the
+engine, this module is pure Python with no App Engine dependencies."""
+
+import array
+import os
+import random
+
+import engine
+
+BOT_NAME = 'computer'  # Reserved user name of the bot
+TABLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'bot_table.bin')
+SCORES = engine.WINNING_SCORE  # Scores of states the game is still on
+STATES = 64 * 64 * SCORES * SCORES
+SCALE = 255  # Probabilities are stored in units of 1 / SCALE
+
+
+def state_index(cards, opponent_cards, score, opponent_score):
+    """Return the table index of a state before a round, seen from the
+    player with cards and score. Each hand of cards is a list of the
+    number of rock, paper and scissors cards left."""
+    hands = (cards[0] * 16 + cards[1] * 4 + cards[2]) * 64 + \
+        opponent_cards[0] * 16 + opponent_cards[1] * 4 + opponent_cards[2]
+    return (hands * SCORES + score) * SCORES + opponent_score
+
+
+def load_table(path=TABLE_FILE):
+    """Return the strategy table: for each state index, the probabilities
+    of rock and paper at 2 * index and 2 * index + 1, in units of 1/SCALE.
+    Scissors gets the rest."""
+    table = array.array('B')
+    with open(path, 'rb') as table_file:
+        table.fromstring(table_file.read())
+    if len(table) != 2 * STATES:
+        raise ValueError('{} does not hold {} states'.format(path, STATES))
+    return table
+
+
+_table = load_table() if os.path.exists(TABLE_FILE) else None
+
+
+def strategy(cards, opponent_cards, score, opponent_score):
+    """Return the probabilities of playing rock, paper and scissors"""
+    index = 2 * state_index(cards, opponent_cards, score, opponent_score)
+    rock, paper = _table[index], _table[index + 1]
+    return [float(rock) / SCALE, float(paper) / SCALE,
+            float(SCALE - rock - paper) / SCALE]
+
+
+def choose_move(state, player, rand=random):
+    """Choose the bot's move for the current round of an engine.GameState.
+    A move the opponent has already played this round is not looked at.
+    Args:
+        state: The GameState
+        player: The bot's player number, 0 or 1
+        rand: The random.Random used to draw the move
+    Returns:
+        rock, paper or scissors"""
+    opponent = 1 - player
+    opponent_cards = list(state.cards[opponent])
+    if state.moves[opponent] is not None:
+        opponent_cards[state.moves[opponent]] += 1
+    probabilities = strategy(state.cards[player], opponent_cards,
+                             state.scores[player], state.scores[opponent])
+    draw = rand.random()
+    for move, probability in enumerate(probabilities):
+        # Never draw a card that is not left, even after rounding
+        if state.cards[player][move]:
+            if draw < probability:
+                return engine.MOVES[move]
+            draw -= probability
+    return engine.MOVES[max(range(len(engine.MOVES)),
+                            key=lambda move: state.cards[player][move])]
@@ -0,0 +1,123 @@
+"""counters.py - Sharded counters of the games each User won, lost or drew.
+Finishing a game adds one to a randomly chosen UserStatsShard of each player
+inside the game's transaction, so that a player finishing many games at once
+does not contend on a single entity group. A periodic rollup adds the shards
+into the User's win/lose/draw/winning_rate, which ordered queries use, and
+deletes them. The current results of a User are its properties plus the
+shards that have not been rolled up yet."""
+
+import random
+
+from google.appengine.ext import ndb
+
+import engine
+from models import User, UserStatsShard
+
+SHARDS = 5  # Number of counter shards per User
+WIN = 'win'
+LOSE = 'lose'
+DRAW = 'draw'
+
+
+def shard_keys(name):
+    """Return the keys of every counter shard of a User"""
+    return [ndb.Key(UserStatsShard, '{}-{}'.format(name, i))
+            for i in range(SHARDS)]
+
+
+def outcome(game):
+    """Return the results (WIN, LOSE or DRAW) of player_1 and player_2 in a
+    Game that is over, or None if it was cancelled before the end, which
+    counts for neither player"""
+    state = game.to_state()
+    if max(state.scores) < engine.WINNING_SCORE and \
+            any(state.cards[0] + state.cards[1]):
+        return None
+    if state.scores[0] > state.scores[1]:
+        return (WIN, LOSE)
+    elif state.scores[0] < state.scores[1]:
+        return (LOSE, WIN)
+    return (DRAW, DRAW)
+
+
+def winning_rate(user):
+    """Return the rate of games won per finished games"""
+    finished = user.win + user.lose + user.draw
+    return float(user.win) / finished if finished else 0.0
+
+
+@ndb.tasklet
+def increment_async(name, result):
+    """Add one to the win, lose or draw count of a User on a random shard.
+    Call inside the transaction that finishes the game.
+    Returns:
+        The changed UserStatsShard, for the caller to put with the game."""
+    key = random.choice(shard_keys(name))
+    shard = yield key.get_async()
+    if not shard:
+        shard = UserStatsShard(key=key, win=0, lose=0, draw=0)
+    setattr(shard, result, getattr(shard, result) + 1)
+    raise ndb.Return(shard)
+
+
+def refresh(users):
+    """Return copies of User entities with the results that have not been
+    rolled up yet added and their winning_rate recomputed. The Users
+    themselves are left untouched, as ndb's in-context cache hands the same
+    objects to every later get of the request. Nothing is written."""
+    shards = ndb.get_multi([key for user in users
+                            for key in shard_keys(user.name)])
+    return [_refreshed(user, shards[i * SHARDS:(i + 1) * SHARDS])
+            for i, user in enumerate(users)]
+
+
+@ndb.tasklet
+def get_users_async(names):
+    """Get the Users of player names and their counter shards in a single
+    batch, and return refreshed copies of the Users as refresh() does.
+    Returns:
+        A Future of the list of Users, with None for each unknown name"""
+    keys = [ndb.Key(User, name) for name in names]
+    entities = yield ndb.get_multi_async(
+        keys + [key for name in names for key in shard_keys(name)])
+    users = []
+    for i, user in enumerate(entities[:len(names)]):
+        start = len(names) + i * SHARDS
+        users.append(user and _refreshed(user, entities[start:start + SHARDS]))
+    raise ndb.Return(users)
+
+
+def _refreshed(user, shards):
+    copy = User(key=user.key, **user.to_dict())
+    _add_shards(copy, shards)
+    return copy
+
+
+def _add_shards(user, shards):
+    for shard in shards:
+        if shard:
+            user.win += shard.win
+            user.lose += shard.lose
+            user.draw += shard.draw
+    user.winning_rate = winning_rate(user)
+
+
+def shard_name(shard_key):
+    """Return the name of the User a shard key belongs to"""
+    return shard_key.id().rsplit('-', 1)[0]
+
+
+@ndb.transactional_tasklet(xg=True)
+def rollup_async(name):
+    """Add the shards of a User into its properties and delete them"""
+    keys = shard_keys(name)
+    entities = yield ndb.get_multi_async([ndb.Key(User, name)] + keys)
+    user = entities[0]
+    shards = [shard for shard in entities[1:] if shard]
+    if not shards:
+        return
+    futures = [ndb.delete_multi_async([shard.key for shard in shards])]
+    if user:  # Shards of a deleted User are just dropped
+        _add_shards(user, shards)
+        futures.append(user.put_async())
+    yield futures
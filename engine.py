@@ -0,0 +1,137 @@
+"""engine.py - Rules of Limited Rock Paper Scissors.
+This module is pure Python with no App Engine dependencies, so the rules can
+be unit tested and benchmarked on their own and reused for bulk simulation.
+Players are numbered 0 (player_1) and 1 (player_2) and moves are indexes
+into MOVES."""
+
+try:
+    import numpy
+except ImportError:  # numpy is only needed for the vectorized simulation
+    numpy = None
+
+ROCK = 'rock'
+PAPER = 'paper'
+SCISSORS = 'scissors'
+MOVES = [ROCK, PAPER, SCISSORS]
+MOVE_INDEX = dict((move, i) for i, move in enumerate(MOVES))
+
+CARDS = 3  # Number of cards of each type a player starts with
+ROUNDS = 9  # Maximum number of rounds in a game
+WINNING_SCORE = 5  # Number of round wins that finishes a game
+
+DRAW = 0
+PLAYER_1_WINS = 1
+PLAYER_2_WINS = 2
+
+# OUTCOME[player_1_move][player_2_move] is the winner of the round
+OUTCOME = [[DRAW, PLAYER_2_WINS, PLAYER_1_WINS],   # rock
+           [PLAYER_1_WINS, DRAW, PLAYER_2_WINS],   # paper
+           [PLAYER_2_WINS, PLAYER_1_WINS, DRAW]]   # scissors
+
+
+class IllegalMove(ValueError):
+    """A move the rules do not allow"""
+    def __init__(self, move):
+        super(IllegalMove, self).__init__(move)
+        self.move = move
+
+
+class UnknownCard(IllegalMove):
+    """The move is not rock, paper or scissors"""
+
+
+class NoCardLeft(IllegalMove):
+    """The player has no card of that type left"""
+
+
+class AlreadyMoved(IllegalMove):
+    """The player has already played a card this round. move is that card"""
+
+
+class GameState(object):
+    """State of one game.
+    cards[player][move] is the number of cards of each type remaining,
+    moves[player] is the move index played this round or None,
+    scores[player] is the number of rounds won and round the number of
+    rounds played."""
+    __slots__ = ('cards', 'moves', 'scores', 'round')
+
+    def __init__(self, cards=None, moves=None, scores=None, round=0):
+        self.cards = cards or [[CARDS] * 3, [CARDS] * 3]
+        self.moves = moves or [None, None]
+        self.scores = scores or [0, 0]
+        self.round = round
+
+
+def apply_move(state, player, move):
+    """Play a card for player this round.
+    Args:
+        state: The GameState
+        player: 0 or 1
+        move: rock, paper or scissors
+    Raises:
+        UnknownCard, NoCardLeft or AlreadyMoved"""
+    if state.moves[player] is not None:
+        raise AlreadyMoved(MOVES[state.moves[player]])
+    index = MOVE_INDEX.get(move)
+    if index is None:
+        raise UnknownCard(move)
+    if state.cards[player][index] < 1:
+        raise NoCardLeft(move)
+    state.cards[player][index] -= 1
+    state.moves[player] = index
+
+
+def resolve_round(state):
+    """Score the round once both players have played.
+    Returns:
+        DRAW, PLAYER_1_WINS or PLAYER_2_WINS, or None if a player has not
+        played yet."""
+    move_1, move_2 = state.moves
+    if move_1 is None or move_2 is None:
+        return None
+    winner = OUTCOME[move_1][move_2]
+    if winner != DRAW:
+        state.scores[winner - 1] += 1
+    state.round += 1
+    state.moves = [None, None]
+    return winner
+
+
+def is_finished(state):
+    """True when all rounds are played or a player has won enough rounds"""
+    return (state.round >= ROUNDS or
+            max(state.scores) >= WINNING_SCORE)
+
+
+def play_decks(decks_1, decks_2):
+    """Vectorized simulation of many complete games with numpy.
+    Each game is described by the order in which each player plays their
+    nine cards, so uniformly random play is a random permutation of a deck.
+    Args:
+        decks_1: (games, 9) integer array of player_1's move indexes
+        decks_2: (games, 9) integer array of player_2's move indexes
+    Returns:
+        A tuple of arrays (scores_1, scores_2, rounds) with the final round
+        scores and number of rounds played in each game."""
+    if numpy is None:
+        raise RuntimeError('play_decks requires numpy')
+    outcome = numpy.asarray(OUTCOME)[numpy.asarray(decks_1),
+                                     numpy.asarray(decks_2)]
+    wins_1 = numpy.cumsum(outcome == PLAYER_1_WINS, axis=1)
+    wins_2 = numpy.cumsum(outcome == PLAYER_2_WINS, axis=1)
+    over = (wins_1 >= WINNING_SCORE) | (wins_2 >= WINNING_SCORE)
+    over[:, -1] = True
+    last = numpy.argmax(over, axis=1)
+    games = numpy.arange(outcome.shape[0])
+    return wins_1[games, last], wins_2[games, last], last + 1
+
+
+def random_decks(games, random_state=None):
+    """Return a (games, 9) array of uniformly shuffled decks for play_decks"""
+    if numpy is None:
+        raise RuntimeError('random_decks requires numpy')
+    random_state = random_state or numpy.random
+    deck = numpy.repeat(numpy.arange(len(MOVES)), CARDS)
+    keys = random_state.random_sample((games, deck.size))
+    return deck[numpy.argsort(keys, axis=1)]
@@ -0,0 +1,106 @@
+"""events.py - Game state changes published to clients waiting on a game.
+play_game and cancel_game publish events after their commit, and clients
+long-poll for them instead of repeatedly calling get_game. Events are
+numbered with the game's sequence number (see game_seq), so a client only
+has to remember the last number it has seen."""
+
+import threading
+import time
+
+from google.appengine.api import memcache
+
+MOVED = 'moved'  # A player has played a card
+ROUND = 'round'  # Both players have played and the round was scored
+FINISHED = 'finished'  # The game has finished
+CANCELLED = 'cancelled'  # The game was cancelled
+
+KEEP_EVENTS = 20  # Number of most recent events kept per game
+WAIT_TIMEOUT = 20  # Seconds a subscriber waits before an empty answer
+
+
+def game_seq(game):
+    """Return the sequence number of a game's current state. Every move and
+    the cancellation of a game increase it."""
+    return 2 * game.round + (game.player_1_move is not None) + \
+        (game.player_2_move is not None)
+
+
+class MemcacheBroker(object):
+    """Keeps the recent events of each game in memcache, so that events
+    published on one instance are seen by subscribers on every other."""
+    EVENT_KEY = 'events:{}'
+    EVENT_TIMEOUT = 60 * 60
+    POLL_INTERVAL = 0.5
+    CAS_RETRIES = 10
+
+    def publish(self, game_key, seq, events):
+        client = memcache.Client()
+        key = self.EVENT_KEY.format(game_key.urlsafe())
+        new = [(seq, kind, message) for kind, message in events]
+        for _ in range(self.CAS_RETRIES):
+            current = client.gets(key)
+            if current is None:
+                if client.add(key, new, time=self.EVENT_TIMEOUT):
+                    return
+                continue
+            # Sorted by seq only: the sort is stable, so the events of one
+            # seq keep the order they were published in
+            kept = sorted(current + new, key=lambda event: event[0])
+            if client.cas(key, kept[-KEEP_EVENTS:], time=self.EVENT_TIMEOUT):
+                return
+
+    def wait(self, game_key, since, timeout):
+        key = self.EVENT_KEY.format(game_key.urlsafe())
+        deadline = time.time() + timeout
+        while True:
+            found = [event for event in memcache.get(key) or []
+                     if event[0] > since]
+            if found or time.time() >= deadline:
+                return found
+            time.sleep(self.POLL_INTERVAL)
+
+
+class LocalBroker(object):
+    """Keeps events in process memory and wakes subscribers immediately.
+    Only suitable for a single process, such as tests and load tests."""
+    def __init__(self):
+        self._events = {}
+        self._condition = threading.Condition()
+
+    def publish(self, game_key, seq, events):
+        with self._condition:
+            current = self._events.setdefault(game_key, [])
+            current.extend((seq, kind, message) for kind, message in events)
+            del current[:-KEEP_EVENTS]
+            self._condition.notify_all()
+
+    def wait(self, game_key, since, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                found = [event for event in self._events.get(game_key, [])
+                         if event[0] > since]
+                remaining = deadline - time.time()
+                if found or remaining <= 0:
+                    return found
+                self._condition.wait(remaining)
+
+
+broker = MemcacheBroker()
+
+
+def publish(game_key, seq, events):
+    """Publish events for a game.
+    Args:
+        game_key: The ndb.Key of the Game
+        seq: game_seq() of the game after the change
+        events: A list of (kind, message) pairs"""
+    broker.publish(game_key, seq, events)
+
+
+def wait(game_key, since, timeout=WAIT_TIMEOUT):
+    """Wait until a game has events newer than since.
+    Returns:
+        A list of (seq, kind, message) tuples, empty if none were published
+        before the timeout."""
+    return broker.wait(game_key, since, timeout)
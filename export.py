@@ -0,0 +1,261 @@
+"""export.py - Bulk export of the games, moves and scores for offline
+analysis. An ExportJob walks each exported kind with a query cursor and
+writes it as numbered part files of newline delimited JSON or CSV, one part
+per task. The ExportJob is the checkpoint: a part is always written from
+the cursor it holds, and the job only moves past the part once the part is
+complete, so a failed task is retried from where the last one stopped and
+rewrites the same part. Only one batch of entities is held in memory at a
+time, however many rows there are.
+Parts are written to Cloud Storage when the destination is gs://bucket/path,
+which needs the GoogleAppEngineCloudStorageClient library, or else to a local
+directory (with the dev server or in tests)."""
+
+import csv
+import datetime
+import json
+import os
+import time
+
+from google.appengine.api import app_identity, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+try:
+    import cloudstorage
+except ImportError:  # Only needed to export to Cloud Storage
+    cloudstorage = None
+
+from models import ExportJob, Game, GameSummary, PlayerMoves, UserScores
+from utils import job_name
+
+KINDS = [Game, GameSummary, PlayerMoves, UserScores]
+HISTORY_KINDS = (Game, GameSummary)  # Exported with their moves decoded
+FORMATS = ['ndjson', 'csv']
+QUERY_BATCH_SIZE = 500
+PART_ROWS = 200000  # Rows per part file at most
+EXPORT_TASK_TIME = 8 * 60  # Seconds of writing per task
+TASK_URL = '/tasks/export'
+
+
+class FileSink(object):
+    """Writes part files under a local directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def open(self, name):
+        path = os.path.join(self.directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return open(path, 'wb')
+
+
+class CloudStorageSink(object):
+    """Writes part files as objects under a /bucket/path of Cloud
+    Storage"""
+
+    def __init__(self, path):
+        if cloudstorage is None:
+            raise RuntimeError('Exporting to Cloud Storage requires the '
+                               'GoogleAppEngineCloudStorageClient library')
+        self.path = path.rstrip('/')
+
+    def open(self, name):
+        return cloudstorage.open('{}/{}'.format(self.path, name), 'w')
+
+
+def open_sink(destination):
+    """Return the sink of a destination, gs://bucket/path or a local
+    directory"""
+    if destination.startswith('gs://'):
+        return CloudStorageSink(destination[len('gs:/'):])
+    return FileSink(destination)
+
+
+def start(format='ndjson', kinds=None, destination=None):
+    """Create an ExportJob and enqueue its first task.
+    Args:
+        format: ndjson or csv
+        kinds: Names of the kinds to export, by default all of KINDS
+        destination: gs://bucket/path or a local directory, by default the
+            exports folder of the default Cloud Storage bucket
+    Returns:
+        The ExportJob
+    Raises:
+        ValueError: If the format or a kind is unknown"""
+    names = [model._get_kind() for model in KINDS]
+    kinds = kinds or names
+    if format not in FORMATS:
+        raise ValueError('Unknown format {}'.format(format))
+    for kind in kinds:
+        if kind not in names:
+            raise ValueError('Unknown kind {}'.format(kind))
+    if not destination:
+        destination = 'gs://{}/exports'.format(
+            app_identity.get_default_gcs_bucket_name())
+
+    job = ExportJob(id=job_name(), format=format, destination=destination,
+                    kinds=kinds, part=0, rows={}, is_done=False)
+    _start(job)
+    return job
+
+
+@ndb.transactional
+def _start(job):
+    job.put()
+    enqueue(job, transactional=True)
+
+
+def resume(job_name):
+    """Enqueue the task of the next part of a job again, after its task
+    ran out of retries.
+    Returns:
+        The ExportJob, or None if there is no such job"""
+    job = ExportJob.get_by_id(job_name)
+    if job and not job.is_done:
+        enqueue(job)
+    return job
+
+
+def enqueue(job, transactional=False):
+    """Enqueue the task writing the next part of a job. The kind and part
+    are passed along so that a duplicate task is ignored."""
+    taskqueue.add(url=TASK_URL,
+                  params={'job': job.key.id(), 'kind': job.kinds[0],
+                          'part': job.part},
+                  transactional=transactional)
+
+
+def run(job_name, kind, part, deadline):
+    """Write one part of a job and move its checkpoint past it, chaining
+    the task of the next part.
+    Args:
+        job_name: The name of the ExportJob
+        kind, part: The kind and part the task was enqueued for; nothing is
+            done unless the job is still at them
+        deadline: time.time() value after which no more batches are read
+    Returns:
+        The ExportJob, or None if the task was a duplicate"""
+    job = ExportJob.get_by_id(job_name)
+    if not job or job.is_done or job.kinds[0] != kind or job.part != part:
+        return None
+    cursor, more, rows = write_part(job, deadline)
+    return _checkpoint(job.key, kind, part, cursor, more, rows)
+
+
+def part_name(job, kind, part):
+    return '{}/{}-{:05d}.{}'.format(job.key.id(), kind, part, job.format)
+
+
+def write_part(job, deadline):
+    """Write the rows of the current kind of a job from its cursor, until
+    PART_ROWS rows, the end of the kind or the deadline.
+    Returns:
+        A tuple of the Cursor after the last row written, True if the kind
+        has more rows and the number of rows written"""
+    model = ndb.Model._lookup_model(job.kinds[0])
+    query = model.query()
+    cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    rows = 0
+    more = True
+    output = open_sink(job.destination).open(
+        part_name(job, job.kinds[0], job.part))
+    try:
+        write = _writer(job.format, model, output)
+        while more and rows < PART_ROWS and time.time() < deadline:
+            entities, next_cursor, more = query.fetch_page(
+                QUERY_BATCH_SIZE, start_cursor=cursor)
+            for entity in entities:
+                write(to_row(entity))
+            rows += len(entities)
+            cursor = next_cursor or cursor
+    finally:
+        output.close()
+    return cursor, more, rows
+
+
+def to_row(entity):
+    """Return a dict of the properties of an entity, with its key and the
+    key of its parent (the Game of PlayerMoves and UserScores) as urlsafe
+    strings. The packed history of Games and GameSummaries is decoded into
+    moves."""
+    parent = entity.key.parent()
+    row = {'key': entity.key.urlsafe(),
+           'parent': parent.urlsafe() if parent else None}
+    for name, value in entity.to_dict().items():
+        row[name] = _plain(value)
+    if isinstance(entity, HISTORY_KINDS):
+        row['moves'] = _moves(entity)
+    return row
+
+
+def _moves(game):
+    """Return the [player_1_move, player_2_move] of every round of a Game
+    or GameSummary, or None for an older Game whose moves are still
+    PlayerMoves children, which are exported with them"""
+    if game.history is None:
+        return None
+    if isinstance(game, GameSummary):
+        game = game.to_game()
+    return [list(moves) for moves in game.get_history()]
+
+
+def _plain(value):
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    if isinstance(value, ndb.Key):
+        return value.urlsafe()
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _writer(format, model, output):
+    """Return a function writing a row to output in the format. CSV columns
+    are the key, the parent and the properties of the model in order,
+    then the moves of HISTORY_KINDS; lists are written as JSON."""
+    if format == 'ndjson':
+        return lambda row: output.write(json.dumps(row, sort_keys=True) +
+                                        '\n')
+
+    columns = ['key', 'parent'] + sorted(
+        prop._code_name for prop in model._properties.values())
+    if issubclass(model, HISTORY_KINDS):
+        columns.append('moves')
+    writer = csv.DictWriter(output, columns, extrasaction='ignore')
+    writer.writeheader()
+
+    def write(row):
+        writer.writerow(dict((name, _csv_value(value))
+                             for name, value in row.items()))
+    return write
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return json.dumps(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+@ndb.transactional
+def _checkpoint(job_key, kind, part, cursor, more, rows):
+    job = job_key.get()
+    if job.is_done or job.kinds[0] != kind or job.part != part:
+        return job  # A duplicate task got there first
+    job.rows[kind] = job.rows.get(kind, 0) + rows
+    if more:
+        job.cursor = cursor.urlsafe() if cursor else None
+        job.part += 1
+    else:
+        job.kinds = job.kinds[1:]
+        job.cursor = None
+        job.part = 0
+    job.is_done = not job.kinds
+    job.put()
+    if not job.is_done:
+        enqueue(job, transactional=True)
+    return job
@@ -0,0 +1,160 @@
+"""leaderboard.py - User rankings in descending order of winning rate.
+The top of the ranking is cached in memcache, split into shards by user name
+so that concurrent game results rarely contend on the same cache entry. Each
+shard holds every user of the shard whose winning rate is above the shard's
+floor (or all of them when the floor is None), so merging the shards gives
+an exact ranking down to the highest floor. Anything below that is read from
+the datastore."""
+
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
+
+from models import User
+
+SHARDS = 10
+SHARD_SIZE = 50  # Maximum number of entries cached per shard
+SHARD_TIMEOUT = 60 * 60  # Bounds how long a missed update can go unnoticed
+CAS_RETRIES = 5
+SHARD_KEY = 'leaderboard:{}'
+CACHE_CURSOR = 'c:'  # Cursor prefix for an offset into the cached ranking
+DATASTORE_CURSOR = 'd:'  # Cursor prefix for a datastore query cursor
+
+
+def _shard(name):
+    return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % SHARDS
+
+
+def _entry(user):
+    return (user.winning_rate, user.name, user.win, user.lose, user.draw)
+
+
+def _order(entry):
+    # Same order as the datastore query: winning rate, then key (the name)
+    return -entry[0], entry[1]
+
+
+def _cached():
+    """Return the merged cached ranking and the rate above which it is
+    exact (None when it holds every user)."""
+    keys = [SHARD_KEY.format(shard) for shard in range(SHARDS)]
+    shards = memcache.get_multi(keys)
+    if len(shards) < SHARDS:
+        shards.update(_rebuild(keys, shards))
+
+    floors = [shard['floor'] for shard in shards.values()
+              if shard['floor'] is not None]
+    floor = max(floors) if floors else None
+    entries = sorted((entry for shard in shards.values()
+                      for entry in shard['entries']
+                      if floor is None or entry[0] > floor), key=_order)
+    return entries, floor
+
+
+def _rebuild(keys, existing):
+    """Fill in missing shards from the top of the datastore ranking"""
+    size = SHARDS * SHARD_SIZE // 2
+    users = User.query().order(-User.winning_rate).fetch(size)
+    floor = users[-1].winning_rate if len(users) == size else None
+
+    shards = dict((key, {'floor': floor, 'entries': []}) for key in keys
+                  if key not in existing)
+    for user in users:
+        shard = shards.get(SHARD_KEY.format(_shard(user.name)))
+        if shard is not None:
+            shard['entries'].append(_entry(user))
+    for shard in shards.values():
+        if len(shard['entries']) > SHARD_SIZE:
+            shard['floor'] = shard['entries'][SHARD_SIZE][0]
+            del shard['entries'][SHARD_SIZE:]
+    # add, not set: never overwrite a shard an update has touched meanwhile
+    memcache.add_multi(shards, time=SHARD_TIMEOUT)
+    return shards
+
+
+def update(users):
+    """Apply changed User entities (new users or new game results) to the
+    cached ranking. Missing shards are left alone and rebuilt on read."""
+    by_shard = {}
+    for user in users:
+        by_shard.setdefault(_shard(user.name), []).append(user)
+
+    client = memcache.Client()
+    for shard, shard_users in by_shard.items():
+        key = SHARD_KEY.format(shard)
+        names = set(user.name for user in shard_users)
+        for _ in range(CAS_RETRIES):
+            value = client.gets(key)
+            if value is None:
+                break
+            floor = value['floor']
+            entries = [entry for entry in value['entries']
+                       if entry[1] not in names]
+            entries.extend(_entry(user) for user in shard_users
+                           if floor is None or user.winning_rate > floor)
+            entries.sort(key=_order)
+            if len(entries) > SHARD_SIZE:
+                floor = entries[SHARD_SIZE][0]
+                entries = entries[:SHARD_SIZE]
+            if client.cas(key, {'floor': floor, 'entries': entries},
+                          time=SHARD_TIMEOUT):
+                break
+        else:
+            # Too much contention: drop the shard rather than serve it stale
+            client.delete(key)
+
+
+def page(limit, cursor=None):
+    """Return a page of the ranking.
+    Args:
+        limit: Maximum number of entries to return
+        cursor: Cursor returned with the previous page, or None
+    Returns:
+        A tuple of a list of (winning_rate, name, win, lose, draw) entries
+        and the cursor of the next page, or None on the last page.
+    Raises:
+        ValueError: If the cursor is malformed."""
+    cursor = cursor or CACHE_CURSOR + '0'
+    if cursor.startswith(DATASTORE_CURSOR):
+        try:
+            start = Cursor(urlsafe=cursor[len(DATASTORE_CURSOR):])
+        except Exception:
+            raise ValueError('Invalid cursor')
+        return _datastore_page(limit, start_cursor=start)
+    if not cursor.startswith(CACHE_CURSOR):
+        raise ValueError('Invalid cursor')
+    try:
+        offset = int(cursor[len(CACHE_CURSOR):])
+    except ValueError:
+        raise ValueError('Invalid cursor')
+    if offset < 0:
+        raise ValueError('Invalid cursor')
+
+    entries, floor = _cached()
+    end = offset + limit
+    if end <= len(entries):
+        more = end < len(entries) or floor is not None
+        return (entries[offset:end],
+                CACHE_CURSOR + str(end) if more else None)
+    if floor is None:
+        return entries[offset:end], None
+    # The page runs past the cached part of the ranking
+    return _datastore_page(limit, offset=offset)
+
+
+def _datastore_page(limit, **options):
+    users, next_cursor, more = User.query().order(
+        -User.winning_rate).fetch_page(limit, **options)
+    return ([_entry(user) for user in users],
+            DATASTORE_CURSOR + next_cursor.urlsafe()
+            if more and next_cursor else None)
+
+
+def rank(user):
+    """Return the 1-based rank of a user: one more than the number of users
+    with a strictly higher winning rate."""
+    entries, floor = _cached()
+    if floor is None or user.winning_rate > floor:
+        return 1 + sum(1 for entry in entries if entry[0] > user.winning_rate)
+    return 1 + User.query(User.winning_rate > user.winning_rate).count()
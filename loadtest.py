@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""loadtest.py - Offline load test of the game API against the App Engine
+testbed stubs. Creates players and games, plays the games to the end with
+their moves interleaved as if they ran concurrently, and reads histories and
+rankings as spectators would. Endpoint timings and RPC counts are the ones
+recorded by profiling.instrument, so they count the same way as on a live
+instance. The results of the players are then recounted by userstats, which
+finds no drift unless the run lost results. Results are written as JSON so
+that runs on two commits can be compared.
+
+Usage:
+    python loadtest.py --sdk ~/google_appengine --games 1000 \\
+        --output loadtest.json [--compare before.json]"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+EMAIL = 'loadtest@example.com'  # oauth user, and email of every player
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def add_sdk(sdk):
+    """Put the SDK and the libraries it bundles on sys.path"""
+    if sdk in sys.path:
+        return
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+def activate_testbed(sdk):
+    """Put the SDK on sys.path and activate the stubs the API uses. Queries
+    are strongly consistent so that the run does not depend on chance."""
+    add_sdk(sdk)
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(oauth_email=EMAIL, oauth_user_id='1',
+                  oauth_auth_domain='gmail.com', overwrite=True)
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.
+        PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_user_stub()
+    bed.init_mail_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    return bed
+
+
+def summarize(samples, seconds, games):
+    """Turn the profiling samples of a run into per endpoint results"""
+    import profiling
+
+    endpoints = {}
+    phases = {}
+    for name, values in samples.items():
+        endpoint, measure = name.rsplit('.', 1)
+        values = sorted(values)
+        if name.startswith('play_game.'):  # Phases timed with phase()
+            phases[name] = {'p50_ms': profiling.percentile(values, 0.5),
+                            'p99_ms': profiling.percentile(values, 0.99)}
+        elif measure == 'wall_ms':
+            endpoints.setdefault(endpoint, {}).update(
+                count=len(values),
+                p50_ms=profiling.percentile(values, 0.5),
+                p99_ms=profiling.percentile(values, 0.99))
+        elif measure in ('datastore_rpcs', 'memcache_calls'):
+            endpoints.setdefault(endpoint, {})[measure + '_mean'] = \
+                float(sum(values)) / len(values)
+
+    requests = sum(result.get('count', 0) for result in endpoints.values())
+    datastore_rpcs = sum(sum(values) for name, values in samples.items()
+                         if name.endswith('.datastore_rpcs'))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'games': games,
+            'requests': requests,
+            'seconds': seconds,
+            'requests_per_second': requests / seconds if seconds else 0.0,
+            'datastore_rpcs_per_game': float(datastore_rpcs) / games,
+            'endpoints': endpoints,
+            'phases': phases}
+
+
+def compare(before, after):
+    """Return the lines of a table of the p50 and p99 latency of each
+    endpoint in two results, with the relative change of the p50"""
+    lines = ['{:<40} {:>17} {:>17} {:>7}'.format(
+        'endpoint', 'p50 ms before/now', 'p99 ms before/now', 'p50')]
+    for name in sorted(after['endpoints']):
+        old = before['endpoints'].get(name)
+        new = after['endpoints'][name]
+        if not old or 'p50_ms' not in old or 'p50_ms' not in new:
+            continue
+        change = (new['p50_ms'] - old['p50_ms']) / old['p50_ms'] \
+            if old['p50_ms'] else 0.0
+        lines.append('{:<40} {:>8.2f}/{:<8.2f} {:>8.2f}/{:<8.2f} {:>+6.0%}'.
+                     format(name, old['p50_ms'], new['p50_ms'],
+                            old['p99_ms'], new['p99_ms'], change))
+    lines.append('datastore RPCs per game: {:.1f}/{:.1f}'.format(
+        before['datastore_rpcs_per_game'], after['datastore_rpcs_per_game']))
+    return lines
+
+
+def run(games, spectators, seed):
+    """Play games to the end and return the profiling samples of the run
+    and its duration in seconds.
+    Args:
+        games: Number of games played at the same time
+        spectators: Number of get_game/get_game_history reads per move
+        seed: Seed of the random moves"""
+    from google.appengine.ext import ndb
+
+    import api
+    import profiling
+    import ratelimit
+    from engine import CARDS, MOVES
+
+    profiling.FLUSH_INTERVAL = float('inf')  # Keep every sample in memory
+    # Every player and spectator is the same oauth user: keep the rate
+    # limits in the measured path, but never throttle
+    ratelimit.LIMITS = dict((scope, (1e6, 1e6)) for scope in ratelimit.LIMITS)
+    v1 = api.LimitedRPSApi()
+    v2 = api.LimitedRPSApiV2()
+    rand = random.Random(seed)
+
+    def call(method, container, **fields):
+        # Each call is a request of its own, with an empty in-context cache
+        ndb.get_context().clear_cache()
+        return method(container.combined_message_class(**fields))
+
+    names = ['player-{}'.format(i) for i in range(2 * games)]
+    for name in names:
+        call(v1.create_user, api.USER_REQUEST, user_name=name)
+    profiling.take_samples()  # Players are set up, not measured
+
+    start = time.time()
+    active = {}
+    for i in range(games):
+        form = call(v2.create_game, api.CREATE_GAME_REQUEST,
+                    player_1_name=names[2 * i],
+                    player_2_name=names[2 * i + 1])
+        decks = [MOVES * CARDS, MOVES * CARDS]
+        for deck in decks:
+            rand.shuffle(deck)
+        active[form.urlsafe_key] = (names[2 * i], names[2 * i + 1], decks)
+
+    while active:
+        keys = list(active)
+        rand.shuffle(keys)
+        for key in keys:
+            player_1_name, player_2_name, decks = active[key]
+            for player_name, deck in zip((player_1_name, player_2_name),
+                                         decks):
+                form = call(v2.play_game, api.PLAY_GAME_REQUEST,
+                            game_key=key, player_name=player_name,
+                            move=deck.pop())
+                for _ in range(spectators):
+                    call(rand.choice((v2.get_game, v2.get_game_history)),
+                         api.GET_GAME_REQUEST, game_key=key)
+            if not form.is_active:
+                del active[key]
+                call(v2.get_game_history, api.GET_GAME_REQUEST, game_key=key)
+                call(v2.get_user_rankings, api.GET_RANKINGS_REQUEST)
+    return profiling.take_samples(), time.time() - start
+
+
+def check_user_stats():
+    """Recount the results of every player from their games and return the
+    report of the repair, whose drift is 0 unless a run lost results"""
+    from models import StatsRepairShard
+    import userstats
+
+    job_key = userstats.start(enqueue=False)
+    for key in StatsRepairShard.query(ancestor=job_key).fetch(keys_only=True):
+        while not userstats.run(key, float('inf')).is_done:
+            pass
+    return userstats.report(job_key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', required=True,
+                        help='Path of the App Engine Python SDK')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--spectators', type=int, default=1,
+                        help='Spectator reads of a game after each move')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='loadtest.json')
+    parser.add_argument('--compare', metavar='BEFORE',
+                        help='Results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    bed = activate_testbed(args.sdk)
+    try:
+        samples, seconds = run(args.games, args.spectators, args.seed)
+        user_stats = check_user_stats()
+    finally:
+        bed.deactivate()
+    results = summarize(samples, seconds, args.games)
+    results['user_stats'] = user_stats
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=1, sort_keys=True)
+    print('{} requests in {:.1f}s ({:.0f}/s), {:.1f} datastore RPCs per '
+          'game, written to {}'.format(results['requests'], seconds,
+                                       results['requests_per_second'],
+                                       results['datastore_rpcs_per_game'],
+                                       args.output))
+    print('User results recounted for {users} players, drift {drift}'.
+          format(**user_stats))
+    if args.compare:
+        with open(args.compare) as before:
+            print('\n'.join(compare(json.load(before), results)))
+
+
+if __name__ == '__main__':
+    main()
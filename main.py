@@ -3,43 +3,510 @@
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
 
+import collections
+import json
+import logging
+import time
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-from models import User, Game
+from models import User, Game, GameSummary, PlayerMoves, UserStatsShard
+from models import ExportJob
+from models import pack_history
+import counters
+import export
+import matchmaking
+import movelog
+import profiling
+import ratelimit
+import stats
+import tournament
+import userstats
+from utils import cache_counts, invalidate
+
+MIGRATION_BATCH_SIZE = 100
+QUERY_BATCH_SIZE = 500
+REMINDER_BATCH_SIZE = 500  # Players per reminder mail task at most
+REMINDER_PAYLOAD_SIZE = 90 * 1024  # Bytes per reminder mail task at most
+REMINDER_GAMES = 20  # Active games listed per reminder mail
+ROLLUP_BATCH_SIZE = 500  # Counter shards rolled up per request
+STATS_TASK_TIME = 8 * 60  # Seconds of scanning per stats task
+REPAIR_TASK_TIME = 8 * 60  # Seconds of repairing per user stats task
+ARCHIVE_BATCH_SIZE = 100  # Finished games archived per task
+DELETE_BATCH_SIZE = 500  # Child entities deleted per delete_multi
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
         """Send a reminder email to each User with active Games.
-        Called every hour using a cron job"""
+        Called every hour using a cron job. Groups the active games by
+        player in a single pass, keeps the players with an email and fans
+        the mails out to push queue tasks. Each task carries the email of
+        its players and up to REMINDER_GAMES of their games, so the tasks
+        read nothing, and holds at most REMINDER_BATCH_SIZE players and
+        REMINDER_PAYLOAD_SIZE bytes."""
+        games = collections.defaultdict(list)
+        query = Game.query(Game.is_active == True)
+        for game in query.iter(batch_size=QUERY_BATCH_SIZE,
+                               projection=[Game.player_1_name,
+                                           Game.player_2_name]):
+            for name, opponent in ((game.player_1_name, game.player_2_name),
+                                   (game.player_2_name, game.player_1_name)):
+                # One more than listed tells the mail there are more
+                if len(games[name]) <= REMINDER_GAMES:
+                    games[name].append((opponent, game.key))
+
+        # The bot and other users without an email get no reminders
+        users = User.query(User.email > '').iter(batch_size=QUERY_BATCH_SIZE,
+                                                 projection=[User.email])
+        reminders = [json.dumps([user.key.id(), user.email,
+                                 [[opponent, key.urlsafe()] for opponent, key
+                                  in games[user.key.id()][:REMINDER_GAMES]],
+                                 len(games[user.key.id()]) > REMINDER_GAMES])
+                     for user in users if user.key.id() in games]
+
+        tasks = []
+        batch = []
+        size = 1  # Of the payload: the brackets and a comma per reminder
+        for reminder in reminders:
+            if batch and (len(batch) == REMINDER_BATCH_SIZE or
+                          size + len(reminder) + 1 > REMINDER_PAYLOAD_SIZE):
+                tasks.append(_reminder_task(batch))
+                batch, size = [], 1
+            batch.append(reminder)
+            size += len(reminder) + 1
+        if batch:
+            tasks.append(_reminder_task(batch))
+        queue = taskqueue.Queue()
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+
+def _reminder_task(reminders):
+    """Return the task mailing a batch of reminders, each a JSON list"""
+    return taskqueue.Task(url='/tasks/send_reminders',
+                          payload='[{}]'.format(','.join(reminders)))
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    def post(self):
+        """Send the reminder emails of one batch of players. The payload
+        lists the name, email and games, as (opponent, urlsafe key) pairs,
+        of each player, and whether they have more games than listed."""
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
+        for name, email, games, more in json.loads(self.request.body):
+            subject = 'Unfinished game reminder!'
+            body = 'Hello {}, \n\nThe following games are still in ' \
+                   'progress:\n'.format(name)
+            html = 'Hello {}, <br><br>The following games are still in ' \
+                   'progress:<br>'.format(name)
+            for opponent, urlsafe in games:
+                body += '{} vs {} (game {})\n'.format(name, opponent, urlsafe)
+                html += '{} vs {} (game {})<br>'.format(name, opponent,
+                                                         urlsafe)
+            if more:
+                body += 'and more\n'
+                html += 'and more<br>'
+            body += 'https://{}.appspot.com">Continue playing'\
+                .format(app_id)
+            html += '<a href="https://{}.appspot.com">Continue playing' \
+                    '</a>'.format(app_id)
+            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                           email, subject, body, html=html)
+
+
+class AdvanceTournament(webapp2.RequestHandler):
+    def post(self):
+        """Start the next round of a tournament once its current round is
+        over. Enqueued whenever a game of the tournament finishes."""
+        tournament.advance(
+            ndb.Key(urlsafe=self.request.get('tournament_key')))
+
+
+class RollupUserStats(webapp2.RequestHandler):
+    def get(self):
+        """Roll the sharded result counters up into their Users.
+        Called every 10 minutes using a cron job"""
+        self.post()
+
+    def post(self):
+        """Roll up one batch of counter shards, then chain the next batch
+        as a task with a cursor."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = UserStatsShard.query().fetch_page(
+            ROLLUP_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+
+        names = set(counters.shard_name(key) for key in keys)
+        futures = [(name, counters.rollup_async(name)) for name in names]
+        for name, future in futures:
+            try:
+                future.get_result()
+            except datastore_errors.TransactionFailedError:
+                logging.warning('Rollup of {} failed, it will be retried by '
+                                'the next run'.format(name))
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/rollup_user_stats',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+@ndb.transactional(xg=True)
+def archive_game(game_key):
+    """Replace a finished Game by its GameSummary, folding its PlayerMoves
+    into the packed history first if needed.
+    Returns:
+        True if the game was archived"""
+    game = game_key.get()
+    if not game or game.is_active:
+        return False
+    if game.history is None:
+        game.history = pack_history(game.legacy_history())
+    GameSummary.from_game(game).put()
+    game_key.delete()
+    return True
+
+
+def delete_children(game_key):
+    """Delete the PlayerMoves of an archived game in batches. UserScores
+    are kept, as get_high_scores and the stats read them."""
+    query = PlayerMoves.query(ancestor=game_key)
+    while True:
+        keys = query.fetch(DELETE_BATCH_SIZE, keys_only=True)
+        if not keys:
+            return
+        ndb.delete_multi(keys)
+
+
+class ArchiveGames(webapp2.RequestHandler):
+    def get(self):
+        """Archive finished games. Called every day using a cron job"""
+        self.post()
+
+    def post(self):
+        """Replace one batch of finished Games by GameSummary records and
+        delete their PlayerMoves, then chain the next batch as a task with
+        a cursor."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = Game.query(Game.is_active == False).\
+            fetch_page(ARCHIVE_BATCH_SIZE, start_cursor=cursor,
+                       keys_only=True)
+
+        for key in keys:
+            if archive_game(key):
+                invalidate(key)
+                delete_children(key)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/archive_games',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class CacheAverageAttempts(webapp2.RequestHandler):
+    def get(self):
+        """Recompute the global game statistics from every finished game.
+        Called every day using a cron job"""
+        self.post()
+
+    def post(self):
+        """Recompute the global game statistics, repairing the sums kept
+        as games finish. A scan that takes longer than STATS_TASK_TIME
+        chains itself with its partial sums."""
+        state = json.loads(self.request.get('state') or 'null') or \
+            stats.new_state()
+        if stats.scan(state, time.time() + STATS_TASK_TIME):
+            stats.save(state)
+        else:
+            taskqueue.add(url='/tasks/cache_average_attempts',
+                          params={'state': json.dumps(state)})
+
+
+class CacheCounts(webapp2.RequestHandler):
+    def get(self):
+        """Show the hits, misses and coalesced reads of the get_by_urlsafe
+        cache, and the requests throttled by the rate limits, as JSON"""
+        counts = cache_counts()
+        counts['throttled'] = ratelimit.throttle_counts()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(counts))
+
+
+class Profile(webapp2.RequestHandler):
+    def get(self):
+        """Show the percentiles of the endpoint timings and RPC counts, and
+        the latest cProfile outputs, as JSON"""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(profiling.percentiles(), indent=1,
+                                       sort_keys=True))
+
+    def post(self):
+        """Set the fraction of requests run under cProfile, 0 to stop"""
+        try:
+            rate = float(self.request.get('sample_rate'))
+        except ValueError:
+            self.abort(400, 'sample_rate must be a number')
+        profiling.set_sample_rate(min(max(rate, 0.0), 1.0))
+
+
+class DrainQueue(webapp2.RequestHandler):
+    def get(self):
+        """Pair waiting players. Called every minute using a cron job, in
+        case a drain task was lost"""
+        self.post()
+
+    def post(self):
+        """Pair one batch of the players waiting in each bucket of the
+        matchmaking queue, chaining another drain while more are waiting.
+        Enqueued when players join the queue."""
+        games, more = matchmaking.drain()
+        if games:
+            logging.info('Matched {} games'.format(len(games)))
+        if more:
+            taskqueue.add(url='/tasks/drain_queue')
+
+
+class RepairGames(webapp2.RequestHandler):
+    def post(self):
+        """Check Games against their move log and correct those that
+        differ. Repairs the game_key given, or else one batch of every Game
+        per task, chaining itself with a cursor."""
+        more = False
+        if self.request.get('game_key'):
+            keys = [ndb.Key(urlsafe=self.request.get('game_key'))]
+        else:
+            cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+            keys, next_cursor, more = Game.query().fetch_page(
+                MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+
+        for key in keys:
+            changed = movelog.repair(key)
+            if changed:
+                invalidate(key)
+                logging.warning('Repaired {} of game {} from its move log'.
+                                format(', '.join(changed), key.urlsafe()))
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/repair_games',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class MoveLog(webapp2.RequestHandler):
+    def get(self):
+        """Stream one page of the move log of every game as newline
+        delimited JSON. Pass the X-Next-Cursor header of a page as the
+        cursor parameter to get the next one."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        rows, next_cursor, more = movelog.export_page(
+            cursor, int(self.request.get('limit') or QUERY_BATCH_SIZE))
+        self.response.headers['Content-Type'] = 'application/x-ndjson'
+        if more and next_cursor:
+            self.response.headers['X-Next-Cursor'] = next_cursor.urlsafe()
+        for row in rows:
+            self.response.write(json.dumps(row) + '\n')
+
+
+class Export(webapp2.RequestHandler):
+    def get(self):
+        """Show the progress of the latest export jobs as JSON"""
+        jobs = ExportJob.query().order(-ExportJob.started).fetch(10)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps([job.status() for job in jobs],
+                                       indent=1, sort_keys=True))
+
+    def post(self):
+        """Start an export job of the kinds given (comma separated, all by
+        default) in a format (ndjson or csv) to a destination, or resume
+        the job given by name from its checkpoint."""
+        if self.request.get('job'):
+            job = export.resume(self.request.get('job'))
+            if not job:
+                self.abort(404, 'No export job named {}'.format(
+                    self.request.get('job')))
+        else:
+            kinds = [kind for kind in self.request.get('kinds').split(',')
+                     if kind]
+            try:
+                job = export.start(self.request.get('format') or 'ndjson',
+                                   kinds, self.request.get('destination'))
+            except ValueError as e:
+                self.abort(400, str(e))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(job.status(), sort_keys=True))
+
+
+class ExportPart(webapp2.RequestHandler):
+    def post(self):
+        """Write the next part file of an export job and chain the task of
+        the part after it. Enqueued by the job itself."""
+        job = export.run(self.request.get('job'), self.request.get('kind'),
+                         int(self.request.get('part')),
+                         time.time() + export.EXPORT_TASK_TIME)
+        if job and job.is_done:
+            logging.info('Export {} done: {}'.format(job.key.id(), job.rows))
+
+
+class RepairUserStats(webapp2.RequestHandler):
+    def get(self):
+        """Show the progress of a user stats repair job, the job given or
+        else the latest one, and the drift it found as JSON"""
+        if self.request.get('job'):
+            job_key = ndb.Key(userstats.JOB_KIND, self.request.get('job'))
+        else:
+            job_key = userstats.latest_job()
+        if not job_key:
+            self.abort(404, 'No user stats repair job has run')
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(userstats.report(job_key),
+                                       sort_keys=True))
+
+    def post(self):
+        """Start a job recounting the results of every User and correcting
+        those that drifted, or resume the unfinished ranges of the job
+        given"""
+        if self.request.get('job'):
+            job_key = ndb.Key(userstats.JOB_KIND, self.request.get('job'))
+            userstats.resume(job_key)
+        else:
+            job_key = userstats.start()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'job': job_key.id()}))
+
+
+class RepairUserStatsRange(webapp2.RequestHandler):
+    def post(self):
+        """Repair the results of one range of Users of a job, chaining
+        itself until the range is done"""
+        shard = userstats.run(ndb.Key(urlsafe=self.request.get('shard')),
+                              time.time() + REPAIR_TASK_TIME)
+        if not shard.is_done:
+            taskqueue.add(url='/tasks/repair_user_stats',
+                          params={'shard': shard.key.urlsafe()})
+
+
+@ndb.transactional(xg=True)
+def rekey_user(key):
+    """Move a User keyed by an auto-allocated id to the key of its name. If
+    a User is already keyed by the name, the duplicate's results are added
+    to it instead, so that no finished game is lost."""
+    user = key.get()
+    if not user or user.key.id() == user.name:
+        return
+    keyed = ndb.Key(User, user.name).get()
+    if keyed:
+        logging.warning('User {} is already keyed by name, merging duplicate '
+                        '{} (win={}, lose={}, draw={})'.format(
+                            user.name, user.key, user.win, user.lose,
+                            user.draw))
+        for result in (counters.WIN, counters.LOSE, counters.DRAW):
+            setattr(keyed, result,
+                    (getattr(keyed, result) or 0) +
+                    (getattr(user, result) or 0))
+        keyed.winning_rate = counters.winning_rate(keyed)
+    else:
+        keyed = User(id=user.name, **user.to_dict())
+    keyed.put()
+    user.key.delete()
+
+
+class RekeyUsers(webapp2.RequestHandler):
+    def post(self):
+        """Re-key User entities created with an auto-allocated id so that
+        they are keyed by their name. Processes one batch per task and
+        chains itself with a cursor until every User has been visited."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
 
         for user in users:
-            games = Game.query(ndb.AND(Game.is_active == True,
-                                          ndb.OR(
-                                              Game.player_1_name == user.name,
-                                              Game.player_2_name == user.name)
-                                          )).fetch()
-
-            if games:
-                subject = 'Unfinished game reminder!'
-                body = 'Hello {}, \n\nThe following games are still in ' \
-                       'progress:\n'.format(user.name)
-                html = 'Hello {}, <br><br>The following games are still in ' \
-                       'progress:<br>'.format(user.name)
-                for game in games:
-                    body += '{} vs {}\n'.format(game.player_1_name,
-                                                game.player_2_name)
-                    html += '{} vs {}<br>'.format(game.player_1_name,
-                                                  game.player_2_name)
-                body += 'https://{}.appspot.com">Continue playing'\
-                    .format(app_id)
-                html += '<a href="https://{}.appspot.com">Continue playing' \
-                        '</a>'.format(app_id)
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email, subject, body, html=html)
-
-app = webapp2.WSGIApplication([('/crons/send_reminder', SendReminderEmail)],
+            if user.key.id() != user.name:
+                rekey_user(user.key)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/rekey_users',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+@ndb.transactional
+def fold_history(game_key):
+    """Pack a game's PlayerMoves into Game.history if it has not been yet"""
+    game = game_key.get()
+    if game.history is None:
+        game.history = pack_history(game.legacy_history())
+        game.put()
+
+
+class BackfillHistory(webapp2.RequestHandler):
+    def post(self):
+        """Fold the PlayerMoves rows of games created before the packed
+        history into Game.history. Processes one batch per task and chains
+        itself with a cursor until every Game has been visited."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+
+        for game in games:
+            if game.history is None:
+                fold_history(game.key)
+                invalidate(game.key)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_history',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+@ndb.transactional
+def fill_players(game_key):
+    """Set Game.players on a game created before it existed"""
+    game = game_key.get()
+    if not game.players:
+        game.players = [game.player_1_name, game.player_2_name]
+        game.put()
+
+
+class BackfillPlayers(webapp2.RequestHandler):
+    def post(self):
+        """Set Game.players on games created before it existed. Processes
+        one batch per task and chains itself with a cursor until every Game
+        has been visited."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+
+        for game in games:
+            if not game.players:
+                fill_players(game.key)
+                invalidate(game.key)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_players',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+app = webapp2.WSGIApplication([('/crons/send_reminder', SendReminderEmail),
+                               ('/crons/rollup_user_stats', RollupUserStats),
+                               ('/tasks/rollup_user_stats', RollupUserStats),
+                               ('/crons/archive_games', ArchiveGames),
+                               ('/tasks/archive_games', ArchiveGames),
+                               ('/crons/drain_queue', DrainQueue),
+                               ('/tasks/drain_queue', DrainQueue),
+                               ('/tasks/send_reminders', SendReminderBatch),
+                               ('/tasks/advance_tournament',
+                                AdvanceTournament),
+                               ('/crons/cache_average_attempts',
+                                CacheAverageAttempts),
+                               ('/tasks/cache_average_attempts',
+                                CacheAverageAttempts),
+                               ('/admin/cache_counts', CacheCounts),
+                               ('/admin/profile', Profile),
+                               ('/admin/move_log', MoveLog),
+                               ('/tasks/repair_games', RepairGames),
+                               ('/admin/export', Export),
+                               ('/admin/repair_user_stats', RepairUserStats),
+                               ('/tasks/repair_user_stats',
+                                RepairUserStatsRange),
+                               ('/tasks/export', ExportPart),
+                               ('/tasks/rekey_users', RekeyUsers),
+                               ('/tasks/backfill_history', BackfillHistory),
+                               ('/tasks/backfill_players', BackfillPlayers)],
                               debug=True)
@@ -0,0 +1,125 @@
+"""matchmaking.py - Queue of players waiting for an automatically chosen
+opponent. Players are put in one of BUCKETS buckets by their rating (their
+winning rate, or NEW_PLAYER_RATING before their first finished game).
+Joining only writes a QueueEntry and enqueues a drain task, at most one per
+DRAIN_INTERVAL. The drain reads the players who joined first in each bucket,
+pairs those with the closest ratings and carries a player left without an
+opponent over to the next bucket, so it never scans every waiting player."""
+
+import time
+
+from google.appengine.api import datastore_errors, taskqueue
+from google.appengine.ext import ndb
+
+import counters
+from models import Game, QueueEntry
+
+BUCKETS = 10
+NEW_PLAYER_RATING = 0.5
+DRAIN_BATCH_SIZE = 200  # Waiting players read per bucket per drain
+DRAIN_INTERVAL = 5  # Seconds between drains after players join
+
+
+def rating(user):
+    """Return the rating players are matched by"""
+    if not user.win + user.lose + user.draw:
+        return NEW_PLAYER_RATING
+    return counters.winning_rate(user)
+
+
+def bucket(value):
+    """Return the bucket of a rating between 0 and 1"""
+    return min(int(value * BUCKETS), BUCKETS - 1)
+
+
+@ndb.transactional
+def _add(entry):
+    if entry.key.get():
+        return False
+    entry.put()
+    return True
+
+
+def join(user):
+    """Put a player in the queue and make sure a drain will pair them.
+    Args:
+        user: The User, with its results refreshed
+    Returns:
+        False if the player was already waiting"""
+    value = rating(user)
+    if not _add(QueueEntry(id=user.name, bucket=bucket(value),
+                           rating=value)):
+        return False
+    enqueue_drain()
+    return True
+
+
+@ndb.transactional
+def leave(name):
+    """Take a player out of the queue.
+    Returns:
+        False if the player was not waiting, or has already been paired"""
+    key = ndb.Key(QueueEntry, name)
+    if not key.get():
+        return False
+    key.delete()
+    return True
+
+
+@ndb.transactional_tasklet(xg=True)
+def _match_async(name_1, name_2):
+    """Create a Game between two waiting players and take both out of the
+    queue, unless one of them has left in the meantime.
+    Returns:
+        The Game, or None"""
+    keys = [ndb.Key(QueueEntry, name_1), ndb.Key(QueueEntry, name_2)]
+    entries = yield ndb.get_multi_async(keys)
+    if not all(entries):
+        raise ndb.Return(None)
+    game = Game.new_game(name_1, name_2)
+    yield ndb.delete_multi_async(keys), game.put_async()
+    raise ndb.Return(game)
+
+
+def drain():
+    """Pair one batch of the waiting players of every bucket.
+    Returns:
+        A tuple of the list of Games created and True if a bucket has more
+        players waiting than were read."""
+    pairs = []
+    more = False
+    carried = None
+    for i in range(BUCKETS):
+        entries, _, bucket_more = QueueEntry.query(
+            QueueEntry.bucket == i).order(QueueEntry.joined).fetch_page(
+                DRAIN_BATCH_SIZE)
+        more = more or bucket_more
+        if carried:
+            entries.append(carried)
+        entries.sort(key=lambda entry: entry.rating)
+        carried = entries.pop() if len(entries) % 2 else None
+        pairs.extend((entries[j].key.id(), entries[j + 1].key.id())
+                     for j in range(0, len(entries), 2))
+
+    futures = [_match_async(name_1, name_2) for name_1, name_2 in pairs]
+    games = []
+    for future in futures:
+        try:
+            game = future.get_result()
+        except datastore_errors.TransactionFailedError:
+            continue  # Paired again by the next drain
+        if game:
+            games.append(game)
+    return games, more
+
+
+def enqueue_drain():
+    """Enqueue a drain unless one is already enqueued for the current
+    DRAIN_INTERVAL"""
+    window = int(time.time()) // DRAIN_INTERVAL
+    try:
+        taskqueue.add(url='/tasks/drain_queue',
+                      name='drain-queue-{}'.format(window),
+                      countdown=DRAIN_INTERVAL)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
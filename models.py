@@ -5,9 +5,24 @@ classes they can include methods (such as 'to_form' and 'new_game')."""
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import engine
+from engine import MOVES  # Game.history move codes are MOVES index + 1
+
+
+def pack_history(moves):
+    """Pack a list of (player_1_move, player_2_move) pairs into an integer,
+    4 bits per round starting from the lowest bits. Within a round the low
+    2 bits hold player_1's move code and the high 2 bits player_2's."""
+    history = 0
+    for i, (player_1_move, player_2_move) in enumerate(moves):
+        code = (MOVES.index(player_1_move) + 1) | \
+            (MOVES.index(player_2_move) + 1) << 2
+        history |= code << (4 * i)
+    return history
+
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile, keyed by the user name"""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty(required=True)
     winning_rate = ndb.FloatProperty()
@@ -16,11 +31,38 @@ class User(ndb.Model):
     lose = ndb.IntegerProperty()  # Number of lose games
     draw = ndb.IntegerProperty()  # Number of draw games
 
+    def to_form(self, rank=None):
+        """Return a UserRankForm of the user's results"""
+        return UserRankForm(name=self.name,
+                            winning_rate=self.winning_rate,
+                            win=self.win,
+                            lose=self.lose,
+                            draw=self.draw,
+                            rank=rank)
+
+
+class UserStatsShard(ndb.Model):
+    """Results of a User's finished games that have not been rolled up into
+    the User yet, keyed by '<name>-<shard number>'. See counters.py."""
+    win = ndb.IntegerProperty(indexed=False)
+    lose = ndb.IntegerProperty(indexed=False)
+    draw = ndb.IntegerProperty(indexed=False)
+
+
+class QueueEntry(ndb.Model):
+    """A player waiting in the matchmaking queue, keyed by the player name.
+    See matchmaking.py."""
+    bucket = ndb.IntegerProperty(required=True)  # Bucket of the rating
+    rating = ndb.FloatProperty(indexed=False)  # Rating when the player joined
+    joined = ndb.DateTimeProperty(auto_now_add=True)
+
 
 class Game(ndb.Model):
     """Game with players name and cards remain."""
     player_1_name = ndb.StringProperty(required=True)
     player_2_name = ndb.StringProperty(required=True)
+    players = ndb.StringProperty(repeated=True)
+    # Both player names, so that a player's games are one equality query
     player_1_rock = ndb.IntegerProperty()  # Number of Player1's rock cards
     player_1_paper = ndb.IntegerProperty()  # Number of Player1's paper cards
     player_1_scissors = ndb.IntegerProperty()
@@ -40,6 +82,196 @@ class Game(ndb.Model):
     # True corresponds to this game is active.
     # False corresponds to this game was finished.
     round_result = ndb.StringProperty()  # Result of round
+    history = ndb.IntegerProperty()
+    # Moves of every played round packed by pack_history().
+    # None for games created before the packed history was introduced,
+    # whose moves are still stored as PlayerMoves children.
+    tournament = ndb.KeyProperty(kind='Tournament')
+    # Tournament the game belongs to, if any
+    tournament_round = ndb.IntegerProperty()  # Round of the tournament
+
+    @classmethod
+    def new_game(cls, player_1_name, player_2_name, **kwargs):
+        """Return a new (unsaved) game with full hands of cards. Keyword
+        arguments (such as id or tournament) are passed to the model."""
+        return cls(player_1_name=player_1_name,
+                   player_2_name=player_2_name,
+                   players=[player_1_name, player_2_name],
+                   player_1_rock=3,
+                   player_1_paper=3,
+                   player_1_scissors=3,
+                   player_2_rock=3,
+                   player_2_paper=3,
+                   player_2_scissors=3,
+                   player_1_round_score=0,
+                   player_2_round_score=0,
+                   round=0,
+                   is_active=True,
+                   round_result='Not all players have played yet.',
+                   history=0,
+                   **kwargs)
+
+    def to_state(self):
+        """Return the engine.GameState of the game"""
+        return engine.GameState(
+            cards=[[self.player_1_rock, self.player_1_paper,
+                    self.player_1_scissors],
+                   [self.player_2_rock, self.player_2_paper,
+                    self.player_2_scissors]],
+            moves=[engine.MOVE_INDEX.get(self.player_1_move),
+                   engine.MOVE_INDEX.get(self.player_2_move)],
+            scores=[self.player_1_round_score, self.player_2_round_score],
+            round=self.round)
+
+    def apply_state(self, state):
+        """Copy an engine.GameState back onto the game properties"""
+        (self.player_1_rock, self.player_1_paper,
+         self.player_1_scissors) = state.cards[0]
+        (self.player_2_rock, self.player_2_paper,
+         self.player_2_scissors) = state.cards[1]
+        self.player_1_move, self.player_2_move = [
+            None if move is None else MOVES[move] for move in state.moves]
+        self.player_1_round_score, self.player_2_round_score = state.scores
+        self.round = state.round
+
+    def to_form(self, game_result=None):
+        """Return a GameForm of the game's state. Moves played this round
+        are left out so that the opponent cannot see them."""
+        return GameForm(urlsafe_key=self.key.urlsafe(),
+                        player_1_name=self.player_1_name,
+                        player_2_name=self.player_2_name,
+                        player_1_cards=[self.player_1_rock,
+                                        self.player_1_paper,
+                                        self.player_1_scissors],
+                        player_2_cards=[self.player_2_rock,
+                                        self.player_2_paper,
+                                        self.player_2_scissors],
+                        player_1_round_score=self.player_1_round_score,
+                        player_2_round_score=self.player_2_round_score,
+                        round=self.round,
+                        is_active=self.is_active,
+                        round_result=self.round_result,
+                        game_result=game_result)
+
+    def to_history_form(self):
+        """Return a HistoryForm of the moves played in every round"""
+        return HistoryForm(urlsafe_key=self.key.urlsafe(),
+                           player_1_name=self.player_1_name,
+                           player_2_name=self.player_2_name,
+                           rounds=[RoundForm(round=i + 1,
+                                             player_1_move=player_1_move,
+                                             player_2_move=player_2_move)
+                                   for i, (player_1_move, player_2_move)
+                                   in enumerate(self.get_history())])
+
+    def legacy_history(self):
+        """Return the moves recorded as PlayerMoves children of the game"""
+        moves = PlayerMoves.query(ancestor=self.key).order(PlayerMoves.round)
+        return [(move.player_1_move, move.player_2_move) for move in moves]
+
+    def record_round(self, player_1_move, player_2_move):
+        """Append the moves of the round just played (self.round) to the
+        packed history, folding in PlayerMoves first for older games."""
+        if self.history is None:
+            self.history = pack_history(self.legacy_history())
+        self.history |= pack_history([(player_1_move, player_2_move)]) << \
+            (4 * (self.round - 1))
+
+    def get_history(self):
+        """Return the list of (player_1_move, player_2_move) of each round"""
+        if self.history is None:
+            return self.legacy_history()
+        moves = []
+        history = self.history
+        while history:
+            moves.append((MOVES[(history & 3) - 1],
+                          MOVES[(history >> 2 & 3) - 1]))
+            history >>= 4
+        return moves
+
+
+class GameSummary(ndb.Model):
+    """Compact record of a finished Game, which replaces it once archived.
+    Keyed by the id of the Game it replaces; the remaining cards are
+    derived from the packed history."""
+    player_1_name = ndb.StringProperty(required=True, indexed=False)
+    player_2_name = ndb.StringProperty(required=True, indexed=False)
+    players = ndb.StringProperty(repeated=True)
+    player_1_round_score = ndb.IntegerProperty(indexed=False)
+    player_2_round_score = ndb.IntegerProperty(indexed=False)
+    round = ndb.IntegerProperty(indexed=False)
+    round_result = ndb.TextProperty()  # Result of the last round
+    history = ndb.IntegerProperty(indexed=False)  # As Game.history
+    tournament = ndb.KeyProperty(kind='Tournament')
+    tournament_round = ndb.IntegerProperty(indexed=False)
+    archived = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def from_game(cls, game):
+        """Return the (unsaved) summary of a finished game"""
+        return cls(id=game.key.id(),
+                   player_1_name=game.player_1_name,
+                   player_2_name=game.player_2_name,
+                   players=[game.player_1_name, game.player_2_name],
+                   player_1_round_score=game.player_1_round_score,
+                   player_2_round_score=game.player_2_round_score,
+                   round=game.round,
+                   round_result=game.round_result,
+                   history=game.history,
+                   tournament=game.tournament,
+                   tournament_round=game.tournament_round)
+
+    @classmethod
+    def key_for(cls, game_key):
+        """Return the key of the summary of a Game"""
+        return ndb.Key(cls, game_key.id())
+
+    def to_game(self):
+        """Return the finished Game the summary replaces, for reading only"""
+        game = Game.new_game(self.player_1_name, self.player_2_name,
+                             id=self.key.id(), tournament=self.tournament,
+                             tournament_round=self.tournament_round)
+        game.player_1_round_score = self.player_1_round_score
+        game.player_2_round_score = self.player_2_round_score
+        game.round = self.round
+        game.is_active = False
+        game.round_result = self.round_result
+        game.history = self.history
+        for player_1_move, player_2_move in game.get_history():
+            for player, move in ((1, player_1_move), (2, player_2_move)):
+                attr = 'player_{}_{}'.format(player, move)
+                setattr(game, attr, getattr(game, attr) - 1)
+        return game
+
+
+class Tournament(ndb.Model):
+    """Tournament between registered players, played in rounds of games"""
+    name = ndb.StringProperty(required=True)
+    players = ndb.StringProperty(repeated=True, indexed=False)
+    pairing = ndb.StringProperty(choices=['round_robin', 'swiss'])
+    rounds = ndb.IntegerProperty()  # Number of rounds in the tournament
+    round = ndb.IntegerProperty()  # Current round, starting from 1
+    round_created = ndb.BooleanProperty()
+    # True once every game of the current round has been created
+    round_started = ndb.DateTimeProperty(indexed=False)
+    # When the current round was created, which starts its deadline
+    byes = ndb.StringProperty(repeated=True, indexed=False)
+    # Players who sat out a round of a swiss tournament, scored as a win
+    is_active = ndb.BooleanProperty()
+
+    def to_form(self, standings=None):
+        """Return a TournamentForm, with standings as a list of
+        (name, win, lose, draw) tuples in ranking order if given"""
+        return TournamentForm(
+            urlsafe_key=self.key.urlsafe(),
+            name=self.name,
+            pairing=self.pairing,
+            players=len(self.players),
+            rounds=self.rounds,
+            round=self.round,
+            is_active=self.is_active,
+            standings=[StandingForm(name=name, win=win, lose=lose, draw=draw)
+                       for name, win, lose, draw in standings or []])
 
 
 class UserScores(ndb.Model):
@@ -48,6 +280,36 @@ class UserScores(ndb.Model):
     score = ndb.IntegerProperty() # Number of winning round in game
 
 
+class StatsShard(ndb.Model):
+    """Partial sums of the global game statistics. See stats.py."""
+    sums = ndb.JsonProperty()  # As stats.new_sums()
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class StatsSnapshot(ndb.Model):
+    """Global game statistics summed from the StatsShards by stats.get(),
+    and cached in memcache"""
+    games = ndb.IntegerProperty(indexed=False)  # Number of finished games
+    average_rounds = ndb.FloatProperty(indexed=False)  # Rounds per game
+    draw_rate = ndb.FloatProperty(indexed=False)  # Drawn per finished games
+    # Per round, the number of times each of MOVES was played
+    move_frequency = ndb.JsonProperty()
+    average_score = ndb.FloatProperty(indexed=False)  # Round score per player
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    def to_form(self):
+        """Returns a StatsForm representation of the snapshot"""
+        rounds = [RoundFrequencyForm(round=i + 1, **dict(
+                      (move, count) for move, count in zip(MOVES, counts)))
+                  for i, counts in enumerate(self.move_frequency or [])]
+        return StatsForm(games=self.games,
+                         average_rounds=self.average_rounds,
+                         draw_rate=self.draw_rate,
+                         average_score=self.average_score,
+                         move_frequency=rounds,
+                         updated=str(self.updated))
+
+
 class PlayerMoves(ndb.Model):
     """Record player's move play in round"""
     player_1_move = ndb.StringProperty()  # Player_1's move
@@ -55,11 +317,204 @@ class PlayerMoves(ndb.Model):
     round = ndb.IntegerProperty()  # Number of rounds played in the game
 
 
+class MoveEvent(ndb.Model):
+    """Append-only record of a move or cancellation of a Game, a child of
+    the Game keyed by events.game_seq() after it. See movelog.py."""
+    kind = ndb.StringProperty(choices=['move', 'cancel'], default='move',
+                              indexed=False)
+    player = ndb.IntegerProperty(indexed=False)  # 0 (player_1) or 1
+    move = ndb.IntegerProperty(indexed=False)  # Index into MOVES
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class GameSnapshot(ndb.Model):
+    """engine.GameState of a Game after a round, a child of the Game keyed
+    by the round. See movelog.py."""
+    cards = ndb.IntegerProperty(repeated=True, indexed=False)
+    # player_1's then player_2's rock, paper and scissors cards
+    scores = ndb.IntegerProperty(repeated=True, indexed=False)
+    history = ndb.IntegerProperty(indexed=False)  # As Game.history
+
+
+class ExportJob(ndb.Model):
+    """Checkpoint of a bulk export, keyed by the name of the job. See
+    export.py."""
+    format = ndb.StringProperty(choices=['ndjson', 'csv'], indexed=False)
+    destination = ndb.StringProperty(indexed=False)
+    # gs://bucket/path, or a local directory
+    kinds = ndb.StringProperty(repeated=True, indexed=False)
+    # Kinds left to export, the one being exported first
+    cursor = ndb.StringProperty(indexed=False)  # urlsafe Cursor in kinds[0]
+    part = ndb.IntegerProperty(indexed=False)  # Next part file of kinds[0]
+    rows = ndb.JsonProperty()  # Number of rows written per kind
+    is_done = ndb.BooleanProperty(indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    def status(self):
+        """Returns the progress of the job as a dict for JSON"""
+        return {'name': self.key.id(),
+                'format': self.format,
+                'destination': self.destination,
+                'kinds': self.kinds,
+                'part': self.part,
+                'rows': self.rows,
+                'is_done': self.is_done,
+                'started': str(self.started),
+                'updated': str(self.updated)}
+
+
+class StatsRepairShard(ndb.Model):
+    """Checkpoint and drift found of one range of Users in a repair of the
+    user results, a child of the key of the job. See userstats.py."""
+    start = ndb.StringProperty(indexed=False)
+    # Name of the first User of the range, None from the first User
+    end = ndb.StringProperty(indexed=False)
+    # Name after the last User of the range, None up to the last User
+    cursor = ndb.StringProperty(indexed=False)  # urlsafe Cursor in the range
+    users = ndb.IntegerProperty(indexed=False, default=0)  # Users checked
+    skipped = ndb.IntegerProperty(indexed=False, default=0)
+    # Users not checked because a game of theirs finished while counted
+    corrected = ndb.IntegerProperty(indexed=False, default=0)
+    drift = ndb.IntegerProperty(indexed=False, default=0)
+    # Sum of the differences of the win, lose and draw counts corrected
+    is_done = ndb.BooleanProperty(indexed=False, default=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     message = messages.StringField(1, required=True)
 
 
+class GameForm(messages.Message):
+    """GameForm -- outbound form of a Game's state"""
+    urlsafe_key = messages.StringField(1, required=True)
+    player_1_name = messages.StringField(2, required=True)
+    player_2_name = messages.StringField(3, required=True)
+    player_1_cards = messages.IntegerField(4, repeated=True)
+    # Number of Player1's rock, paper and scissors cards
+    player_2_cards = messages.IntegerField(5, repeated=True)
+    # Number of Player2's rock, paper and scissors cards
+    player_1_round_score = messages.IntegerField(6)
+    player_2_round_score = messages.IntegerField(7)
+    round = messages.IntegerField(8)
+    is_active = messages.BooleanField(9)
+    round_result = messages.StringField(10)
+    game_result = messages.StringField(11)  # Only set by play_game
+
+
+class RoundForm(messages.Message):
+    """RoundForm -- outbound form of the moves played in a round"""
+    round = messages.IntegerField(1, required=True)
+    player_1_move = messages.StringField(2)
+    player_2_move = messages.StringField(3)
+
+
+class HistoryForm(messages.Message):
+    """HistoryForm -- outbound form of the moves played in a Game"""
+    urlsafe_key = messages.StringField(1, required=True)
+    player_1_name = messages.StringField(2, required=True)
+    player_2_name = messages.StringField(3, required=True)
+    rounds = messages.MessageField(RoundForm, 4, repeated=True)
+
+
+class UserRankForm(messages.Message):
+    """UserRankForm -- outbound form of a User's results"""
+    name = messages.StringField(1, required=True)
+    winning_rate = messages.FloatField(2)
+    win = messages.IntegerField(3)
+    lose = messages.IntegerField(4)
+    draw = messages.IntegerField(5)
+    rank = messages.IntegerField(6)  # Only set by get_user_rank
+
+
+class UserRankForms(messages.Message):
+    """UserRankForms -- outbound page of the User rankings"""
+    users = messages.MessageField(UserRankForm, 1, repeated=True)
+    cursor = messages.StringField(2)  # Cursor of the next page, if any
+
+
+class MoveForm(messages.Message):
+    """MoveForm -- inbound form of one move of a batch"""
+    game_key = messages.StringField(1, required=True)
+    player_name = messages.StringField(2, required=True)
+    move = messages.StringField(3, required=True)
+
+
+class MoveForms(messages.Message):
+    """MoveForms -- inbound batch of moves"""
+    moves = messages.MessageField(MoveForm, 1, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+    """MoveResultForm -- outbound result of one move of a batch"""
+    game_key = messages.StringField(1, required=True)
+    player_name = messages.StringField(2, required=True)
+    ok = messages.BooleanField(3, required=True)
+    message = messages.StringField(4)  # Game result, or why the move failed
+
+
+class MoveResultForms(messages.Message):
+    """MoveResultForms -- outbound results of a batch of moves"""
+    results = messages.MessageField(MoveResultForm, 1, repeated=True)
+
+
+class StandingForm(messages.Message):
+    """StandingForm -- outbound form of a player's tournament results"""
+    name = messages.StringField(1, required=True)
+    win = messages.IntegerField(2)
+    lose = messages.IntegerField(3)
+    draw = messages.IntegerField(4)
+
+
+class TournamentForm(messages.Message):
+    """TournamentForm -- outbound form of a Tournament"""
+    urlsafe_key = messages.StringField(1, required=True)
+    name = messages.StringField(2, required=True)
+    pairing = messages.StringField(3)
+    players = messages.IntegerField(4)  # Number of players
+    rounds = messages.IntegerField(5)
+    round = messages.IntegerField(6)
+    is_active = messages.BooleanField(7)
+    standings = messages.MessageField(StandingForm, 8, repeated=True)
+
+
+class GameEventForm(messages.Message):
+    """GameEventForm -- outbound form of a game state change"""
+    seq = messages.IntegerField(1, required=True)
+    kind = messages.StringField(2, required=True)
+    message = messages.StringField(3)
+
+
+class GameEventForms(messages.Message):
+    """GameEventForms -- outbound game state changes since a seq"""
+    events = messages.MessageField(GameEventForm, 1, repeated=True)
+    seq = messages.IntegerField(2, required=True)  # Seq to wait on next
+
+
 class StringMessages(messages.Message):
     """StringMessage-- outbound (repeated) string message"""
     message = messages.StringField(1, repeated=True)
+    cursor = messages.StringField(2)  # Cursor of the next page, if any
+
+
+class RoundFrequencyForm(messages.Message):
+    """RoundFrequencyForm -- outbound number of times each card was played
+    in a round"""
+    round = messages.IntegerField(1, required=True)
+    rock = messages.IntegerField(2)
+    paper = messages.IntegerField(3)
+    scissors = messages.IntegerField(4)
+
+
+class StatsForm(messages.Message):
+    """StatsForm -- outbound global game statistics"""
+    games = messages.IntegerField(1)
+    average_rounds = messages.FloatField(2)
+    draw_rate = messages.FloatField(3)
+    average_score = messages.FloatField(4)
+    move_frequency = messages.MessageField(RoundFrequencyForm, 5,
+                                           repeated=True)
+    updated = messages.StringField(6)
@@ -0,0 +1,186 @@
+"""movelog.py - Append-only log of the moves of every Game.
+Each move is written as a MoveEvent child of its Game in the transaction
+that applies it, and every SNAPSHOT_ROUNDS rounds a GameSnapshot of the
+state is written too. Replaying the events after the nearest snapshot
+rebuilds a game as it was after any round, without reading the Game, and
+replaying the whole log repairs a Game damaged by a bad write. Games
+started before the log existed have no events and cannot be replayed."""
+
+from google.appengine.ext import ndb
+
+import engine
+import events
+from engine import MOVE_INDEX, MOVES
+from models import Game, GameSnapshot, MoveEvent, pack_history
+
+SNAPSHOT_ROUNDS = 3  # Rounds between two snapshots
+MOVE = 'move'
+CANCEL = 'cancel'
+
+
+class IncompleteLog(Exception):
+    """The game was started before its moves were logged"""
+
+
+def record(game, player_name, move):
+    """Return the entities logging a move just applied to a Game, for the
+    caller to put in the same transaction: the MoveEvent and, when the
+    move finished a round that is a multiple of SNAPSHOT_ROUNDS, a
+    GameSnapshot."""
+    seq = events.game_seq(game)
+    player = 0 if game.player_1_name == player_name else 1
+    entities = [MoveEvent(parent=game.key, id=seq, player=player,
+                          move=MOVE_INDEX[move])]
+    if seq == 2 * game.round and game.round % SNAPSHOT_ROUNDS == 0:
+        state = game.to_state()
+        entities.append(GameSnapshot(parent=game.key, id=game.round,
+                                     cards=state.cards[0] + state.cards[1],
+                                     scores=state.scores,
+                                     history=game.history))
+    return entities
+
+
+@ndb.transactional
+def cancel(game_key):
+    """Cancel an active Game and log the cancellation in one transaction,
+    so that a move finishing the game meanwhile is never overwritten. The
+    caller invalidates the cached Game and publishes the cancellation once
+    this has committed.
+    Returns:
+        The Game, or None if there is no such Game, and True if it was
+        cancelled"""
+    game = game_key.get()
+    if not game or not game.is_active:
+        return game, False
+    game.round = 9
+    game.is_active = False
+    ndb.put_multi([game, record_cancel(game)])
+    return game, True
+
+
+def record_cancel(game):
+    """Return the MoveEvent logging the cancellation of a Game, for the
+    caller to put with the cancelled Game"""
+    return MoveEvent(parent=game.key, id=events.game_seq(game), kind=CANCEL)
+
+
+def is_logged(game):
+    """False if a Game has moves but no log, as it started before the log
+    existed"""
+    return not events.game_seq(game) or \
+        MoveEvent.query(ancestor=game.key).get(keys_only=True) is not None
+
+
+def replay(game_key, round=None, use_snapshots=True):
+    """Rebuild a game from its log.
+    Args:
+        game_key: The ndb.Key of the Game
+        round: Stop after this many rounds, or None for the whole log
+        use_snapshots: Start from the nearest GameSnapshot instead of the
+            first move
+    Returns:
+        A tuple of the engine.GameState, the list of (player_1_move,
+        player_2_move) of every round played and True if the game was
+        cancelled.
+    Raises:
+        IncompleteLog: If the game has moves that were not logged"""
+    last_round = engine.ROUNDS if round is None else round
+    state = engine.GameState()
+    history = 0
+    start = 0
+    if use_snapshots:
+        rounds = range(SNAPSHOT_ROUNDS, last_round + 1, SNAPSHOT_ROUNDS)
+        snapshots = ndb.get_multi([ndb.Key(GameSnapshot, snapshot_round,
+                                           parent=game_key)
+                                   for snapshot_round in rounds])
+        for snapshot in reversed(snapshots):
+            if snapshot:
+                start = snapshot.key.id()
+                state = engine.GameState(
+                    cards=[snapshot.cards[:3], snapshot.cards[3:]],
+                    scores=list(snapshot.scores), round=start)
+                history = snapshot.history
+                break
+
+    query = MoveEvent.query(ancestor=game_key)
+    if start:
+        query = query.filter(
+            MoveEvent.key > ndb.Key(MoveEvent, 2 * start, parent=game_key))
+    if round is not None:
+        query = query.filter(
+            MoveEvent.key <= ndb.Key(MoveEvent, 2 * round, parent=game_key))
+    moves = list(_rounds_from_history(history))
+    cancelled = False
+    expected = 2 * start + 1
+    for event in query.order(MoveEvent.key).iter():
+        if event.kind == CANCEL:
+            cancelled = True
+            break
+        if event.key.id() != expected:
+            raise IncompleteLog(game_key)
+        played = list(state.moves)
+        played[event.player] = event.move
+        engine.apply_move(state, event.player, MOVES[event.move])
+        if engine.resolve_round(state) is not None:
+            moves.append((MOVES[played[0]], MOVES[played[1]]))
+        expected += 1
+    return state, moves, cancelled
+
+
+def _rounds_from_history(history):
+    while history:
+        yield (MOVES[(history & 3) - 1], MOVES[(history >> 2 & 3) - 1])
+        history >>= 4
+
+
+@ndb.transactional
+def repair(game_key):
+    """Rebuild a Game from its whole log and write it back if it differs.
+    Returns:
+        The names of the properties that were corrected, empty if the Game
+        matched its log, or None if the Game has no log to check against"""
+    game = game_key.get()
+    if not game or not is_logged(game):
+        return None
+    try:
+        state, moves, cancelled = replay(game_key, use_snapshots=False)
+    except IncompleteLog:
+        return None
+
+    expected = Game.new_game(game.player_1_name, game.player_2_name)
+    expected.apply_state(state)
+    expected.history = pack_history(moves)
+    expected.is_active = not (cancelled or engine.is_finished(state))
+    if cancelled:
+        expected.round = engine.ROUNDS
+
+    changed = [name for name in ('player_1_rock', 'player_1_paper',
+                                 'player_1_scissors', 'player_2_rock',
+                                 'player_2_paper', 'player_2_scissors',
+                                 'player_1_round_score',
+                                 'player_2_round_score', 'round',
+                                 'player_1_move', 'player_2_move',
+                                 'is_active', 'history')
+               if getattr(game, name) != getattr(expected, name)]
+    if changed:
+        for name in changed:
+            setattr(game, name, getattr(expected, name))
+        game.put()
+    return changed
+
+
+def export_page(cursor=None, batch_size=500):
+    """Return one page of the log of every game for offline analysis.
+    Returns:
+        A tuple of a list of dicts, one per event, the Cursor of the next
+        page and True if there are more events"""
+    logged, next_cursor, more = MoveEvent.query().fetch_page(
+        batch_size, start_cursor=cursor)
+    rows = [{'game': event.key.parent().urlsafe(),
+             'seq': event.key.id(),
+             'kind': event.kind,
+             'player': event.player,
+             'move': None if event.move is None else MOVES[event.move],
+             'created': event.created.isoformat()}
+            for event in logged]
+    return rows, next_cursor, more
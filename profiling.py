@@ -0,0 +1,178 @@
+"""profiling.py - Per-endpoint timings and RPC counts.
+Endpoint methods wrapped with instrument() record their wall time and the
+number of datastore and memcache RPCs they made; code inside them can time
+its phases with phase(). Samples are kept in memory and flushed to memcache
+every FLUSH_INTERVAL seconds, where percentiles() reads them for every
+instance. A fraction of requests, switchable at runtime with
+set_sample_rate(), also run under cProfile and keep their top functions."""
+
+import collections
+import contextlib
+import cProfile
+import functools
+import pstats
+import random
+import StringIO
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map, memcache
+
+FLUSH_INTERVAL = 60  # Seconds between flushes of an instance's samples
+KEEP_SAMPLES = 1000  # Most recent samples kept per metric
+KEEP_PROFILES = 10  # Most recent cProfile outputs kept
+PROFILE_LINES = 25  # Functions kept of each cProfile output
+METRICS_KEY = 'profile:metrics'  # Names of every metric flushed so far
+METRIC_KEY = 'profile:metric:{}'
+PROFILES_KEY = 'profile:profiles'
+SAMPLE_RATE_KEY = 'profile:sample_rate'
+COUNTED_SERVICES = {'datastore_v3': 'datastore_rpcs',
+                    'memcache': 'memcache_calls'}
+
+_local = threading.local()
+_lock = threading.Lock()
+_samples = collections.defaultdict(list)
+_profiles = []
+_flushed = [time.time()]
+_sample_rate = [0.0]
+
+
+def _count_rpc(service, call, request, response):
+    counts = getattr(_local, 'counts', None)
+    if counts is not None and service in COUNTED_SERVICES:
+        counts[COUNTED_SERVICES[service]] += 1
+
+
+def instrument(method):
+    """Decorate an endpoint method to record its wall time in milliseconds
+    and its datastore and memcache RPCs, as metrics named
+    '<Service>.<method>.<measure>'. Place it below @endpoints.method."""
+    @functools.wraps(method)
+    def wrapper(service, request):
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('profiling',
+                                                            _count_rpc)
+        name = '{}.{}'.format(type(service).__name__, method.__name__)
+        _local.counts = collections.Counter()
+        profiler = None
+        if _sample_rate[0] and random.random() < _sample_rate[0]:
+            profiler = cProfile.Profile()
+        start = time.time()
+        try:
+            if profiler:
+                return profiler.runcall(method, service, request)
+            return method(service, request)
+        finally:
+            record(name + '.wall_ms', (time.time() - start) * 1000)
+            for measure in COUNTED_SERVICES.values():
+                record('{}.{}'.format(name, measure), _local.counts[measure])
+            _local.counts = None
+            if profiler:
+                _keep_profile(name, profiler)
+            _maybe_flush()
+    return wrapper
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Record the wall time in milliseconds of a block as metric name"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, (time.time() - start) * 1000)
+
+
+def record(name, value):
+    """Add one sample to a metric"""
+    with _lock:
+        _samples[name].append(value)
+
+
+def take_samples():
+    """Return the samples recorded on this instance since the last flush,
+    as a dict mapping metric names to lists of values, and drop them"""
+    with _lock:
+        samples = dict(_samples)
+        _samples.clear()
+    return samples
+
+
+def _keep_profile(name, profiler):
+    out = StringIO.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+    with _lock:
+        _profiles.append('{} at {}\n{}'.format(name, time.ctime(),
+                                               out.getvalue()))
+
+
+def _maybe_flush():
+    with _lock:
+        if time.time() - _flushed[0] < FLUSH_INTERVAL:
+            return
+        samples = dict(_samples)
+        profiles = list(_profiles)
+        _samples.clear()
+        del _profiles[:]
+        _flushed[0] = time.time()
+    flush(samples, profiles)
+
+
+def flush(samples, profiles):
+    """Merge an instance's samples and cProfile outputs into memcache and
+    pick up the current sample rate. Updates lost to a concurrent flush of
+    another instance are dropped, as they are only samples."""
+    client = memcache.Client()
+    new = dict((METRIC_KEY.format(name), values)
+               for name, values in samples.items())
+    new[METRICS_KEY] = sorted(samples)
+    if profiles:
+        new[PROFILES_KEY] = profiles
+    current = client.get_multi(list(new) + [SAMPLE_RATE_KEY], for_cas=True)
+    _sample_rate[0] = current.pop(SAMPLE_RATE_KEY, 0.0)
+
+    merged = {}
+    for key, values in new.items():
+        if key == METRICS_KEY:
+            merged[key] = sorted(set(current.get(key, [])) | set(values))
+        elif key == PROFILES_KEY:
+            merged[key] = (current.get(key, []) + values)[-KEEP_PROFILES:]
+        else:
+            merged[key] = (current.get(key, []) + values)[-KEEP_SAMPLES:]
+    client.cas_multi(dict((key, value) for key, value in merged.items()
+                          if key in current))
+    client.add_multi(dict((key, value) for key, value in merged.items()
+                          if key not in current))
+
+
+def set_sample_rate(rate):
+    """Set the fraction of requests that run under cProfile. Instances pick
+    it up at their next flush."""
+    memcache.set(SAMPLE_RATE_KEY, rate)
+
+
+def percentile(values, fraction):
+    """Return the value at a fraction (0 to 1) of a sorted list"""
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def percentiles():
+    """Return the p50, p90, p99 and maximum of every flushed metric, and the
+    most recent cProfile outputs.
+    Returns:
+        A dict with a 'metrics' dict mapping each metric name to its count
+        and percentiles, and a 'profiles' list of cProfile output text."""
+    names = memcache.get(METRICS_KEY) or []
+    stored = memcache.get_multi([METRIC_KEY.format(name) for name in names])
+    metrics = {}
+    for name in names:
+        values = sorted(stored.get(METRIC_KEY.format(name)) or [])
+        if values:
+            metrics[name] = {'count': len(values),
+                             'p50': percentile(values, 0.5),
+                             'p90': percentile(values, 0.9),
+                             'p99': percentile(values, 0.99),
+                             'max': values[-1]}
+    return {'metrics': metrics,
+            'profiles': memcache.get(PROFILES_KEY) or [],
+            'sample_rate': memcache.get(SAMPLE_RATE_KEY) or 0.0}
@@ -0,0 +1,55 @@
+"""ratelimit.py - Token bucket rate limits kept in memcache, shared by every
+instance. Each bucket holds up to its burst of tokens and refills at its
+rate; a request takes one token and is throttled when none is left. The
+bucket is updated with compare-and-set, and a request is let through if
+memcache is unavailable or the bucket stays contended, since the limits
+protect the datastore but must not take the API down with memcache."""
+
+import time
+
+from google.appengine.api import memcache
+
+from utils import count, read_counts
+
+# Tokens per second and burst of each scope of limit
+LIMITS = {
+    'user': (5.0, 20),  # Game reads of one user or client address
+    'game': (50.0, 200),  # Reads of one game by every spectator
+}
+BUCKET_KEY = 'rate:{}:{}'
+CAS_RETRIES = 3
+
+
+def allow(scope, name):
+    """Take a token from a bucket.
+    Args:
+        scope: The kind of limit, one of LIMITS
+        name: What is limited, such as a user or a game
+    Returns:
+        False if the request is throttled"""
+    rate, burst = LIMITS[scope]
+    key = BUCKET_KEY.format(scope, name)
+    ttl = int(burst / rate) + 1  # A bucket left this long is full again
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        now = time.time()
+        bucket = client.gets(key)
+        if bucket is None:
+            if client.add(key, (burst - 1, now), time=ttl):
+                return True
+            continue
+        tokens, updated = bucket
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens < 1:
+            count(scope, 'throttled')
+            return False
+        if client.cas(key, (tokens - 1, now), time=ttl):
+            return True
+    return True
+
+
+def throttle_counts():
+    """Return the number of requests throttled per scope by every instance,
+    up to utils.COUNTS_FLUSH_INTERVAL seconds ago"""
+    return dict((scope, read_counts(scope, ('throttled',))[0])
+                for scope in LIMITS)
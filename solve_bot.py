@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""solve_bot.py - Offline solver of the bot's strategy table.
+Works backwards from the last round through every state a game can reach:
+for each state it builds the 3x3 matrix of the values of the states that
+each pair of moves leads to, and solves it for the mixed strategy that
+maximizes the bot's worst case value. Writes the strategies to
+bot_table.bin for bot.py.
+
+Usage:
+    python solve_bot.py [--output bot_table.bin]"""
+
+import argparse
+import array
+import itertools
+
+import bot
+import engine
+
+EPSILON = 1e-9
+
+
+def hands(cards_left):
+    """Return every hand of cards_left cards as [rock, paper, scissors]"""
+    return [list(hand) for hand in itertools.product(
+        range(engine.CARDS + 1), repeat=len(engine.MOVES))
+        if sum(hand) == cards_left]
+
+
+def final_value(score, opponent_score):
+    return (score > opponent_score) - (score < opponent_score)
+
+
+def _solve_3x3(a, b, c):
+    """Solve the linear system whose rows are a, b and c (each the three
+    coefficients and the constant), or return None if it is singular"""
+    def det(m):
+        return (m[0][0] * (m[1][1] * m[2][2] - m[1][2] * m[2][1]) -
+                m[0][1] * (m[1][0] * m[2][2] - m[1][2] * m[2][0]) +
+                m[0][2] * (m[1][0] * m[2][1] - m[1][1] * m[2][0]))
+    rows = [a, b, c]
+    matrix = [row[:3] for row in rows]
+    d = det(matrix)
+    if abs(d) < EPSILON:
+        return None
+    solution = []
+    for i in range(3):
+        replaced = [row[:i] + [row[3]] + row[i + 1:3] for row in rows]
+        solution.append(det(replaced) / d)
+    return solution
+
+
+def maximin(matrix, rows, columns):
+    """Return the value and the mixed strategy (one probability per move)
+    of the row player of a zero-sum game that maximize its worst case.
+    The worst case is a concave piecewise linear function on the simplex
+    of strategies, so its maximum is at a vertex of the simplex, at a
+    point of an edge where two columns are equal, or at a point inside
+    where three columns are equal. Every such point is tried.
+    Args:
+        matrix: matrix[row][column] is the row player's value
+        rows: The moves the row player has cards for
+        columns: The moves the column player has cards for"""
+    candidates = []
+    for row in rows:
+        candidates.append([float(i == row) for i in range(3)])
+    for first, second in itertools.combinations(rows, 2):
+        for j, k in itertools.combinations(columns, 2):
+            # t * first + (1 - t) * second makes columns j and k equal
+            slope = (matrix[first][j] - matrix[first][k]) - \
+                (matrix[second][j] - matrix[second][k])
+            if abs(slope) > EPSILON:
+                t = -(matrix[second][j] - matrix[second][k]) / slope
+                if -EPSILON <= t <= 1 + EPSILON:
+                    point = [0.0] * 3
+                    point[first], point[second] = t, 1 - t
+                    candidates.append(point)
+    if len(rows) == 3 and len(columns) == 3:
+        point = _solve_3x3(
+            [matrix[i][0] - matrix[i][1] for i in range(3)] + [0.0],
+            [matrix[i][0] - matrix[i][2] for i in range(3)] + [0.0],
+            [1.0, 1.0, 1.0, 1.0])
+        if point and min(point) >= -EPSILON:
+            candidates.append(point)
+
+    best = None
+    for point in candidates:
+        point = [max(p, 0.0) for p in point]
+        total = sum(point)
+        point = [p / total for p in point]
+        value = min(sum(point[i] * matrix[i][j] for i in rows)
+                    for j in columns)
+        if best is None or value > best[0] + EPSILON:
+            best = (value, point)
+    return best
+
+
+def solve():
+    """Return the strategy table as an array for bot.load_table"""
+    table = array.array('B', [0] * (2 * bot.STATES))
+    values = {}
+    moves = range(len(engine.MOVES))
+    for cards_left in range(1, engine.ROUNDS + 1):
+        round = engine.ROUNDS - cards_left
+        for cards, opponent_cards in itertools.product(hands(cards_left),
+                                                       repeat=2):
+            for score, opponent_score in itertools.product(
+                    range(bot.SCORES), repeat=2):
+                if score + opponent_score > round:
+                    continue
+                matrix = [[0.0] * 3 for _ in moves]
+                for move, opponent_move in itertools.product(moves, repeat=2):
+                    if not cards[move] or not opponent_cards[opponent_move]:
+                        continue
+                    winner = engine.OUTCOME[move][opponent_move]
+                    state = engine.GameState(
+                        cards=[list(cards), list(opponent_cards)],
+                        scores=[score + (winner == engine.PLAYER_1_WINS),
+                                opponent_score +
+                                (winner == engine.PLAYER_2_WINS)],
+                        round=round + 1)
+                    state.cards[0][move] -= 1
+                    state.cards[1][opponent_move] -= 1
+                    if engine.is_finished(state):
+                        value = final_value(*state.scores)
+                    else:
+                        value = values[bot.state_index(
+                            state.cards[0], state.cards[1], *state.scores)]
+                    matrix[move][opponent_move] = value
+
+                value, point = maximin(
+                    matrix, [move for move in moves if cards[move]],
+                    [move for move in moves if opponent_cards[move]])
+                index = bot.state_index(cards, opponent_cards, score,
+                                        opponent_score)
+                values[index] = value
+                rock = round_half_up(point[0] * bot.SCALE)
+                paper = min(round_half_up(point[1] * bot.SCALE),
+                            bot.SCALE - rock)
+                table[2 * index], table[2 * index + 1] = rock, paper
+    return table, values
+
+
+def round_half_up(value):
+    return int(value + 0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', default=bot.TABLE_FILE)
+    args = parser.parse_args()
+    table, values = solve()
+    with open(args.output, 'wb') as output:
+        table.tofile(output)
+    print('Solved {} states, value of the first round {:.4f}, written to '
+          '{}'.format(len(values), values[bot.state_index(
+              [engine.CARDS] * 3, [engine.CARDS] * 3, 0, 0)], args.output))
+
+
+if __name__ == '__main__':
+    main()
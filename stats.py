@@ -0,0 +1,167 @@
+"""stats.py - Global game statistics kept up to date as games finish.
+The transaction that finishes a game adds it to one of SHARDS StatsShards of
+partial sums, chosen at random so that games finishing at once rarely
+contend. Reading the statistics sums the shards, cached in memcache for
+STATS_TTL. The /tasks/cache_average_attempts task, run daily by a cron job,
+repairs the sums: it scans the finished and archived games, writes the
+totals to the base shard and drops the others.
+Cancelled games are not counted."""
+
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import counters
+import engine
+from engine import MOVE_INDEX
+from models import Game, GameSummary, StatsShard, StatsSnapshot
+
+STATS_KEY = 'stats'
+STATS_TTL = 60  # Seconds the summed statistics are cached
+SHARDS = 20  # Shards games finishing are added to, besides the base
+BASE_ID = 'base'  # Shard of the sums of the last full scan
+QUERY_BATCH_SIZE = 500
+TASK_URL = '/tasks/cache_average_attempts'
+
+
+def new_sums():
+    """Return partial sums of no games"""
+    return {'games': 0, 'rounds': 0, 'draws': 0,
+            'moves': [[0] * len(engine.MOVES) for _ in range(engine.ROUNDS)],
+            'scores': 0, 'score_sum': 0}
+
+
+def new_state():
+    """Return the partial sums of a scan that has not started yet"""
+    state = new_sums()
+    state.update(phase='games', cursor=None)
+    return state
+
+
+def shard_keys():
+    """Return the keys of the base shard and of every other shard"""
+    return [ndb.Key(StatsShard, BASE_ID)] + \
+        [ndb.Key(StatsShard, 'shard-{}'.format(i)) for i in range(SHARDS)]
+
+
+@ndb.tasklet
+def add_game_async(game):
+    """Add a game that has just finished to a random shard. Call inside the
+    transaction that finishes the game.
+    Returns:
+        The changed StatsShard, for the caller to put with the game."""
+    key = random.choice(shard_keys()[1:])
+    shard = yield key.get_async()
+    if not shard:
+        shard = StatsShard(key=key, sums=new_sums())
+    _add_game(shard.sums, game)
+    raise ndb.Return(shard)
+
+
+def scan(state, deadline):
+    """Add finished Games, then archived GameSummaries, to the partial
+    sums until the scan is complete or the deadline (a time.time()
+    value) has passed.
+    Returns:
+        True when the scan is complete."""
+    while state['phase'] == 'games':
+        if time.time() > deadline:
+            return False
+        games, cursor, more = Game.query(Game.is_active == False).fetch_page(
+            QUERY_BATCH_SIZE, start_cursor=_cursor(state))
+        for game in games:
+            _add_game(state, game)
+        _advance(state, 'summaries', cursor, more)
+
+    while state['phase'] == 'summaries':
+        if time.time() > deadline:
+            return False
+        summaries, cursor, more = GameSummary.query().fetch_page(
+            QUERY_BATCH_SIZE, start_cursor=_cursor(state))
+        for summary in summaries:
+            _add_game(state, summary.to_game())
+        _advance(state, 'done', cursor, more)
+    return True
+
+
+def _cursor(state):
+    return Cursor(urlsafe=state['cursor']) if state['cursor'] else None
+
+
+def _advance(state, next_phase, cursor, more):
+    if more and cursor:
+        state['cursor'] = cursor.urlsafe()
+    else:
+        state['phase'], state['cursor'] = next_phase, None
+
+
+def _add_game(state, game):
+    if counters.outcome(game) is None:
+        return  # Cancelled before the end
+    state['games'] += 1
+    state['scores'] += 2
+    state['score_sum'] += game.player_1_round_score + \
+        game.player_2_round_score
+    if game.player_1_round_score == game.player_2_round_score:
+        state['draws'] += 1
+    if game.history is None:
+        # Older games keep their moves in PlayerMoves; only count rounds
+        state['rounds'] += game.round
+        return
+    moves = game.get_history()
+    state['rounds'] += len(moves)
+    for counts, (player_1_move, player_2_move) in zip(state['moves'], moves):
+        counts[MOVE_INDEX[player_1_move]] += 1
+        counts[MOVE_INDEX[player_2_move]] += 1
+
+
+@ndb.transactional(xg=True)
+def save(state):
+    """Replace the sums by those of a complete scan: write them to the base
+    shard and delete the other shards, whose games the scan has counted.
+    A game finishing after the scan passed it is dropped with them, and
+    counted again by the next scan."""
+    sums = dict((name, state[name]) for name in new_sums())
+    keys = shard_keys()
+    ndb.delete_multi(keys[1:])
+    StatsShard(key=keys[0], sums=sums).put()
+    memcache.delete(STATS_KEY)
+
+
+def get():
+    """Return a StatsSnapshot of the sums of every shard, or None if no
+    game has been counted yet"""
+    snapshot = memcache.get(STATS_KEY)
+    if snapshot is None:
+        shards = [shard for shard in ndb.get_multi(shard_keys()) if shard]
+        if not shards:
+            return None
+        sums = new_sums()
+        for shard in shards:
+            _merge(sums, shard.sums)
+        snapshot = _snapshot(sums, max(shard.updated for shard in shards))
+        memcache.add(STATS_KEY, snapshot, time=STATS_TTL)
+    return snapshot
+
+
+def _merge(sums, other):
+    for name in ('games', 'rounds', 'draws', 'scores', 'score_sum'):
+        sums[name] += other[name]
+    for counts, other_counts in zip(sums['moves'], other['moves']):
+        for i, count in enumerate(other_counts):
+            counts[i] += count
+
+
+def _snapshot(sums, updated):
+    games = sums['games']
+    return StatsSnapshot(
+        games=games,
+        average_rounds=float(sums['rounds']) / games if games else 0.0,
+        draw_rate=float(sums['draws']) / games if games else 0.0,
+        move_frequency=sums['moves'],
+        average_score=(float(sums['score_sum']) / sums['scores']
+                       if sums['scores'] else 0.0),
+        updated=updated)
@@ -0,0 +1,51 @@
+"""base.py - Common setup of the tests, which run against the App Engine
+testbed stubs like loadtest.py. Run them from the root of the repository
+with the path of the App Engine Python SDK in APPENGINE_SDK:
+    APPENGINE_SDK=~/google_appengine python -m unittest discover tests"""
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import loadtest  # noqa: E402
+
+SDK = os.path.expanduser(os.environ.get('APPENGINE_SDK',
+                                        '~/google_appengine'))
+loadtest.add_sdk(SDK)
+
+from google.appengine.ext import ndb, testbed  # noqa: E402
+
+
+class TestCase(unittest.TestCase):
+    """Runs each test with fresh datastore, memcache, mail and taskqueue
+    stubs, signed in as loadtest.EMAIL"""
+
+    def setUp(self):
+        self.testbed = loadtest.activate_testbed(SDK)
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def tasks(self, url=None):
+        """Return the tasks enqueued, those of a url if one is given"""
+        stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        return stub.get_filtered_tasks(url=url)
+
+    def call(self, method, container, **fields):
+        """Call an endpoint method as a request of its own, with an empty
+        in-context cache, like loadtest.run does"""
+        ndb.get_context().clear_cache()
+        return method(container.combined_message_class(**fields))
+
+    def create_users(self, *names):
+        """Create a User of each name, with loadtest.EMAIL"""
+        from models import User
+        users = [User(id=name, name=name, email=loadtest.EMAIL,
+                      winning_rate=0, win=0, lose=0, draw=0)
+                 for name in names]
+        ndb.put_multi(users)
+        return users
@@ -0,0 +1,32 @@
+"""test_counters.py - Sharded result counters of Users"""
+
+import base
+from google.appengine.ext import ndb
+
+import counters
+from models import User, UserStatsShard
+
+
+class RefreshTest(base.TestCase):
+    def setUp(self):
+        super(RefreshTest, self).setUp()
+        self.create_users('a')
+        UserStatsShard(key=counters.shard_keys('a')[0], win=2, lose=1,
+                       draw=0).put()
+
+    def test_refreshing_twice_in_a_request_counts_shards_once(self):
+        first = counters.get_users_async(['a']).get_result()[0]
+        second = counters.get_users_async(['a']).get_result()[0]
+        third = counters.refresh([User.get_by_id('a')])[0]
+        for user in (first, second, third):
+            self.assertEqual((user.win, user.lose, user.draw), (2, 1, 0))
+        self.assertEqual(User.get_by_id('a').win, 0)
+
+    def test_rollup_moves_shards_into_the_user(self):
+        counters.rollup_async('a').get_result()
+        ndb.get_context().clear_cache()
+        user = User.get_by_id('a')
+        self.assertEqual((user.win, user.lose, user.draw), (2, 1, 0))
+        self.assertAlmostEqual(user.winning_rate, 2.0 / 3)
+        self.assertEqual(ndb.get_multi(counters.shard_keys('a')),
+                         [None] * counters.SHARDS)
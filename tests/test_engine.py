@@ -0,0 +1,140 @@
+"""test_engine.py - Rules of the game. These tests need no App Engine SDK
+and also run on their own:
+    python tests/test_engine.py"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import engine  # noqa: E402
+from engine import PAPER, ROCK, SCISSORS  # noqa: E402
+
+
+def play_deck(deck_1, deck_2):
+    """Play two decks of move indexes with apply_move and resolve_round
+    until the game is finished.
+    Returns:
+        The final GameState"""
+    state = engine.GameState()
+    for move_1, move_2 in zip(deck_1, deck_2):
+        engine.apply_move(state, 0, engine.MOVES[move_1])
+        engine.apply_move(state, 1, engine.MOVES[move_2])
+        engine.resolve_round(state)
+        if engine.is_finished(state):
+            break
+    return state
+
+
+class RulesTest(unittest.TestCase):
+    def test_outcome(self):
+        beats = {ROCK: SCISSORS, PAPER: ROCK, SCISSORS: PAPER}
+        for move_1 in engine.MOVES:
+            for move_2 in engine.MOVES:
+                winner = engine.OUTCOME[engine.MOVE_INDEX[move_1]][
+                    engine.MOVE_INDEX[move_2]]
+                if move_1 == move_2:
+                    self.assertEqual(winner, engine.DRAW)
+                elif beats[move_1] == move_2:
+                    self.assertEqual(winner, engine.PLAYER_1_WINS)
+                else:
+                    self.assertEqual(winner, engine.PLAYER_2_WINS)
+
+    def test_apply_move_takes_a_card(self):
+        state = engine.GameState()
+        engine.apply_move(state, 1, PAPER)
+        self.assertEqual(state.cards, [[3, 3, 3], [3, 2, 3]])
+        self.assertEqual(state.moves, [None, 1])
+
+    def test_apply_move_rejects_illegal_moves(self):
+        state = engine.GameState(cards=[[0, 3, 3], [3, 3, 3]])
+        with self.assertRaises(engine.UnknownCard):
+            engine.apply_move(state, 0, 'lizard')
+        with self.assertRaises(engine.NoCardLeft):
+            engine.apply_move(state, 0, ROCK)
+        engine.apply_move(state, 0, PAPER)
+        with self.assertRaises(engine.AlreadyMoved) as raised:
+            engine.apply_move(state, 0, SCISSORS)
+        self.assertEqual(raised.exception.move, PAPER)
+        self.assertEqual(state.cards[0], [0, 2, 3])
+
+    def test_resolve_round_waits_for_both_players(self):
+        state = engine.GameState()
+        engine.apply_move(state, 0, ROCK)
+        self.assertIsNone(engine.resolve_round(state))
+        self.assertEqual((state.round, state.moves), (0, [0, None]))
+
+    def test_resolve_round_scores_and_clears_the_moves(self):
+        state = engine.GameState()
+        engine.apply_move(state, 0, ROCK)
+        engine.apply_move(state, 1, PAPER)
+        self.assertEqual(engine.resolve_round(state), engine.PLAYER_2_WINS)
+        self.assertEqual((state.scores, state.round, state.moves),
+                         ([0, 1], 1, [None, None]))
+        engine.apply_move(state, 0, ROCK)
+        engine.apply_move(state, 1, ROCK)
+        self.assertEqual(engine.resolve_round(state), engine.DRAW)
+        self.assertEqual((state.scores, state.round), ([0, 1], 2))
+
+    def test_is_finished(self):
+        self.assertFalse(engine.is_finished(engine.GameState()))
+        self.assertFalse(engine.is_finished(
+            engine.GameState(scores=[4, 4], round=8)))
+        self.assertTrue(engine.is_finished(
+            engine.GameState(scores=[5, 0], round=5)))
+        self.assertTrue(engine.is_finished(
+            engine.GameState(scores=[3, 3], round=engine.ROUNDS)))
+
+    def test_game_ends_at_the_winning_score(self):
+        rock, paper, scissors = range(3)
+        deck_1 = [rock, rock, rock, paper, paper, paper, scissors, scissors,
+                  scissors]
+        deck_2 = [scissors, scissors, scissors, rock, rock, rock, paper,
+                  paper, paper]
+        state = play_deck(deck_1, deck_2)
+        self.assertEqual((state.scores, state.round), ([5, 0], 5))
+
+
+@unittest.skipIf(engine.numpy is None, 'numpy is not installed')
+class PlayDecksTest(unittest.TestCase):
+    def check(self, decks_1, decks_2):
+        scores_1, scores_2, rounds = engine.play_decks(decks_1, decks_2)
+        for i, (deck_1, deck_2) in enumerate(zip(decks_1, decks_2)):
+            state = play_deck(deck_1, deck_2)
+            self.assertEqual(
+                (scores_1[i], scores_2[i], rounds[i]),
+                (state.scores[0], state.scores[1], state.round),
+                'decks {} and {}'.format(list(deck_1), list(deck_2)))
+
+    def test_agrees_with_resolve_round_on_random_decks(self):
+        random_state = engine.numpy.random.RandomState(1)
+        self.check(engine.random_decks(2000, random_state),
+                   engine.random_decks(2000, random_state))
+
+    def test_all_draws_play_every_round(self):
+        deck = [0, 1, 2] * engine.CARDS
+        self.check([deck], [deck])
+        _, _, rounds = engine.play_decks([deck], [deck])
+        self.assertEqual(rounds[0], engine.ROUNDS)
+
+    def test_stops_at_the_round_a_player_wins(self):
+        rock, paper, scissors = range(3)
+        deck_1 = [rock] * 3 + [paper] * 3 + [scissors] * 3
+        deck_2 = [scissors] * 3 + [rock] * 3 + [paper] * 3
+        self.check([deck_1, deck_2], [deck_2, deck_1])
+        scores_1, scores_2, rounds = engine.play_decks([deck_1, deck_2],
+                                                       [deck_2, deck_1])
+        self.assertEqual(list(rounds), [5, 5])
+        self.assertEqual((list(scores_1), list(scores_2)), ([5, 0], [0, 5]))
+
+    def test_random_decks_are_full_hands(self):
+        decks = engine.random_decks(50)
+        self.assertEqual(decks.shape, (50, engine.ROUNDS))
+        for deck in decks:
+            self.assertEqual(sorted(deck), [0, 0, 0, 1, 1, 1, 2, 2, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
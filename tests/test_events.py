@@ -0,0 +1,144 @@
+"""test_events.py - Game events published to waiting clients, through the
+memcache and the in-process brokers"""
+
+import threading
+
+import base
+from google.appengine.ext import ndb
+
+import endpoints
+
+import api
+import bot
+import events
+import movelog
+from models import Game, MoveEvent
+
+
+class BrokerTests(object):
+    """Tests every broker passes, mixed into a TestCase with a broker"""
+
+    def setUp(self):
+        super(BrokerTests, self).setUp()
+        self.broker = self.new_broker()
+        self.key = ndb.Key(Game, 1)
+
+    def test_wait_returns_the_events_after_since(self):
+        self.broker.publish(self.key, 1, [(events.MOVED, 'a')])
+        self.broker.publish(self.key, 2, [(events.MOVED, 'b'),
+                                          (events.ROUND, 'c')])
+        self.assertEqual(self.broker.wait(self.key, 1, 0),
+                         [(2, events.MOVED, 'b'), (2, events.ROUND, 'c')])
+
+    def test_wait_times_out_empty(self):
+        self.broker.publish(self.key, 1, [(events.MOVED, 'a')])
+        self.assertEqual(self.broker.wait(self.key, 1, 0.01), [])
+        self.assertEqual(self.broker.wait(ndb.Key(Game, 2), 0, 0.01), [])
+
+    def test_publish_wakes_a_waiting_subscriber(self):
+        found = []
+        waiter = threading.Thread(
+            target=lambda: found.extend(self.broker.wait(self.key, 0, 10)))
+        waiter.start()
+        self.broker.publish(self.key, 1, [(events.MOVED, 'a')])
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(found, [(1, events.MOVED, 'a')])
+
+    def test_keeps_the_latest_events(self):
+        for seq in range(1, events.KEEP_EVENTS + 6):
+            self.broker.publish(self.key, seq, [(events.MOVED, '')])
+        seqs = [event[0] for event in self.broker.wait(self.key, 0, 0)]
+        self.assertEqual(seqs, range(6, events.KEEP_EVENTS + 6))
+
+    def test_events_of_a_seq_keep_their_order(self):
+        self.broker.publish(self.key, 1, [(events.MOVED, 'a')])
+        self.broker.publish(self.key, 2, [(events.MOVED, 'b'),
+                                          (events.ROUND, 'c'),
+                                          (events.FINISHED, 'd')])
+        self.assertEqual([event[1] for event in
+                          self.broker.wait(self.key, 1, 0)],
+                         [events.MOVED, events.ROUND, events.FINISHED])
+
+
+class LocalBrokerTest(BrokerTests, base.TestCase):
+    new_broker = events.LocalBroker
+
+
+class MemcacheBrokerTest(BrokerTests, base.TestCase):
+    new_broker = events.MemcacheBroker
+
+    def test_events_published_out_of_order_are_sorted_by_seq(self):
+        self.broker.publish(self.key, 1, [(events.MOVED, 'a')])
+        self.broker.publish(self.key, 3, [(events.FINISHED, 'c')])
+        self.broker.publish(self.key, 2, [(events.ROUND, 'b')])
+        self.assertEqual([event[:2] for event in
+                          self.broker.wait(self.key, 0, 0)],
+                         [(1, events.MOVED), (2, events.ROUND),
+                          (3, events.FINISHED)])
+
+
+class GameSeqTest(base.TestCase):
+    def setUp(self):
+        super(GameSeqTest, self).setUp()
+        self.broker, events.broker = events.broker, events.LocalBroker()
+        self.create_users('a', 'b')
+        self.v1 = api.LimitedRPSApi()
+        self.v2 = api.LimitedRPSApiV2()
+
+    def tearDown(self):
+        events.broker = self.broker
+        super(GameSeqTest, self).tearDown()
+
+    def play(self, key, player_name, move):
+        return self.call(self.v2.play_game, api.PLAY_GAME_REQUEST,
+                         game_key=key, player_name=player_name, move=move)
+
+    def seqs(self, key):
+        return [event[0] for event in events.wait(ndb.Key(urlsafe=key), 0, 0)]
+
+    def test_bot_moves_follow_the_player_move(self):
+        key = self.call(self.v2.create_game, api.CREATE_GAME_REQUEST,
+                        player_1_name='a',
+                        player_2_name=bot.BOT_NAME).urlsafe_key
+        for move in ('rock', 'paper', 'scissors'):
+            game = self.play(key, 'a', move)
+        seqs = self.seqs(key)
+        self.assertEqual(sorted(set(seqs)), range(1, 2 * game.round + 1))
+        self.assertEqual(seqs, sorted(seqs))
+
+    def test_cancellation_comes_after_every_move(self):
+        key = self.call(self.v2.create_game, api.CREATE_GAME_REQUEST,
+                        player_1_name='a', player_2_name='b').urlsafe_key
+        self.play(key, 'a', 'rock')
+        self.play(key, 'b', 'paper')
+        self.play(key, 'a', 'rock')
+        self.call(self.v1.cancel_game, api.GET_GAME_REQUEST, game_key=key)
+
+        found = events.wait(ndb.Key(urlsafe=key), 0, 0)
+        self.assertEqual(found[-1][1], events.CANCELLED)
+        self.assertGreater(found[-1][0], max(seq for seq, _, _ in found[:-1]))
+        self.assertEqual([event[0] for event in found],
+                         sorted(event[0] for event in found))
+
+    def test_cancel_leaves_a_finished_game_and_its_log(self):
+        key = self.call(self.v2.create_game, api.CREATE_GAME_REQUEST,
+                        player_1_name='a', player_2_name='b').urlsafe_key
+        self.play(key, 'a', 'rock')
+        self.play(key, 'b', 'paper')
+        # Finished by a move that committed after the game was last read
+        game = ndb.Key(urlsafe=key).get()
+        game.player_2_round_score = 5
+        game.is_active = False
+        game.put()
+
+        with self.assertRaises(endpoints.ConflictException):
+            self.call(self.v1.cancel_game, api.GET_GAME_REQUEST,
+                      game_key=key)
+        ndb.get_context().clear_cache()
+        self.assertEqual(ndb.Key(urlsafe=key).get().round, 1)
+        kinds = [event.kind for event in
+                 MoveEvent.query(ancestor=ndb.Key(urlsafe=key))]
+        self.assertNotIn(movelog.CANCEL, kinds)
+        self.assertNotEqual(events.wait(ndb.Key(urlsafe=key), 0, 0)[-1][1],
+                            events.CANCELLED)
@@ -0,0 +1,105 @@
+"""test_export.py - Bulk export of the games to part files"""
+
+import csv
+import json
+import os
+import shutil
+import tempfile
+
+import base
+
+import export
+from engine import PAPER, ROCK, SCISSORS
+from models import Game, GameSummary, UserScores, pack_history
+
+MOVES = [(ROCK, SCISSORS), (PAPER, PAPER)]
+
+
+def played_game(player_1_name, player_2_name):
+    """Put a Game whose players have played MOVES"""
+    game = Game.new_game(player_1_name, player_2_name)
+    game.history = pack_history(MOVES)
+    game.round = len(MOVES)
+    game.put()
+    return game
+
+
+class ExportTest(base.TestCase):
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for name in ('PART_ROWS', 'QUERY_BATCH_SIZE'):
+            self.addCleanup(setattr, export, name, getattr(export, name))
+
+    def start(self, format, kinds):
+        """Start a job to the temporary directory, whose tasks the test
+        runs itself"""
+        job = export.start(format, kinds, self.directory)
+        self.assertEqual(len(self.tasks(export.TASK_URL)), 1)
+        return job
+
+    def finish(self, job):
+        """Run the parts of a job until it is done"""
+        while not job.is_done:
+            job = export.run(job.key.id(), job.kinds[0], job.part,
+                             float('inf'))
+        return job
+
+    def read(self, job, kind, part=0):
+        path = os.path.join(self.directory,
+                            export.part_name(job, kind, part))
+        with open(path, 'rb') as part_file:
+            if job.format == 'ndjson':
+                return [json.loads(line) for line in part_file]
+            return list(csv.DictReader(part_file))
+
+    def test_job_names_started_in_the_same_second_differ(self):
+        names = set(export.start('ndjson', ['Game'], self.directory).key.id()
+                    for _ in range(2))
+        self.assertEqual(len(names), 2)
+
+    def test_ndjson_rows_hold_decoded_moves(self):
+        game = played_game('a', 'b')
+        UserScores(parent=game.key, player='a', score=1).put()
+        GameSummary(id=2, player_1_name='c', player_2_name='d',
+                    players=['c', 'd'], player_1_round_score=0,
+                    player_2_round_score=0, round=1,
+                    history=pack_history(MOVES[1:])).put()
+
+        job = self.finish(self.start('ndjson', ['Game', 'GameSummary',
+                                                'UserScores']))
+        self.assertEqual(job.rows, {'Game': 1, 'GameSummary': 1,
+                                    'UserScores': 1})
+        [row] = self.read(job, 'Game')
+        self.assertEqual(row['moves'], [[ROCK, SCISSORS], [PAPER, PAPER]])
+        self.assertEqual(row['players'], ['a', 'b'])
+        [row] = self.read(job, 'GameSummary')
+        self.assertEqual(row['moves'], [[PAPER, PAPER]])
+        [row] = self.read(job, 'UserScores')
+        self.assertEqual(row['parent'], game.key.urlsafe())
+        self.assertNotIn('moves', row)
+
+    def test_csv_has_a_moves_column(self):
+        played_game('a', 'b')
+        job = self.finish(self.start('csv', ['Game']))
+        [row] = self.read(job, 'Game')
+        self.assertEqual(json.loads(row['moves']),
+                         [[ROCK, SCISSORS], [PAPER, PAPER]])
+        self.assertEqual(row['player_1_name'], 'a')
+
+    def test_parts_resume_from_the_checkpoint(self):
+        export.PART_ROWS = export.QUERY_BATCH_SIZE = 2
+        for i in range(5):
+            Game.new_game('p{}'.format(i), 'q').put()
+        job = self.start('ndjson', ['Game'])
+        first = export.run(job.key.id(), 'Game', 0, float('inf'))
+        self.assertEqual((first.part, first.rows), (1, {'Game': 2}))
+        # A duplicate of the task of a part already written does nothing
+        self.assertIsNone(export.run(job.key.id(), 'Game', 0, float('inf')))
+
+        job = self.finish(first)
+        self.assertEqual(job.rows, {'Game': 5})
+        names = [row['player_1_name'] for part in range(3)
+                 for row in self.read(job, 'Game', part)]
+        self.assertEqual(sorted(names), ['p{}'.format(i) for i in range(5)])
@@ -0,0 +1,107 @@
+"""test_matchmaking.py - Pairing of the players waiting in the queue"""
+
+import os
+import time
+
+import base
+
+import main
+import matchmaking
+from models import Game, QueueEntry, User
+
+# Players of the scale test, raise it to check the queue at scale
+SCALE_JOINS = int(os.environ.get('MATCHMAKING_JOINS', 300))
+
+
+def wait(*ratings):
+    """Put players named after their ratings in the queue, in order"""
+    for name, value in ratings:
+        QueueEntry(id=name, bucket=matchmaking.bucket(value),
+                   rating=value).put()
+
+
+def paired():
+    """Return the pairs of player names of the Games created"""
+    return sorted((game.player_1_name, game.player_2_name)
+                  for game in Game.query())
+
+
+def waiting():
+    return sorted(key.id() for key in QueueEntry.query().fetch(
+        keys_only=True))
+
+
+class DrainTest(base.TestCase):
+    def test_pairs_closest_ratings_in_a_bucket(self):
+        wait(('a', 0.51), ('b', 0.58), ('c', 0.52), ('d', 0.57))
+        games, more = matchmaking.drain()
+        self.assertEqual(len(games), 2)
+        self.assertFalse(more)
+        self.assertEqual(paired(), [('a', 'c'), ('d', 'b')])
+        self.assertEqual(waiting(), [])
+
+    def test_odd_player_is_carried_to_the_next_bucket(self):
+        wait(('a', 0.01), ('b', 0.02), ('c', 0.05), ('d', 0.15))
+        matchmaking.drain()
+        self.assertEqual(paired(), [('a', 'b'), ('c', 'd')])
+
+    def test_odd_player_left_over_keeps_waiting(self):
+        wait(('a', 0.51), ('b', 0.52), ('c', 0.53))
+        games, _ = matchmaking.drain()
+        self.assertEqual(len(games), 1)
+        self.assertEqual(waiting(), ['c'])
+
+        wait(('d', 0.91))
+        matchmaking.drain()
+        self.assertEqual(paired(), [('a', 'b'), ('c', 'd')])
+
+    def test_pair_is_dropped_when_a_player_left_in_the_meantime(self):
+        wait(('a', 0.51), ('b', 0.52), ('c', 0.53), ('d', 0.54))
+        match_async = matchmaking._match_async
+
+        def leave_then_match(name_1, name_2):
+            if name_2 == 'b':
+                matchmaking.leave('b')
+            return match_async(name_1, name_2)
+
+        matchmaking._match_async = leave_then_match
+        try:
+            games, _ = matchmaking.drain()
+        finally:
+            matchmaking._match_async = match_async
+        self.assertEqual(len(games), 1)
+        self.assertEqual(paired(), [('c', 'd')])
+        self.assertEqual(waiting(), ['a'])
+
+    def test_reads_a_batch_per_bucket(self):
+        wait(*[('p{}'.format(i), 0.55)
+               for i in range(matchmaking.DRAIN_BATCH_SIZE + 2)])
+        games, more = matchmaking.drain()
+        self.assertEqual(len(games), matchmaking.DRAIN_BATCH_SIZE // 2)
+        self.assertTrue(more)
+        self.assertEqual(len(waiting()), 2)
+
+    def test_joins_share_drains_and_are_all_paired(self):
+        users = [User(id='p{}'.format(i), name='p{}'.format(i),
+                      email='', winning_rate=0, win=i % 7, lose=i % 5,
+                      draw=0) for i in range(SCALE_JOINS)]
+        start = time.time()
+        for user in users:
+            self.assertTrue(matchmaking.join(user))
+        seconds = time.time() - start
+        # Joins within a DRAIN_INTERVAL share one drain task
+        self.assertLessEqual(len(self.tasks('/tasks/drain_queue')),
+                             seconds // matchmaking.DRAIN_INTERVAL + 2)
+
+        drains = 0
+        more = True
+        while more:
+            response = main.app.get_response('/tasks/drain_queue',
+                                             method='POST')
+            self.assertEqual(response.status_int, 200)
+            more = len(waiting()) > 1
+            drains += 1
+        self.assertEqual(Game.query().count(), SCALE_JOINS // 2)
+        # Even if every player were in one bucket
+        self.assertLessEqual(drains,
+                             SCALE_JOINS // matchmaking.DRAIN_BATCH_SIZE + 1)
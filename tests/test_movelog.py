@@ -0,0 +1,118 @@
+"""test_movelog.py - Replay and repair of games from their move log"""
+
+import base
+from google.appengine.ext import ndb
+
+import api
+import engine
+import movelog
+from engine import PAPER, ROCK, SCISSORS
+from models import GameSnapshot, MoveEvent
+
+# a wins, draw, b wins, b wins
+ROUNDS = [(ROCK, SCISSORS), (PAPER, PAPER), (SCISSORS, ROCK), (ROCK, PAPER)]
+
+
+def summary(state, moves):
+    """Return what a replay rebuilt, comparable between replays"""
+    return (state.cards, state.moves, state.scores, state.round, moves)
+
+
+class MoveLogTest(base.TestCase):
+    def setUp(self):
+        super(MoveLogTest, self).setUp()
+        self.create_users('a', 'b')
+        self.v2 = api.LimitedRPSApiV2()
+        urlsafe = self.call(self.v2.create_game, api.CREATE_GAME_REQUEST,
+                            player_1_name='a',
+                            player_2_name='b').urlsafe_key
+        self.key = ndb.Key(urlsafe=urlsafe)
+
+    def play(self, player_name, move):
+        self.call(self.v2.play_game, api.PLAY_GAME_REQUEST,
+                  game_key=self.key.urlsafe(), player_name=player_name,
+                  move=move)
+
+    def play_rounds(self, rounds):
+        for move_1, move_2 in rounds:
+            self.play('a', move_1)
+            self.play('b', move_2)
+
+    def replay(self, round=None, use_snapshots=True):
+        state, moves, cancelled = movelog.replay(self.key, round,
+                                                 use_snapshots)
+        self.assertFalse(cancelled)
+        return summary(state, moves)
+
+    def test_replay_from_the_start(self):
+        self.play_rounds(ROUNDS)
+        for use_snapshots in (True, False):
+            cards, moves, scores, round, history = self.replay(
+                0, use_snapshots)
+            self.assertEqual((cards, scores, round, history),
+                             ([[3] * 3, [3] * 3], [0, 0], 0, []))
+
+    def test_replay_to_a_snapshot_round_and_past_it(self):
+        self.play_rounds(ROUNDS)
+        self.assertIsNotNone(ndb.Key(GameSnapshot, 3, parent=self.key).get())
+        for round in (3, 4):
+            self.assertEqual(self.replay(round),
+                             self.replay(round, use_snapshots=False))
+        cards, moves, scores, round, history = self.replay(3)
+        self.assertEqual((scores, round, history), ([1, 1], 3, ROUNDS[:3]))
+        cards, moves, scores, round, history = self.replay(4)
+        self.assertEqual((cards, scores, round, history),
+                         ([[1, 2, 2], [2, 1, 2]], [1, 2], 4, ROUNDS))
+
+    def test_replay_without_the_snapshot_and_of_a_round_in_progress(self):
+        self.play_rounds(ROUNDS)
+        self.play('a', ROCK)
+        ndb.Key(GameSnapshot, 3, parent=self.key).delete()
+        whole = self.replay()
+        self.assertEqual(whole, self.replay(use_snapshots=False))
+        cards, moves, scores, round, history = whole
+        self.assertEqual((moves, round), ([engine.MOVE_INDEX[ROCK], None], 4))
+        game = self.key.get()
+        self.assertEqual(cards, game.to_state().cards)
+
+    def test_replay_of_a_cancelled_game(self):
+        self.play_rounds(ROUNDS[:1])
+        self.call(api.LimitedRPSApi().cancel_game, api.GET_GAME_REQUEST,
+                  game_key=self.key.urlsafe())
+        state, moves, cancelled = movelog.replay(self.key)
+        self.assertTrue(cancelled)
+        self.assertEqual((state.round, moves), (1, ROUNDS[:1]))
+        self.assertEqual(movelog.repair(self.key), [])
+
+    def test_partially_logged_game_is_not_replayed_or_repaired(self):
+        self.play_rounds(ROUNDS[:2])
+        # Its first round was played before the log existed
+        ndb.delete_multi([ndb.Key(MoveEvent, seq, parent=self.key)
+                          for seq in (1, 2)])
+        with self.assertRaises(movelog.IncompleteLog):
+            movelog.replay(self.key, use_snapshots=False)
+        self.assertIsNone(movelog.repair(self.key))
+
+    def test_unlogged_game_is_not_repaired(self):
+        self.play_rounds(ROUNDS[:2])
+        ndb.delete_multi(MoveEvent.query(ancestor=self.key).fetch(
+            keys_only=True))
+        self.assertIsNone(movelog.repair(self.key))
+
+    def test_repair_fixes_a_tampered_game(self):
+        self.play_rounds(ROUNDS)
+        game = self.key.get()
+        game.player_1_round_score = 4
+        game.player_2_rock = 3
+        game.is_active = False
+        game.put()
+        ndb.get_context().clear_cache()
+
+        self.assertEqual(sorted(movelog.repair(self.key)),
+                         ['is_active', 'player_1_round_score',
+                          'player_2_rock'])
+        ndb.get_context().clear_cache()
+        game = self.key.get()
+        self.assertEqual((game.player_1_round_score, game.player_2_rock,
+                          game.is_active), (1, 2, True))
+        self.assertEqual(movelog.repair(self.key), [])
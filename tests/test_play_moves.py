@@ -0,0 +1,74 @@
+"""test_play_moves.py - Batches of moves in one or many games"""
+
+import base
+import endpoints
+from google.appengine.ext import ndb
+
+import api
+from models import Game, GameSummary, MoveForm, MoveForms
+
+
+class PlayMovesTest(base.TestCase):
+    def setUp(self):
+        super(PlayMovesTest, self).setUp()
+        self.create_users('a', 'b', 'c', 'd')
+        self.first = Game.new_game('a', 'b')
+        self.second = Game.new_game('c', 'd')
+        ndb.put_multi([self.first, self.second])
+        self.v2 = api.LimitedRPSApiV2()
+
+    def play(self, *moves):
+        """Play (game, player_name, move) triples as one batch"""
+        ndb.get_context().clear_cache()
+        request = MoveForms(moves=[
+            MoveForm(game_key=game if isinstance(game, str)
+                     else game.key.urlsafe(),
+                     player_name=player_name, move=move)
+            for game, player_name, move in moves])
+        results = self.v2.play_moves(request).results
+        ndb.get_context().clear_cache()
+        return results
+
+    def test_valid_and_invalid_moves_across_games(self):
+        results = self.play((self.first, 'a', 'rock'),
+                            (self.second, 'c', 'lizard'),
+                            (self.first, 'a', 'paper'),
+                            (self.second, 'a', 'rock'),
+                            ('not-a-key', 'a', 'rock'),
+                            (self.second, 'd', 'scissors'),
+                            (self.first, 'b', 'paper'))
+        self.assertEqual([result.ok for result in results],
+                         [True, False, False, False, False, True, True])
+        self.assertIn('we don\'t know about', results[1].message)
+        self.assertIn('already used a rock card', results[2].message)
+        self.assertIn('is not a player', results[3].message)
+
+        first, second = self.first.key.get(), self.second.key.get()
+        self.assertEqual((first.round, first.player_2_round_score), (1, 1))
+        self.assertEqual((second.round, second.player_2_move),
+                         (0, 'scissors'))
+
+    def test_rejected_move_keeps_the_round_result(self):
+        results = self.play((self.first, 'a', 'rock'),
+                            (self.first, 'b', 'paper'),
+                            (self.first, 'a', 'lizard'))
+        self.assertEqual([result.ok for result in results],
+                         [True, True, False])
+        self.assertEqual(self.first.key.get().round_result,
+                         'Round result: Winner:b, Loser:a.')
+
+    def test_move_to_an_archived_game(self):
+        self.first.player_1_round_score = 5
+        self.first.is_active = False
+        GameSummary.from_game(self.first).put()
+        self.first.key.delete()
+        [archived, other] = self.play((self.first, 'a', 'rock'),
+                                      (self.second, 'c', 'rock'))
+        self.assertFalse(archived.ok)
+        self.assertEqual(archived.message, 'Game has already finished')
+        self.assertTrue(other.ok)
+
+    def test_batch_size_is_limited(self):
+        with self.assertRaises(endpoints.BadRequestException):
+            self.play(*[(self.first, 'a', 'rock')] *
+                      (api.MAX_BATCH_MOVES + 1))
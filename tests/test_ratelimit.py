@@ -0,0 +1,82 @@
+"""test_ratelimit.py - Token bucket rate limits kept in memcache"""
+
+import base
+
+import ratelimit
+
+
+class Clock(object):
+    """Stands in for the time module, at a time the test sets"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class UnavailableClient(object):
+    """Stands in for memcache.Client when memcache is down"""
+
+    def gets(self, key):
+        return None
+
+    def add(self, key, value, time=0):
+        return False
+
+
+class ContendedClient(object):
+    """Stands in for memcache.Client when another instance always updates
+    the bucket first"""
+
+    def gets(self, key):
+        return (1, 1000.0)
+
+    def cas(self, key, value, time=0):
+        return False
+
+
+class AllowTest(base.TestCase):
+    def setUp(self):
+        super(AllowTest, self).setUp()
+        self.clock = Clock()
+        self.addCleanup(setattr, ratelimit, 'time', ratelimit.time)
+        ratelimit.time = self.clock
+        self.rate, self.burst = ratelimit.LIMITS['user']
+
+    def take(self, name='a'):
+        """Take tokens until throttled, returning the number taken"""
+        taken = 0
+        while ratelimit.allow('user', name):
+            taken += 1
+            self.assertLessEqual(taken, self.burst)
+        return taken
+
+    def test_burst_then_throttle(self):
+        self.assertEqual(self.take(), self.burst)
+        self.assertFalse(ratelimit.allow('user', 'a'))
+
+    def test_buckets_are_separate(self):
+        self.take('a')
+        self.assertTrue(ratelimit.allow('user', 'b'))
+        self.assertTrue(ratelimit.allow('game', 'a'))
+
+    def test_refills_at_the_rate(self):
+        self.take()
+        self.clock.now += 1
+        self.assertEqual(self.take(), int(self.rate))
+        self.clock.now += 60
+        self.assertEqual(self.take(), self.burst)
+
+    def test_allows_when_memcache_is_down(self):
+        self.addCleanup(setattr, ratelimit.memcache, 'Client',
+                        ratelimit.memcache.Client)
+        ratelimit.memcache.Client = UnavailableClient
+        for _ in range(self.burst + 1):
+            self.assertTrue(ratelimit.allow('user', 'a'))
+
+    def test_allows_when_the_bucket_stays_contended(self):
+        self.addCleanup(setattr, ratelimit.memcache, 'Client',
+                        ratelimit.memcache.Client)
+        ratelimit.memcache.Client = ContendedClient
+        self.assertTrue(ratelimit.allow('user', 'a'))
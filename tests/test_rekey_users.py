@@ -0,0 +1,41 @@
+"""test_rekey_users.py - Migration of Users to keys by their name"""
+
+import base
+import loadtest
+from google.appengine.ext import ndb
+
+import main
+from models import User
+
+
+class RekeyUsersTest(base.TestCase):
+    def legacy_user(self, name, win, lose, draw):
+        """Put a User with an auto-allocated id, as created before Users
+        were keyed by name"""
+        return User(name=name, email=loadtest.EMAIL, winning_rate=0,
+                    win=win, lose=lose, draw=draw).put()
+
+    def test_users_are_rekeyed_by_name(self):
+        old_key = self.legacy_user('a', 2, 1, 1)
+        main.app.get_response('/tasks/rekey_users', method='POST')
+        self.assertIsNone(old_key.get())
+        user = ndb.Key(User, 'a').get()
+        self.assertEqual((user.win, user.lose, user.draw), (2, 1, 1))
+
+    def test_duplicates_are_merged_into_the_user_keyed_by_name(self):
+        [keyed] = self.create_users('a')
+        keyed.win, keyed.lose = 1, 1
+        keyed.put()
+        duplicates = [self.legacy_user('a', 2, 0, 1),
+                      self.legacy_user('a', 1, 0, None)]
+        self.legacy_user('b', 0, 3, 0)
+
+        main.app.get_response('/tasks/rekey_users', method='POST')
+        ndb.get_context().clear_cache()
+        self.assertEqual(ndb.get_multi(duplicates), [None, None])
+        self.assertEqual(sorted(user.key.id() for user in User.query()),
+                         ['a', 'b'])
+        user = ndb.Key(User, 'a').get()
+        self.assertEqual((user.win, user.lose, user.draw), (4, 1, 1))
+        self.assertAlmostEqual(user.winning_rate, 4.0 / 6)
+        self.assertEqual(user.email, loadtest.EMAIL)
@@ -0,0 +1,99 @@
+"""test_reminders.py - The hourly reminder cron and its mail tasks"""
+
+import json
+import os
+
+import base
+import loadtest
+from google.appengine.ext import ndb, testbed
+
+import bot
+import main
+from models import Game, User
+
+MAX_TASK_SIZE = 100 * 1024  # Bytes of a push task at most
+# Players of the scale test, raise it to check the payloads at scale
+SCALE_USERS = int(os.environ.get('REMINDER_USERS', 300))
+
+
+class ReminderTest(base.TestCase):
+    def reminders(self):
+        """Return the reminders of every mail task enqueued"""
+        return [reminder for task in self.tasks('/tasks/send_reminders')
+                for reminder in json.loads(task.payload)]
+
+    def test_batches_hold_players_with_an_email_and_their_games(self):
+        self.create_users('a', 'b', 'c', 'd')
+        User(id=bot.BOT_NAME, name=bot.BOT_NAME, email='', winning_rate=0,
+             win=0, lose=0, draw=0).put()
+        finished = Game.new_game('c', 'd')
+        finished.is_active = False
+        game = Game.new_game('a', 'b')
+        ndb.put_multi([game, Game.new_game('a', bot.BOT_NAME), finished])
+
+        main.app.get_response('/crons/send_reminder')
+        reminders = sorted(self.reminders())
+        self.assertEqual([reminder[0] for reminder in reminders], ['a', 'b'])
+        name, email, games, more = reminders[1]
+        self.assertEqual(email, loadtest.EMAIL)
+        self.assertEqual(games, [['a', game.key.urlsafe()]])
+        self.assertFalse(more)
+        self.assertEqual(len(reminders[0][2]), 2)
+
+    def test_games_past_the_mail_limit_are_left_out(self):
+        self.create_users('a')
+        ndb.put_multi([Game.new_game('a', 'p{}'.format(i))
+                       for i in range(main.REMINDER_GAMES + 5)])
+        main.app.get_response('/crons/send_reminder')
+        [(name, _, games, more)] = self.reminders()
+        self.assertEqual(len(games), main.REMINDER_GAMES)
+        self.assertTrue(more)
+
+    def test_batches_are_split_by_payload_size(self):
+        self.addCleanup(setattr, main, 'REMINDER_PAYLOAD_SIZE',
+                        main.REMINDER_PAYLOAD_SIZE)
+        main.REMINDER_PAYLOAD_SIZE = 1000
+        names = ['player-{}'.format(i) for i in range(40)]
+        self.create_users(*names)
+        ndb.put_multi([Game.new_game(names[i], names[i + 1])
+                       for i in range(0, len(names), 2)])
+
+        main.app.get_response('/crons/send_reminder')
+        tasks = self.tasks('/tasks/send_reminders')
+        self.assertGreater(len(tasks), 1)
+        self.assertTrue(all(len(task.payload) <= 1000 for task in tasks))
+        self.assertEqual(sorted(reminder[0] for reminder in
+                                self.reminders()), sorted(names))
+
+    def test_batch_mails_each_player_their_games(self):
+        reminders = [['a', loadtest.EMAIL, [['b', 'key-1'], ['c', 'key-2']],
+                      True],
+                     ['b', loadtest.EMAIL, [['a', 'key-1']], False]]
+        main.app.get_response('/tasks/send_reminders', method='POST',
+                              body=json.dumps(reminders))
+        stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        messages = stub.get_sent_messages(to=loadtest.EMAIL)
+        self.assertEqual(len(messages), 2)
+        bodies = sorted(message.body.decode() for message in messages)
+        self.assertIn('a vs b (game key-1)', bodies[0])
+        self.assertIn('a vs c (game key-2)', bodies[0])
+        self.assertIn('and more', bodies[0])
+        self.assertIn('b vs a (game key-1)', bodies[1])
+        self.assertNotIn('and more', bodies[1])
+
+    def test_cron_payloads_stay_under_the_task_size(self):
+        names = ['player-{}'.format(i) for i in range(SCALE_USERS)]
+        for i in range(0, len(names), 1000):
+            self.create_users(*names[i:i + 1000])
+            ndb.put_multi([Game.new_game(names[j], names[j + 1])
+                           for j in range(i, min(i + 1000, len(names)) - 1,
+                                          2)])
+        ndb.get_context().clear_cache()
+
+        response = main.app.get_response('/crons/send_reminder')
+        self.assertEqual(response.status_int, 200)
+        tasks = self.tasks('/tasks/send_reminders')
+        self.assertEqual(len(self.reminders()),
+                         SCALE_USERS - SCALE_USERS % 2)
+        self.assertLess(max(len(task.payload) for task in tasks),
+                        MAX_TASK_SIZE)
@@ -0,0 +1,66 @@
+"""test_stats.py - Global game statistics kept as games finish"""
+
+import base
+from google.appengine.ext import ndb
+
+import stats
+from engine import ROCK, SCISSORS
+from models import Game, StatsShard, pack_history
+
+
+def won_game():
+    """Return a Game player_1 won in 5 rounds of rock against scissors"""
+    game = Game.new_game('a', 'b')
+    game.history = pack_history([(ROCK, SCISSORS)] * 5)
+    game.round = 5
+    game.player_1_round_score = 5
+    game.is_active = False
+    game.put()
+    return game
+
+
+def cancelled_game():
+    """Return a Game cancelled after its first round"""
+    game = Game.new_game('a', 'b')
+    game.history = pack_history([(ROCK, ROCK)])
+    game.round = 1
+    game.is_active = False
+    game.put()
+    return game
+
+
+@ndb.transactional(xg=True)
+def finish(game):
+    """Add a game to the statistics as play_game does"""
+    stats.add_game_async(game).get_result().put()
+
+
+class StatsTest(base.TestCase):
+    def test_no_statistics_before_a_game_finishes(self):
+        self.assertIsNone(stats.get())
+
+    def test_finished_games_are_summed_across_shards(self):
+        for _ in range(3):
+            finish(won_game())
+        finish(cancelled_game())
+        snapshot = stats.get()
+        self.assertEqual(snapshot.games, 3)
+        self.assertEqual(snapshot.average_rounds, 5.0)
+        self.assertEqual(snapshot.draw_rate, 0.0)
+        self.assertEqual(snapshot.average_score, 2.5)
+        self.assertEqual(snapshot.move_frequency[0], [3, 0, 3])
+        self.assertEqual(snapshot.move_frequency[5], [0, 0, 0])
+
+    def test_scan_replaces_the_shards(self):
+        finish(won_game())
+        won_game()
+        cancelled_game()
+
+        state = stats.new_state()
+        self.assertTrue(stats.scan(state, float('inf')))
+        stats.save(state)
+        self.assertEqual([key.id() for key in StatsShard.query().fetch(
+            keys_only=True)], [stats.BASE_ID])
+        snapshot = stats.get()
+        self.assertEqual(snapshot.games, 2)
+        self.assertEqual(snapshot.average_score, 2.5)
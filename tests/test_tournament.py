@@ -0,0 +1,180 @@
+"""test_tournament.py - Tournament pairings, standings and rounds"""
+
+import datetime
+import itertools
+import time
+
+import base
+
+import counters
+import tournament
+from models import Game, GameSummary
+
+
+def finish(game, player_1_score, player_2_score):
+    """Finish a Game with round scores, as play_game would"""
+    game.player_1_round_score = player_1_score
+    game.player_2_round_score = player_2_score
+    game.is_active = False
+    game.put()
+
+
+def cancel(game):
+    """Cancel a Game before the end, as cancel_game does"""
+    game.round = 9
+    game.is_active = False
+    game.put()
+
+
+class PairingTest(base.TestCase):
+    def test_round_robin_pairs_everyone_once(self):
+        players = ['p{}'.format(i) for i in range(6)]
+        pairs = [frozenset(pair) for round in range(5)
+                 for pair in tournament.round_robin_pairings(players, round)]
+        self.assertEqual(sorted(pairs, key=sorted), sorted(
+            (frozenset(pair) for pair in itertools.combinations(players, 2)),
+            key=sorted))
+
+    def test_round_robin_sits_each_player_out_once_when_odd(self):
+        players = ['p{}'.format(i) for i in range(5)]
+        out = []
+        for round in range(5):
+            pairs = tournament.round_robin_pairings(players, round)
+            self.assertEqual(len(pairs), 2)
+            paired = set(itertools.chain(*pairs))
+            out.extend(set(players) - paired)
+        self.assertEqual(sorted(out), players)
+
+    def test_swiss_avoids_rematches(self):
+        pairs, bye = tournament.swiss_pairings(
+            ['a', 'b', 'c', 'd'], set([frozenset(('a', 'b'))]), set())
+        self.assertEqual(pairs, [('a', 'c'), ('b', 'd')])
+        self.assertIsNone(bye)
+
+    def test_swiss_allows_a_rematch_when_there_is_no_other(self):
+        pairs, _ = tournament.swiss_pairings(
+            ['a', 'b'], set([frozenset(('a', 'b'))]), set())
+        self.assertEqual(pairs, [('a', 'b')])
+
+    def test_swiss_bye_goes_to_the_lowest_player_without_one(self):
+        pairs, bye = tournament.swiss_pairings(['a', 'b', 'c'], set(),
+                                               set(['c']))
+        self.assertEqual(bye, 'b')
+        self.assertEqual(pairs, [('a', 'c')])
+
+
+class RoundTest(base.TestCase):
+    def setUp(self):
+        super(RoundTest, self).setUp()
+        self.players = ['a', 'b', 'c', 'd']
+        self.tournament = tournament.new_tournament(
+            'test', self.players, tournament.ROUND_ROBIN)
+
+    def round_games(self, round):
+        return Game.query(Game.tournament == self.tournament.key,
+                          Game.tournament_round == round).fetch()
+
+    def test_first_round_is_created(self):
+        self.assertEqual(len(self.round_games(1)), 2)
+        self.assertTrue(self.tournament.key.get().round_created)
+
+    def test_advance_waits_for_every_game(self):
+        finish(self.round_games(1)[0], 5, 0)
+        tournament.advance(self.tournament.key)
+        self.assertEqual(self.tournament.key.get().round, 1)
+        self.assertEqual(self.round_games(2), [])
+
+    def test_advance_creates_the_next_round_once(self):
+        for game in self.round_games(1):
+            finish(game, 5, 3)
+        tournament.advance(self.tournament.key)
+        tournament.advance(self.tournament.key)
+        self.assertEqual(self.tournament.key.get().round, 2)
+        self.assertEqual(len(self.round_games(2)), 2)
+
+    def test_tournament_ends_after_the_last_round(self):
+        for round in range(1, 4):
+            for game in self.round_games(round):
+                finish(game, 5, 3)
+            tournament.advance(self.tournament.key)
+        found = self.tournament.key.get()
+        self.assertFalse(found.is_active)
+        self.assertEqual(found.round, 3)
+
+    def advances(self):
+        """Return the advance tasks enqueued, without the deadline of the
+        first round"""
+        return self.tasks('/tasks/advance_tournament')[1:]
+
+    def past_deadline(self):
+        found = self.tournament.key.get()
+        found.round_started -= datetime.timedelta(
+            seconds=tournament.ROUND_TIME)
+        found.put()
+
+    def test_round_creation_enqueues_its_deadline(self):
+        [task] = self.tasks('/tasks/advance_tournament')
+        self.assertGreaterEqual(task.eta_posix - time.time(),
+                                tournament.ROUND_TIME)
+
+    def test_abandoned_game_waits_until_the_deadline(self):
+        first, second = self.round_games(1)
+        finish(first, 5, 3)
+        tournament.advance(self.tournament.key)
+        self.assertTrue(second.key.get().is_active)
+        self.assertEqual(self.advances(), [])
+
+    def test_abandoned_game_is_cancelled_after_the_deadline(self):
+        first, second = self.round_games(1)
+        finish(first, 5, 3)
+        self.past_deadline()
+        tournament.advance(self.tournament.key)
+        cancelled = second.key.get()
+        self.assertFalse(cancelled.is_active)
+        self.assertIsNone(counters.outcome(cancelled))
+        self.assertEqual(len(self.advances()), 1)
+
+        tournament.advance(self.tournament.key)
+        self.assertEqual(self.tournament.key.get().round, 2)
+        self.assertEqual(len(self.round_games(2)), 2)
+
+    def test_stale_index_checks_the_round_again(self):
+        games = self.round_games(1)
+        for game in games:
+            finish(game, 5, 3)
+        active_keys = tournament._active_keys
+        tournament._active_keys = lambda *args: [games[0].key]
+        try:
+            tournament.advance(self.tournament.key)
+        finally:
+            tournament._active_keys = active_keys
+        self.assertEqual(self.tournament.key.get().round, 1)
+        self.assertEqual(len(self.advances()), 1)
+
+        tournament.advance(self.tournament.key)
+        self.assertEqual(self.tournament.key.get().round, 2)
+
+    def test_round_created_before_deadlines_gets_one(self):
+        found = self.tournament.key.get()
+        found.round_started = None
+        found.put()
+        tournament.advance(self.tournament.key)
+        self.assertIsNotNone(self.tournament.key.get().round_started)
+        self.assertEqual(len(self.advances()), 1)
+
+    def test_standings_skip_cancelled_games_and_count_archived_ones(self):
+        first, second = self.round_games(1)
+        finish(first, 5, 3)
+        GameSummary.from_game(first).put()
+        first.key.delete()
+        cancel(second)
+
+        standings, played = tournament.results(self.tournament.key.get())
+        counts = dict((name, (win, lose, draw))
+                      for name, win, lose, draw in standings)
+        self.assertEqual(counts[first.player_1_name], (1, 0, 0))
+        self.assertEqual(counts[first.player_2_name], (0, 1, 0))
+        self.assertEqual(counts[second.player_1_name], (0, 0, 0))
+        self.assertEqual(counts[second.player_2_name], (0, 0, 0))
+        self.assertIn(frozenset((second.player_1_name,
+                                 second.player_2_name)), played)
@@ -0,0 +1,77 @@
+"""test_userstats.py - Recount and repair of the results of Users"""
+
+import base
+from google.appengine.ext import ndb
+
+import counters
+import userstats
+from models import Game, StatsRepairShard, User
+
+
+def finished_game(player_1_name, player_2_name):
+    """Put a Game player_1 won"""
+    game = Game.new_game(player_1_name, player_2_name)
+    game.player_1_round_score = 5
+    game.is_active = False
+    game.put()
+    return game
+
+
+@ndb.transactional(xg=True)
+def finish(game):
+    """Finish an active Game player_2 won, as play_game would"""
+    game.player_2_round_score = 5
+    game.is_active = False
+    shards = [counters.increment_async(name, result).get_result()
+              for name, result in zip(game.players, counters.outcome(game))]
+    ndb.put_multi([game] + shards)
+
+
+def repair():
+    """Run a repair job to the end and return its report"""
+    job_key = userstats.start(shards=1, enqueue=False)
+    for key in StatsRepairShard.query(ancestor=job_key).fetch(
+            keys_only=True):
+        while not userstats.run(key, float('inf')).is_done:
+            pass
+    ndb.get_context().clear_cache()
+    return userstats.report(job_key)
+
+
+class RepairTest(base.TestCase):
+    def setUp(self):
+        super(RepairTest, self).setUp()
+        self.create_users('a', 'b', 'c')
+        finished_game('a', 'b')
+
+    def test_corrects_users_with_an_abandoned_game(self):
+        Game.new_game('a', 'c').put()
+        report = repair()
+        self.assertEqual((report['users'], report['skipped'],
+                          report['corrected']), (3, 0, 2))
+        user = User.get_by_id('a')
+        self.assertEqual((user.win, user.lose, user.draw), (1, 0, 0))
+        self.assertEqual(User.get_by_id('b').lose, 1)
+
+    def test_skips_users_whose_game_finishes_before_the_correction(self):
+        game = Game.new_game('a', 'c')
+        game.put()
+        correct_async = userstats.correct_async
+
+        def finish_then_correct(name, results, active):
+            if game.is_active:
+                finish(game)
+            return correct_async(name, results, active)
+
+        userstats.correct_async = finish_then_correct
+        try:
+            report = repair()
+        finally:
+            userstats.correct_async = correct_async
+        # Only b was corrected: a and c counted the game as active
+        self.assertEqual((report['users'], report['skipped']), (1, 2))
+        self.assertEqual(User.get_by_id('a').win, 0)
+        self.assertEqual(User.get_by_id('b').lose, 1)
+        users = counters.get_users_async(['a', 'c']).get_result()
+        self.assertEqual([(user.win, user.lose) for user in users],
+                         [(0, 1), (1, 0)])
@@ -0,0 +1,86 @@
+"""test_utils.py - Coalescing of identical reads in flight"""
+
+import threading
+
+import base
+from google.appengine.ext import ndb
+
+import utils
+from models import Game
+
+KEY = ndb.Key(Game, 1)
+HOLD = 0.2  # Seconds the read in flight is held while the follower reads
+
+
+class CoalesceTest(base.TestCase):
+    def setUp(self):
+        super(CoalesceTest, self).setUp()
+        self.release = threading.Event()
+        self.fetches = []
+        self.results = []
+
+    def lead(self, fetch):
+        """Start a read that is held in flight until self.release is set,
+        then returns or raises what fetch does"""
+        started = threading.Event()
+
+        def held_fetch():
+            self.fetches.append('leader')
+            started.set()
+            self.release.wait()
+            return fetch()
+
+        def read():
+            try:
+                self.results.append(utils.coalesce(KEY, held_fetch))
+            except ValueError:
+                self.results.append('failed')
+
+        leader = threading.Thread(target=read)
+        leader.start()
+        self.addCleanup(leader.join)
+        self.addCleanup(self.release.set)
+        started.wait()
+        return leader
+
+    def follow(self):
+        """Read the same key on this thread with a fetch of its own"""
+        def fetch():
+            self.fetches.append('follower')
+            return 'own'
+        return utils.coalesce(KEY, fetch)
+
+    def test_follower_shares_the_result_in_flight(self):
+        leader = self.lead(lambda: 'shared')
+        threading.Timer(HOLD, self.release.set).start()
+        self.assertEqual(self.follow(), 'shared')
+        leader.join()
+        self.assertEqual(self.results, ['shared'])
+        self.assertEqual(self.fetches, ['leader'])
+        self.assertEqual(utils._inflight, {})
+
+    def test_follower_fetches_when_the_leader_fails(self):
+        def fail():
+            raise ValueError('datastore error')
+        leader = self.lead(fail)
+        threading.Timer(HOLD, self.release.set).start()
+        self.assertEqual(self.follow(), 'own')
+        leader.join()
+        self.assertEqual(self.results, ['failed'])
+        self.assertEqual(self.fetches, ['leader', 'follower'])
+
+    def test_follower_fetches_when_the_leader_is_too_slow(self):
+        self.addCleanup(setattr, utils, 'COALESCE_WAIT', utils.COALESCE_WAIT)
+        utils.COALESCE_WAIT = HOLD / 4
+        leader = self.lead(lambda: 'late')
+        self.assertEqual(self.follow(), 'own')
+        self.release.set()
+        leader.join()
+        self.assertEqual(self.results, ['late'])
+        self.assertEqual(self.fetches, ['leader', 'follower'])
+
+    def test_next_read_after_the_flight_fetches_again(self):
+        self.release.set()
+        self.lead(lambda: 'first').join()
+        self.assertEqual(self.follow(), 'own')
+        self.assertEqual(self.fetches, ['leader', 'follower'])
@@ -0,0 +1,271 @@
+"""tournament.py - Tournaments between registered players.
+Each round's Games are created in bulk. Every tournament game that finishes
+enqueues an advance task, which starts the next round once no game of the
+current round is still active. Creating a round also enqueues an advance
+for its deadline, ROUND_TIME later, which cancels the games of the round
+still active so that an abandoned game cannot block the tournament.
+Standings are computed from the finished games of the tournament: a win
+scores 2 points and a draw 1; cancelled games score nothing."""
+
+import datetime
+import itertools
+import math
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import counters
+import events
+import movelog
+from models import Game, GameSummary, Tournament
+from utils import invalidate
+
+ROUND_ROBIN = 'round_robin'
+SWISS = 'swiss'
+PUT_BATCH_SIZE = 500  # Maximum number of entities written per put_multi
+QUERY_BATCH_SIZE = 500
+ADVANCE_COUNTDOWN = 5  # Seconds for a finished game to reach the indexes
+ACTIVE_CHECK_LIMIT = 20
+ROUND_TIME = 3 * 24 * 60 * 60  # Seconds before a round's games are cancelled
+# State of the current round, see _round_state()
+OVER, ACTIVE, STALE = 'over', 'active', 'stale'
+RESULTS = [counters.WIN, counters.LOSE, counters.DRAW]  # Order of the counts
+
+
+def round_robin_pairings(players, round):
+    """Return the pairs of a round (from 0) of a round robin, using the
+    circle method. With an odd number of players one sits out each round."""
+    players = list(players)
+    if len(players) % 2:
+        players.append(None)
+    shift = round % (len(players) - 1)
+    rotating = players[1:]
+    order = [players[0]] + rotating[len(rotating) - shift:] + \
+        rotating[:len(rotating) - shift]
+    pairs = [(order[i], order[-1 - i]) for i in range(len(order) // 2)]
+    return [pair for pair in pairs if None not in pair]
+
+
+def swiss_pairings(ranking, played, byes):
+    """Return the pairs and the player sitting out (or None) of a swiss
+    round. Players are paired down the ranking with the next player they
+    have not met yet, allowing a rematch only when there is no other.
+    Args:
+        ranking: Player names, best first
+        played: Set of frozensets of the pairs that have already met
+        byes: Set of players who have already sat out a round"""
+    unpaired = list(ranking)
+    bye = None
+    if len(unpaired) % 2:
+        bye = next((name for name in reversed(unpaired) if name not in byes),
+                   unpaired[-1])
+        unpaired.remove(bye)
+
+    pairs = []
+    while unpaired:
+        first = unpaired.pop(0)
+        index = next((i for i, other in enumerate(unpaired)
+                      if frozenset((first, other)) not in played), 0)
+        pairs.append((first, unpaired.pop(index)))
+    return pairs, bye
+
+
+def results(tournament):
+    """Return the standings of a tournament as (name, win, lose, draw)
+    tuples in ranking order, and the set of pairs that have played. Games
+    that have been archived are counted from their GameSummary, and games
+    cancelled before the end are not counted."""
+    counts = dict((name, [0, 0, 0]) for name in tournament.players)
+    for name in tournament.byes:
+        counts[name][0] += 1
+    played = set()
+    games = Game.query(Game.tournament == tournament.key,
+                       Game.is_active == False)
+    summaries = GameSummary.query(GameSummary.tournament == tournament.key)
+    for game in itertools.chain(games.iter(batch_size=QUERY_BATCH_SIZE),
+                                summaries.iter(batch_size=QUERY_BATCH_SIZE)):
+        played.add(frozenset((game.player_1_name, game.player_2_name)))
+        if isinstance(game, GameSummary):
+            game = game.to_game()
+        outcome = counters.outcome(game)
+        if outcome:  # Cancelled games score nothing
+            for name, result in zip((game.player_1_name,
+                                     game.player_2_name), outcome):
+                counts[name][RESULTS.index(result)] += 1
+
+    standings = sorted(((name, win, lose, draw)
+                        for name, (win, lose, draw) in counts.items()),
+                       key=lambda entry: (-(2 * entry[1] + entry[3]),
+                                          entry[0]))
+    return standings, played
+
+
+def new_tournament(name, players, pairing, rounds=None):
+    """Create a Tournament and the Games of its first round.
+    Args:
+        name: Name of the tournament
+        players: Names of the registered players, who must exist
+        pairing: ROUND_ROBIN or SWISS
+        rounds: Number of rounds of a swiss tournament, by default enough
+            to find a single winner
+    Returns:
+        The Tournament"""
+    if pairing == ROUND_ROBIN:
+        rounds = len(players) - 1 + len(players) % 2
+    elif not rounds:
+        rounds = int(math.ceil(math.log(len(players), 2)))
+    tournament = Tournament(name=name, players=players, pairing=pairing,
+                            rounds=rounds, round=1, round_created=False,
+                            is_active=True)
+    tournament.put()
+    create_round(tournament)
+    return tournament
+
+
+def create_round(tournament):
+    """Create the Games of the tournament's current round. Game keys are
+    derived from the tournament, round and table, so running this again
+    after a failure only creates the games that are missing."""
+    bye = None
+    if tournament.pairing == ROUND_ROBIN:
+        pairs = round_robin_pairings(tournament.players, tournament.round - 1)
+    else:
+        standings, played = results(tournament)
+        pairs, bye = swiss_pairings([entry[0] for entry in standings],
+                                    played, set(tournament.byes))
+
+    games = [Game.new_game(player_1_name, player_2_name,
+                           id='{}-{}-{}'.format(tournament.key.id(),
+                                                tournament.round, table),
+                           tournament=tournament.key,
+                           tournament_round=tournament.round)
+             for table, (player_1_name, player_2_name) in enumerate(pairs)]
+    for i in range(0, len(games), PUT_BATCH_SIZE):
+        batch = games[i:i + PUT_BATCH_SIZE]
+        existing = ndb.get_multi([game.key for game in batch])
+        ndb.put_multi([game for game, found in zip(batch, existing)
+                       if not found])
+    _finish_creating_round(tournament.key, tournament.round, bye)
+
+
+@ndb.transactional
+def _finish_creating_round(tournament_key, round, bye):
+    tournament = tournament_key.get()
+    if tournament.round == round and not tournament.round_created:
+        tournament.round_created = True
+        if bye:
+            tournament.byes.append(bye)
+        _start_clock(tournament)
+
+
+def _start_clock(tournament):
+    """Start the deadline of the current round, in a transaction on the
+    Tournament"""
+    tournament.round_started = datetime.datetime.utcnow()
+    tournament.put()
+    enqueue_advance(tournament.key, countdown=ROUND_TIME + ADVANCE_COUNTDOWN,
+                    transactional=True)
+
+
+@ndb.transactional
+def _start_clock_if_missing(tournament_key, round):
+    """Start the deadline of a round created before rounds had one"""
+    tournament = tournament_key.get()
+    if tournament.round == round and tournament.round_started is None:
+        _start_clock(tournament)
+
+
+@ndb.transactional
+def _start_next_round(tournament_key, round):
+    """Move the tournament past a finished round, unless another task
+    already has. Returns the Tournament if a new round has to be created."""
+    tournament = tournament_key.get()
+    if not tournament.is_active or tournament.round != round or \
+            not tournament.round_created:
+        return None
+    if tournament.round >= tournament.rounds:
+        tournament.is_active = False
+        tournament.put()
+        return None
+    tournament.round += 1
+    tournament.round_created = False
+    tournament.put()
+    return tournament
+
+
+def _active_keys(tournament, limit=None):
+    """Return the keys of the games of the current round that the
+    eventually consistent indexes still show as active"""
+    query = Game.query(Game.tournament == tournament.key,
+                       Game.tournament_round == tournament.round,
+                       Game.is_active == True)
+    return query.fetch(limit, keys_only=True)
+
+
+def _round_state(tournament):
+    """Return ACTIVE when a game of the current round is still active, as
+    a strongly consistent get confirms, OVER when none is, or STALE when the
+    query only found games that have finished since, so that the round has
+    to be checked again once the indexes have caught up."""
+    keys = _active_keys(tournament, ACTIVE_CHECK_LIMIT)
+    if any(game and game.is_active for game in ndb.get_multi(keys)):
+        return ACTIVE
+    return STALE if keys else OVER
+
+
+def _past_deadline(tournament):
+    return tournament.round_started is not None and \
+        datetime.datetime.utcnow() - tournament.round_started >= \
+        datetime.timedelta(seconds=ROUND_TIME)
+
+
+def cancel_round(tournament):
+    """Cancel the games of the current round that are still active.
+    Returns:
+        The number of games cancelled"""
+    cancelled = 0
+    for key in _active_keys(tournament):
+        game, was_active = movelog.cancel(key)
+        if was_active:
+            invalidate(key)
+            events.publish(key, events.game_seq(game),
+                           [(events.CANCELLED, 'Game cancelled: the round '
+                                               'is over.')])
+            cancelled += 1
+    return cancelled
+
+
+def advance(tournament_key):
+    """Create the current round if that was interrupted, or start the next
+    round once the current one is over. Games still active after the
+    round's deadline are cancelled. A round the indexes do not show as
+    over yet is checked again by another advance task."""
+    tournament = tournament_key.get()
+    if not tournament or not tournament.is_active:
+        return
+    if not tournament.round_created:
+        create_round(tournament)
+        return
+    if tournament.round_started is None:
+        _start_clock_if_missing(tournament_key, tournament.round)
+
+    state = _round_state(tournament)
+    if state == ACTIVE and _past_deadline(tournament):
+        cancel_round(tournament)
+        state = STALE
+    if state == STALE:
+        enqueue_advance(tournament_key)
+    elif state == OVER:
+        tournament = _start_next_round(tournament_key, tournament.round)
+        if tournament:
+            create_round(tournament)
+
+
+def enqueue_advance(tournament_key, countdown=ADVANCE_COUNTDOWN,
+                    transactional=False):
+    """Enqueue an advance task, after a game of the tournament finished or
+    for the deadline of a round. advance() does nothing unless the round is
+    over or past its deadline, so a task enqueued twice is harmless."""
+    taskqueue.add(url='/tasks/advance_tournament',
+                  params={'tournament_key': tournament_key.urlsafe()},
+                  countdown=countdown, transactional=transactional)
@@ -0,0 +1,244 @@
+"""userstats.py - Recount of the win/lose/draw results of every User from
+the games they finished, repairing the Users whose results have drifted,
+such as after a failure between the writes of a game. A job splits the
+Users into SHARDS ranges of names at keys sampled with __scatter__, and
+runs a chain of tasks per range in parallel. Each task maps batches of
+USER_BATCH_SIZE Users: it counts each User's results from the finished
+Games and GameSummaries they played, then corrects the Users whose results
+plus pending counter shards differ. A StatsRepairShard per range keeps its
+cursor and the drift found, so a failed task resumes from its last batch
+and the job reports its progress. A game finishing while its players are
+counted would look like drift, so the games that were active when counted
+are read again in the correcting transaction, and the Users of one that
+has finished meanwhile are skipped until the next run."""
+
+import logging
+import time
+
+from google.appengine.api import datastore_errors, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import counters
+import leaderboard
+from models import Game, GameSummary, StatsRepairShard, User
+from utils import job_name
+
+SHARDS = 8  # Ranges of Users repaired in parallel
+OVERSAMPLE = 32  # Keys sampled per range to choose the range bounds
+USER_BATCH_SIZE = 50  # Users counted at the same time
+GAME_BATCH_SIZE = 500
+# Active games checked in the correcting transaction, which also holds the
+# User and its counter shards within the 25 entity groups of a transaction
+MAX_ACTIVE_GAMES = 25 - 1 - counters.SHARDS
+JOB_KIND = 'StatsRepair'  # Kind of the parent key of the shards of a job
+TASK_URL = '/tasks/repair_user_stats'
+
+
+def start(shards=SHARDS, enqueue=True):
+    """Split the Users into ranges and start a repair job.
+    Args:
+        shards: Number of ranges repaired in parallel
+        enqueue: Enqueue the task of each range, or leave them to run()
+    Returns:
+        The key of the job"""
+    job_key = ndb.Key(JOB_KIND, job_name())
+    bounds = split_points(shards)
+    ranges = [StatsRepairShard(parent=job_key, id=i + 1, start=first,
+                               end=last)
+              for i, (first, last) in enumerate(zip([None] + bounds,
+                                                    bounds + [None]))]
+    ndb.put_multi(ranges)
+    if enqueue:
+        taskqueue.Queue().add([_task(shard) for shard in ranges])
+    return job_key
+
+
+def split_points(shards):
+    """Return up to shards - 1 user names that split the Users into ranges
+    of about the same size. __scatter__ orders a uniform sample of the
+    keys."""
+    keys = User.query().order(ndb.GenericProperty('__scatter__')).fetch(
+        shards * OVERSAMPLE, keys_only=True)
+    names = sorted(key.id() for key in keys)
+    step = float(len(names)) / shards
+    return sorted(set(names[int(i * step)] for i in range(1, shards)
+                      if int(i * step) < len(names)))
+
+
+def resume(job_key):
+    """Enqueue the task of every unfinished range of a job again, after
+    their tasks ran out of retries"""
+    ranges = [shard for shard in StatsRepairShard.query(ancestor=job_key)
+              if not shard.is_done]
+    if ranges:
+        taskqueue.Queue().add([_task(shard) for shard in ranges])
+
+
+def _task(shard):
+    return taskqueue.Task(url=TASK_URL,
+                          params={'shard': shard.key.urlsafe()})
+
+
+def run(shard_key, deadline):
+    """Repair batches of Users of a range from its cursor until the range
+    is done or the deadline (a time.time() value) has passed.
+    Returns:
+        The StatsRepairShard, its is_done False if it has more Users"""
+    shard = shard_key.get()
+    query = User.query()
+    if shard.start is not None:
+        query = query.filter(User.key >= ndb.Key(User, shard.start))
+    if shard.end is not None:
+        query = query.filter(User.key < ndb.Key(User, shard.end))
+
+    while not shard.is_done and time.time() < deadline:
+        cursor = Cursor(urlsafe=shard.cursor) if shard.cursor else None
+        keys, next_cursor, more = query.fetch_page(
+            USER_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        _repair_batch(shard, [key.id() for key in keys])
+        shard.cursor = next_cursor.urlsafe() if next_cursor else None
+        shard.is_done = not more
+        shard.put()
+    return shard
+
+
+def _repair_batch(shard, names):
+    """Count the results of a batch of Users and correct those that
+    differ, adding to the counts of the shard"""
+    counts = [recount_async(name) for name in names]
+    futures = []
+    for name, future in zip(names, counts):
+        results, active = future.get_result()
+        if len(active) > MAX_ACTIVE_GAMES:
+            logging.warning('{} has too many active games to be repaired'.
+                            format(name))
+            shard.skipped += 1
+        else:
+            futures.append((name, correct_async(name, results, active)))
+
+    corrected = []
+    for name, future in futures:
+        try:
+            checked = future.get_result()
+        except datastore_errors.TransactionFailedError:
+            logging.warning('Repair of the results of {} failed, it will be '
+                            'retried by the next run'.format(name))
+            continue
+        if checked is None:
+            shard.skipped += 1
+            continue
+        drift, user = checked
+        shard.users += 1
+        shard.drift += drift
+        if user:
+            corrected.append(user)
+            logging.warning('Corrected the results of {} by {}'.format(
+                name, drift))
+    if corrected:
+        shard.corrected += len(corrected)
+        leaderboard.update(counters.refresh(corrected))
+
+
+@ndb.tasklet
+def recount_async(name):
+    """Count the results of a player in every finished game.
+    Returns:
+        A tuple of a dict of the number of games won, lost and drawn, and
+        the keys of the player's Games that were active"""
+    results = {counters.WIN: 0, counters.LOSE: 0, counters.DRAW: 0}
+    active = []
+    seen = set()
+    # Games first: a game archived in between is then found twice, not
+    # missed
+    for model in (Game, GameSummary):
+        query = model.query(model.players == name)
+        cursor = None
+        more = True
+        while more:
+            entities, cursor, more = yield query.fetch_page_async(
+                GAME_BATCH_SIZE, start_cursor=cursor)
+            for entity in entities:
+                if entity.key.id() in seen:
+                    continue
+                seen.add(entity.key.id())
+                game = entity if model is Game else entity.to_game()
+                if game.is_active:
+                    active.append(game.key)
+                    continue
+                for result in game_results(game, name):
+                    results[result] += 1
+    raise ndb.Return(results, active)
+
+
+def game_results(game, name):
+    """Return the results a finished Game counted for a player, one per
+    side they played, or none if the game was cancelled"""
+    outcome = counters.outcome(game)
+    if not outcome:
+        return []
+    return [result for player_name, result
+            in zip((game.player_1_name, game.player_2_name), outcome)
+            if player_name == name]
+
+
+@ndb.transactional_tasklet(xg=True)
+def correct_async(name, results, active=()):
+    """Correct the results of a User so that they plus its pending counter
+    shards equal the results counted. The games that were active when
+    counted are read in the same transaction: one that has finished since
+    is in the pending shards but not in the results, and a game finishing
+    before the commit makes the transaction retry.
+    Args:
+        name: The name of the User
+        results: The results counted by recount_async
+        active: The keys of the Games active when counted, up to
+            MAX_ACTIVE_GAMES
+    Returns:
+        A tuple of the sum of the differences of the win, lose and draw
+        counts, and the User if it was written, or None if a game that
+        was active has finished"""
+    keys = [ndb.Key(User, name)] + counters.shard_keys(name)
+    entities = yield ndb.get_multi_async(keys + list(active))
+    games = entities[len(keys):]
+    if not all(game and game.is_active for game in games):
+        raise ndb.Return(None)
+    user = entities[0]
+    if not user:
+        raise ndb.Return((0, None))
+    pending = {counters.WIN: 0, counters.LOSE: 0, counters.DRAW: 0}
+    for shard in entities[1:len(keys)]:
+        if shard:
+            for result in pending:
+                pending[result] += getattr(shard, result)
+
+    drift = 0
+    for result, count in results.items():
+        expected = count - pending[result]
+        drift += abs(getattr(user, result) - expected)
+        setattr(user, result, expected)
+    rate = counters.winning_rate(user)
+    if not drift and user.winning_rate == rate:
+        raise ndb.Return((0, None))
+    user.winning_rate = rate
+    yield user.put_async()
+    raise ndb.Return((drift, user))
+
+
+def report(job_key):
+    """Return the progress of a job and the drift it found as a dict"""
+    totals = {'job': job_key.id(), 'ranges': 0, 'done': 0, 'users': 0,
+              'skipped': 0, 'corrected': 0, 'drift': 0}
+    for shard in StatsRepairShard.query(ancestor=job_key):
+        totals['ranges'] += 1
+        totals['done'] += shard.is_done
+        for name in ('users', 'skipped', 'corrected', 'drift'):
+            totals[name] += getattr(shard, name)
+    return totals
+
+
+def latest_job():
+    """Return the key of the job started last, or None"""
+    shard = StatsRepairShard.query().order(-StatsRepairShard.started).get(
+        keys_only=True)
+    return shard.parent() if shard else None
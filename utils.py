@@ -1,24 +1,66 @@
 """utils.py - File for collecting general utility functions."""
 
+import collections
+import datetime
+import random
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+from models import Game, User
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+ACTIVE_GAME_TTL = 30  # Seconds an active Game stays in memcache
+FINISHED_GAME_TTL = 24 * 60 * 60  # Seconds a finished Game stays in memcache
+# Memcache TTL of each cached model, by entity. Other models are not cached
+CACHE_POLICIES = {
+    Game: lambda game: ACTIVE_GAME_TTL if game.is_active
+    else FINISHED_GAME_TTL,
+}
+CACHE_KEY = 'entity:{}'
+INVALIDATE_LOCK = 2  # Seconds a reader may not refill an invalidated entry
+KEY_CACHE_SIZE = 10000  # Decoded keys kept per instance
+COUNTS_KEY = 'cache_counts:{}:{}'
+COUNTS_FLUSH_INTERVAL = 10  # Seconds between flushes of the hit counters
+COALESCE_WAIT = 1  # Seconds a read waits for the same read in flight
+
+_keys = {}
+_counts = collections.Counter()
+_counts_lock = threading.Lock()
+_counts_flushed = [time.time()]
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def get_key(urlsafe, model):
+    """Returns the ndb.Key that a urlsafe key string encodes, without
+        fetching the entity. Raises an error if the key String is malformed
+        or the key is of the incorrect kind
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The ndb.Key
     Raises:
         ValueError:"""
+    key = _keys.get(urlsafe)
+    if key is None:
+        key = _decode_key(urlsafe)
+        if len(_keys) >= KEY_CACHE_SIZE:
+            _keys.clear()
+        _keys[urlsafe] = key
+
+    if key.kind() != model._get_kind():
+        raise ValueError('Incorrect Kind')
+    return key
+
+
+def _decode_key(urlsafe):
     try:
-        key = ndb.Key(urlsafe=urlsafe)
+        return ndb.Key(urlsafe=urlsafe)
     except TypeError:
         raise endpoints.BadRequestException('Invalid Key')
     except Exception, e:
@@ -27,9 +69,185 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
+
+def get_by_urlsafe(urlsafe, model, cached=True):
+    """Returns an ndb.Model entity that the urlsafe key points to. Checks
+        that the type of entity returned is of the correct kind. Raises an
+        error if the key String is malformed or the entity is of the incorrect
+        kind. Entities of the models in CACHE_POLICIES are read from memcache
+        when cached is True; code that writes the entity back must read it
+        with cached=False.
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+        cached: Whether the entity may come from memcache
+    Returns:
+        The entity that the urlsafe Key string points to or None if no entity
+        exists.
+    Raises:
+        ValueError:"""
+    return get_by_urlsafe_async(urlsafe, model, cached).get_result()
+
+
+@ndb.tasklet
+def get_by_urlsafe_async(urlsafe, model, cached=True):
+    """Asynchronous version of get_by_urlsafe, returning a Future"""
+    key = get_key(urlsafe, model)
+    if cached and model in CACHE_POLICIES:
+        entity = yield _get_cached_async(key, CACHE_POLICIES[model])
+    else:
+        entity = yield key.get_async()
     if not entity:
-        return None
+        raise ndb.Return(None)
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
-    return entity
+    raise ndb.Return(entity)
+
+
+@ndb.tasklet
+def _get_cached_async(key, ttl):
+    context = ndb.get_context()
+    cache_key = CACHE_KEY.format(key.urlsafe())
+    entity = yield context.memcache_get(cache_key)
+    count(key.kind(), 'miss' if entity is None else 'hit')
+    if entity is None:
+        entity = yield key.get_async(use_memcache=False)
+        if entity:
+            # add() fails while an invalidation holds the entry locked
+            yield context.memcache_add(cache_key, entity, time=ttl(entity))
+    raise ndb.Return(entity)
+
+
+def invalidate(*keys):
+    """Drop entities from the cache of get_by_urlsafe. Call after writing
+        an entity of a model in CACHE_POLICIES.
+    Args:
+        keys: The ndb.Keys of the written entities"""
+    client = memcache.Client()
+    for key in keys:
+        client.delete(CACHE_KEY.format(key.urlsafe()),
+                      seconds=INVALIDATE_LOCK)
+
+
+def count(kind, outcome):
+    """Count an outcome, such as a cache hit, in memcache. Counts are
+        added up per instance and flushed every COUNTS_FLUSH_INTERVAL."""
+    with _counts_lock:
+        _counts[COUNTS_KEY.format(kind, outcome)] += 1
+        if time.time() - _counts_flushed[0] < COUNTS_FLUSH_INTERVAL:
+            return
+        counts = dict(_counts)
+        _counts.clear()
+        _counts_flushed[0] = time.time()
+    memcache.offset_multi(counts, initial_value=0)
+
+
+def cache_counts():
+    """Returns the hits, misses and coalesced reads of the get_by_urlsafe
+        cache counted by every instance, up to COUNTS_FLUSH_INTERVAL
+        seconds ago.
+    Returns:
+        A dict mapping each cached kind to a dict of its counts."""
+    counts = {}
+    for model in CACHE_POLICIES:
+        kind = model._get_kind()
+        hits, misses, coalesced = read_counts(kind,
+                                              ('hit', 'miss', 'coalesced'))
+        counts[kind] = {'hits': hits, 'misses': misses,
+                        'coalesced': coalesced}
+    return counts
+
+
+def read_counts(kind, outcomes):
+    """Returns the number of times each of the outcomes of a kind was
+        counted with count()"""
+    keys = [COUNTS_KEY.format(kind, outcome) for outcome in outcomes]
+    counts = memcache.get_multi(keys)
+    return [counts.get(key, 0) for key in keys]
+
+
+class _Flight(object):
+    """A read in flight, which the same reads started meanwhile wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.ok = False
+
+
+def coalesce(key, fetch):
+    """Returns the result of fetch() for an entity, sharing it with the
+        calls for the same key that run at the same time on the other
+        threads of this instance, so that a burst of identical reads makes
+        one fetch. The result is shared, so it must not be modified. A call
+        that waits more than COALESCE_WAIT, or whose fetch in flight fails,
+        makes its own.
+    Args:
+        key: The ndb.Key of the entity read
+        fetch: A function of no arguments reading it
+    Returns:
+        The result of fetch()"""
+    with _inflight_lock:
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _inflight[key] = _Flight()
+
+    if not leader:
+        if flight.done.wait(COALESCE_WAIT) and flight.ok:
+            count(key.kind(), 'coalesced')
+            return flight.result
+        return fetch()
+
+    try:
+        flight.result = fetch()
+        flight.ok = True
+        return flight.result
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        flight.done.set()
+
+
+def get_cursor(urlsafe):
+    """Returns the query Cursor for a urlsafe cursor string sent by a client.
+    Args:
+        urlsafe: A urlsafe cursor string, or None for the first page
+    Returns:
+        The Cursor, or None if no cursor string was given.
+    Raises:
+        endpoints.BadRequestException: If the cursor string is malformed."""
+    if not urlsafe:
+        return None
+    try:
+        return Cursor(urlsafe=urlsafe)
+    except Exception:
+        raise endpoints.BadRequestException('Invalid cursor')
+
+
+def get_users(names):
+    """Returns the User entities for the given player names with a single
+        batch get. Users are keyed by their name, so this is a key lookup
+        served from ndb's in-context cache and memcache where possible.
+    Args:
+        names: A list of player names
+    Returns:
+        A list of User entities in the same order as names, with None for
+        each name that has no User."""
+    return get_users_async(names).get_result()
+
+
+@ndb.tasklet
+def get_users_async(names):
+    """Asynchronous version of get_users, returning a Future"""
+    users = yield ndb.get_multi_async([ndb.Key(User, name) for name in names],
+                                      use_cache=True, use_memcache=True)
+    raise ndb.Return(users)
+
+
+def job_name():
+    """Return the name of a new background job: the time it starts, with a
+    random suffix so that jobs started in the same second differ"""
+    return '{}-{:06x}'.format(
+        datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S'),
+        random.getrandbits(24))